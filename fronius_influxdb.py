@@ -2,6 +2,9 @@
 
 import sys
 import time
+import signal
+import asyncio
+import concurrent.futures
 import argparse
 import logging
 
@@ -9,10 +12,150 @@ logging.basicConfig(format='fronius_influxdb: %(message)s', level=logging.INFO)
 
 
 from pv_fronius.fronius_symo import Symo
+from pv_fronius.fronius_symo_async import AsyncSymo
+from pv_fronius.poll_scheduler import PollScheduler, poll_periods
 from influxdb_cli2.influxdb_cli2 import influxdb_cli2
+from influxdb_cli2.write_filter import write_filter
 
 from config_data import *
 
+parameter_ignore = 'Sunspec'
+
+# Points are written in batches from a background thread
+influxdb_batch_size = 1000
+influxdb_flush_interval = 5.0
+
+# Seconds between attempts to detect a device which is not reachable (e.g. a Symo
+# without battery sleeps at night)
+detect_retry_interval = 60.0
+# --all: writes waiting for the worker thread before polling waits for them
+max_pending_writes = 16
+
+# With --multi-field one snapshot is one line of this measurement, a field per parameter
+multi_field_measurement = 'symo'
+
+# Only changes are written, see influxdb_cli2/write_filter.py
+# [part of the parameter name, filter config], first match wins
+write_filter_configs = [
+    ["Energy", {'heartbeat' : 3600.0}],
+    ["Power", {'swinging_door' : 10.0}],
+    ["AC_Output_L", {'swinging_door' : 10.0}],
+    ["Current", {'deadband' : 0.05}],
+    ["Voltage", {'deadband' : 1.0}],
+    ["Frequency", {'deadband' : 0.02}],
+    ["Temperature", {'deadband' : 0.5}],
+    ["Ratio", {'deadband' : 0.01}],
+    ["Imbalance", {'deadband' : 0.01}],
+    ["Efficiency", {'deadband' : 0.001}],
+]
+
+def logged_parameters(symo):
+    return [name for name in symo.get_all_parameters() + symo.get_all_calculated() if parameter_ignore not in name]
+
+def write_snapshot(influxdb, influxdb_table, snapshot, names, verbose=False, multi_field=False):
+    for name in names:
+        value = snapshot[name]
+
+        if verbose:
+            logging.info('{0} = {1}'.format(name,value))
+
+        if not multi_field:
+            influxdb.write_sensordata(influxdb_table, name, value, timestamp=snapshot.timestamp)
+
+    if multi_field:
+        influxdb.write_fields(influxdb_table, multi_field_measurement, {name : snapshot[name] for name in names}, timestamp=snapshot.timestamp)
+
+# SIGTERM (systemd stop) ends like Ctrl-C, so the finally blocks write what is held back
+def terminate(signum, frame):
+    sys.exit(0)
+
+async def poll_due(symo, scheduler):
+    names = scheduler.due()
+    if not names:
+        return None
+    snapshot = await symo.snapshot(names)
+    scheduler.completed(snapshot)
+    return [snapshot, names]
+
+# Detect the register map of a device, False if it could not be identified
+async def detect(symo):
+    try:
+        await symo.detect_model()
+    except Exception as e:
+        logging.error("Detecting {0} failed: {1}".format(symo.ipaddr, e))
+        return False
+    return bool(symo.registers)
+
+# All configured inverters from one event loop. Devices which are not reachable
+# at the start are detected again every detect_retry_interval seconds, InfluxDB
+# writes run in a worker thread, so they don't stall the polls of the others.
+async def log_all(influxdb, ipaddrs, influxdb_tables, verbose=False, periods=poll_periods, metrics_period=None, multi_field=False):
+    loop = asyncio.get_running_loop()
+    # One worker keeps the points of a device in order
+    writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    writes = set()
+
+    symos = [AsyncSymo(ipaddr) for ipaddr in ipaddrs]
+    schedulers = [None] * len(symos)
+    next_detect = [0.0] * len(symos)
+    next_metrics = time.monotonic()
+
+    def written(future):
+        writes.discard(future)
+        if not future.cancelled() and future.exception():
+            logging.error("Writing to InfluxDB failed: {0}".format(future.exception()))
+
+    def write(function, *args):
+        future = loop.run_in_executor(writer, function, *args)
+        writes.add(future)
+        future.add_done_callback(written)
+
+    try:
+        while True:
+            now = time.monotonic()
+            pending = [i for i in range(len(symos)) if schedulers[i] is None and now >= next_detect[i]]
+            if pending:
+                detected = await asyncio.gather(*[detect(symos[i]) for i in pending])
+                for i, found in zip(pending, detected):
+                    if found:
+                        logging.info("Found Inverter {0} at {1}".format(symos[i].name, symos[i].ipaddr))
+                        schedulers[i] = PollScheduler(logged_parameters(symos[i]), periods)
+                    else:
+                        logging.error("Inverter at {0} not found, retry in {1:.0f}s".format(symos[i].ipaddr, detect_retry_interval))
+                        next_detect[i] = now + detect_retry_interval
+
+            active = [i for i in range(len(symos)) if schedulers[i] is not None]
+            start = time.monotonic()
+            results = await asyncio.gather(*[poll_due(symos[i], schedulers[i]) for i in active], return_exceptions=True)
+            if verbose:
+                logging.info("Sweep over {0} inverters took {1:.2f}s".format(len(active), time.monotonic() - start))
+
+            for i, result in zip(active, results):
+                if isinstance(result, Exception):
+                    # Not completed, stays due for the next tick
+                    logging.error("Reading {0} failed: {1}".format(ipaddrs[i], result))
+                    continue
+                if result is not None:
+                    [snapshot, names] = result
+                    write(write_snapshot, influxdb, influxdb_tables[i], snapshot, names, verbose, multi_field)
+
+            if metrics_period and time.monotonic() >= next_metrics:
+                for i in active:
+                    write(symos[i].write_metrics, influxdb, influxdb_tables[i])
+                next_metrics += metrics_period
+
+            if len(writes) > max_pending_writes:
+                # InfluxDB can't keep up, wait instead of queueing more
+                await asyncio.wait(list(writes))
+
+            sleep_times = [schedulers[i].sleep_time() for i in active]
+            sleep_times += [next_detect[i] - time.monotonic() for i in range(len(symos)) if schedulers[i] is None]
+            await asyncio.sleep(max(min(sleep_times, default=detect_retry_interval), 0.0))
+    finally:
+        writer.shutdown(wait=True)
+        for symo in symos:
+            await symo.close()
+
 if __name__ == "__main__":
     import time
 
@@ -26,8 +169,46 @@ if __name__ == "__main__":
                            action='store')
     argparser.add_argument("-c", "--config", help="Use predefined config (starts with 0)",
                            action='store')
+    argparser.add_argument("-A", "--all", help="Poll all predefined configs concurrently",
+                           action='store_true')
+    argparser.add_argument("--power-period", help="Seconds between reads of power values",
+                           default=poll_periods["power"], type=float, action='store')
+    argparser.add_argument("--state-period", help="Seconds between reads of state values (SoC, limits...)",
+                           default=poll_periods["state"], type=float, action='store')
+    argparser.add_argument("--energy-period", help="Seconds between reads of energy counters",
+                           default=poll_periods["energy"], type=float, action='store')
+    argparser.add_argument("--no-filter", help="Write every value, not only changes",
+                           action='store_true')
+    argparser.add_argument("--multi-field", help="Write a snapshot as one line with a field per parameter (measurement {0})".format(multi_field_measurement),
+                           action='store_true')
+    argparser.add_argument("--spool", help="Directory of a disk spool, points are kept there while InfluxDB is not reachable",
+                           action='store')
+    argparser.add_argument("--metrics-period", help="Write Modbus latency/error metrics every N seconds",
+                           type=float, action='store')
     args = argparser.parse_args()
 
+    if args.no_filter:
+        influxdb_filter = None
+    else:
+        influxdb_filter = write_filter(write_filter_configs)
+
+    periods = dict(poll_periods)
+    periods["power"] = args.power_period
+    periods["state"] = args.state_period
+    periods["energy"] = args.energy_period
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    if args.all:
+        influxdb = influxdb_cli2(influxdb_url, influxdb_token, org=influxdb_org, bucket=influxdb_bucket, write_filter=influxdb_filter,
+                                 batch_size=influxdb_batch_size, flush_interval=influxdb_flush_interval, spool_dir=args.spool)
+        try:
+            asyncio.run(log_all(influxdb, symo_ip, symo_table, args.verbose, periods, args.metrics_period, args.multi_field))
+        finally:
+            # Points held back by the write filter and the queued batches
+            influxdb.close()
+        sys.exit(0)
+
     if args.config and args.address:
         logging.error("Can not use predefined config and setting address via commandline at some time")
         sys.exit(1)
@@ -44,38 +225,34 @@ if __name__ == "__main__":
 
     logging.info("Using IP {0}, Database Table {1}".format(ipaddr, influxdb_table))
 
-    influxdb = influxdb_cli2(influxdb_url, influxdb_token, org=influxdb_org, bucket=influxdb_bucket)
-
-    symo = Symo(ipaddr)
-    logging.info("Found Inverter {0}".format(symo.name))
-
-    parameters = symo.get_all_parameters()
-    parameter_ignore = 'Sunspec'
-    calculated_parameters = symo.get_all_calculated()
-
-    while True:
-
-        for name in parameters:
-            if parameter_ignore in name:
-                continue
-            value = symo.read_data(name)
-
-            if args.verbose:
-                logging.info('{0} = {1}'.format(name,value))
+    influxdb = influxdb_cli2(influxdb_url, influxdb_token, org=influxdb_org, bucket=influxdb_bucket, write_filter=influxdb_filter,
+                             batch_size=influxdb_batch_size, flush_interval=influxdb_flush_interval, spool_dir=args.spool)
 
-            influxdb.write_sensordata(influxdb_table, name, value)
-            time.sleep(0.02)
+    symo = Symo(ipaddr, persistent=True)
 
-        for name in calculated_parameters:
-            if parameter_ignore in name:
-                continue
-            value = symo.read_calculated_value(name)
+    try:
+        while not symo.registers:
+            logging.error("Inverter at {0} not found, retry in {1:.0f}s".format(ipaddr, detect_retry_interval))
+            time.sleep(detect_retry_interval)
+            symo.detect_model()
+        logging.info("Found Inverter {0}".format(symo.name))
 
-            if args.verbose:
-                logging.info('{0} = {1}'.format(name,value))
+        scheduler = PollScheduler(logged_parameters(symo), periods)
+        next_metrics = time.monotonic()
 
-            influxdb.write_sensordata(influxdb_table, name, value)
-            time.sleep(0.02)
+        while True:
+            names = scheduler.due()
+            if names:
+                snapshot = symo.snapshot(names)
+                scheduler.completed(snapshot)
+                write_snapshot(influxdb, influxdb_table, snapshot, names, args.verbose, args.multi_field)
 
+            if args.metrics_period and time.monotonic() >= next_metrics:
+                symo.write_metrics(influxdb, influxdb_table)
+                next_metrics += args.metrics_period
 
-        time.sleep(60)
+            time.sleep(scheduler.sleep_time())
+    finally:
+        # Points held back by the write filter and the queued batches
+        influxdb.close()
+        symo.close()
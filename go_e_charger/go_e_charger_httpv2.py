@@ -4,6 +4,16 @@
 
 # Version history:
 # V1: Baseline
+# V2: Persistent keep-alive session, retries for status reads, connection counters
+# V3: Status cache, one status request serves all property reads within status_ttl
+# V4: apply() sets several keys with one request, fix convert_outgoing_param,
+#     setChargingP raises currents below the 6 A minimum of the wallbox
+# V5: setChargingP returns at once, a background thread tracks when the new current is in effect
+# V6: Status reads fetch only the used keys with filter=, full status only as fallback
+# V7: Only values younger than status_ttl are handed out, also after a failed status read
+# V8: Cache and stats guarded by the lock, the settle thread refreshes concurrently
+# V9: Broken replies count as failed requests, a failed poll doesn't end settle tracking
+# V10: http error replies of status reads are failed reads
 
 # Based on https://github.com/cathiele/goecharger/blob/main/goecharger/goecharger.py
 # API-documentation: https://go-e.co/app/api.pdf
@@ -12,15 +22,64 @@
 # http://192.168.0.12/api/status
 
 import requests
+from requests.adapters import HTTPAdapter
 from enum import Enum
 from json.decoder import JSONDecodeError
+from concurrent.futures import Future
+import threading
+import logging
 import time
 
 class GoeCharger:
     
-    def __init__(self, ipaddr = '192.168.0.82', debug=False):
+    # The ESP32 of the go-e is slow to accept connections, so one connection
+    # is kept open and reused for all requests
+    # status_ttl: seconds a fetched status serves property reads, 0 = always fetch
+    # settle_interval/settle_timeout: status polling after setChargingP until the
+    # wallbox shows the new current (acu) and the car draws it (nrg)
+    def __init__(self, ipaddr = '192.168.0.82', debug=False, connect_timeout=5.0, read_timeout=5.0,
+                 retries=2, retry_backoff=0.5, status_ttl=10.0,
+                 settle_interval=2.0, settle_timeout=30.0, settle_tolerance=1.0):
         self.ipaddr = ipaddr
         self.debug = debug
+        self.timeout = (connect_timeout, read_timeout)
+        # Status reads are repeated on connection errors/timeouts, with retry_backoff * 2^n seconds in between
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', self.adapter)
+        # The settle thread shares the session, status_cache/status_times and
+        # stats with the caller
+        self.lock = threading.RLock()
+        # Raw api status, updated by sets, and the fetch time per key
+        self.status_ttl = status_ttl
+        self.status_cache = {}
+        self.status_times = {}
+        # None = unknown, False = the wallbox ignores filter=, full status is fetched
+        self.filter_supported = None
+
+        self.stats = {
+            'requests' : 0,
+            'retries' : 0,
+            'failed_requests' : 0,
+            'cache_hits' : 0,
+            'cache_misses' : 0,
+            'bytes_received' : 0,
+            'full_status_reads' : 0,
+            'settled' : 0,
+            'settle_timeouts' : 0,
+            'settle_superseded' : 0,
+        }
+
+        self.settle_interval = settle_interval
+        self.settle_timeout = settle_timeout
+        self.settle_tolerance = settle_tolerance
+        # Future of the last setChargingP and the event to stop its thread
+        self.settle = None
+        self.settle_stop = None
+        self.settle_time = None
         self.parameters = {
             # Format:
             # 'code' : ['Name', convertread, convertwrite]
@@ -37,24 +96,176 @@ class GoeCharger:
             'cus' : ['cable_unlock_status', None, None],
             }
 
-    def __ReadStatusAPI(self, params = 'all'):
+        # Keys fetched with every status read, so the other property reads of a
+        # control cycle are served from the cache
+        self.status_keys = list(self.parameters.keys())
+
+        # Keys which can be set, 'code' : [min, max]
+        self.set_limits = {
+            'amp' : [6, 32],
+            'frc' : [0, 2],
+            'psm' : [0, 2],
+            }
+
+    def close(self):
+        if self.settle_stop is not None:
+            self.settle_stop.set()
+        self.session.close()
+
+    # Requests, new and reused connections
+    def connection_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        new_connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool:
+                new_connections += pool.num_connections
+        stats['new_connections'] = new_connections
+        stats['reused_connections'] = max(stats['requests'] - new_connections, 0)
+        return stats
+
+    def __Request(self, url, params=None):
+        if self.debug:
+            print("GET {0} {1}".format(url, params))
+        with self.lock:
+            self.stats['requests'] += 1
+            return self.session.get(url, params=params, timeout=self.timeout)
+
+    # codes: list of api keys, None = full status (several kB)
+    def __ReadStatusAPI(self, codes=None):
+        if codes is None:
+            url = "http://%s/api/status" % self.ipaddr
+            self.stats['full_status_reads'] += 1
+        else:
+            # Comma must not be url encoded
+            url = "http://{0}/api/status?filter={1}".format(self.ipaddr, ",".join(codes))
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                self.stats['retries'] += 1
+                time.sleep(self.retry_backoff * 2**(attempt - 1))
+            try:
+                statusRequest = self.__Request(url)
+                self.stats['bytes_received'] += len(statusRequest.content)
+                # An error reply is no status, it would also look like an ignored filter=
+                statusRequest.raise_for_status()
+                status = statusRequest.json()
+                return status
+            # Timeouts, resets, truncated or non-JSON replies
+            except (requests.exceptions.RequestException, ValueError) as e:
+                if self.debug:
+                    print("Reading status failed: {0}".format(e))
+        self.stats['failed_requests'] += 1
+        return {}
+
+    # All values with one request, {code : value} -> {code : True or error message}
+    # Not repeated, the wallbox could have taken the values already
+    def __WriteStatusAPI(self, values):
+        with self.lock:
+            return self.__WriteStatus(values)
+
+    def __WriteStatus(self, values):
+        try:
+            setRequest = self.__Request("http://%s/api/set" % self.ipaddr, params=values)
+        except requests.exceptions.RequestException as e:
+            self.stats['failed_requests'] += 1
+            for code in values:
+                self.status_cache.pop(code, None)
+                self.status_times.pop(code, None)
+            if self.debug:
+                print("Setting {0} failed: {1}".format(values, e))
+            return {code : 'failed' for code in values}
+        if setRequest.status_code != 200:
+            self.stats['failed_requests'] += 1
+            for code in values:
+                self.status_cache.pop(code, None)
+                self.status_times.pop(code, None)
+            return {code : 'failed, http status {0}'.format(setRequest.status_code) for code in values}
+
+        # go-e answers true or an error message per key
         try:
-            if 'all' == params:
-                statusRequest = requests.get("http://%s/api/status" % self.ipaddr, timeout=(5,5))
+            answer = setRequest.json()
+        except (JSONDecodeError, ValueError):
+            answer = {}
+        results = {}
+        for code, value in values.items():
+            result = answer.get(code, True)
+            if result is True:
+                # Optimistic, the next refresh shows what the wallbox really did
+                self.status_cache[code] = value
             else:
-                # TODO: Does not really work
-                # print("http://{0}/api/status?filter={1}".format( self.ipaddr, params))
-                statusRequest = requests.get("http://{0}/api/status?filter={1}".format( self.ipaddr, params), timeout=5)
-                # print(statusRequest.json())
+                self.status_cache.pop(code, None)
+                self.status_times.pop(code, None)
+            results[code] = result
+        return results
 
-            status = statusRequest.json()
+    # Fetch codes (None = status_keys) now, 'all' = full status
+    def refresh(self, codes=None):
+        with self.lock:
+            if codes == 'all':
+                status = self.__ReadStatusAPI()
+            else:
+                status = self.__FilteredStatus(self.status_keys if codes is None else codes)
+            if status:
+                now = time.monotonic()
+                self.status_cache.update(status)
+                for code in status:
+                    self.status_times[code] = now
             return status
-        except (requests.exceptions.ConnectTimeout, requests.exceptions.ConnectionError):
-            return {}
 
-    def __WriteStatusAPI(self, parameter, value):
-        setRequest = requests.get("http://%s/api/set?%s=%s" % (self.ipaddr, parameter, value), timeout=(5,5))
-        #return GoeChargerStatusMapper().mapApiStatusResponse(setRequest.json())
+    # Filtered status, the full status if the wallbox doesn't support filter=
+    def __FilteredStatus(self, codes):
+        if self.filter_supported is False:
+            return self.__ReadStatusAPI()
+        status = self.__ReadStatusAPI(codes)
+        if not status or self.filter_supported:
+            return status
+
+        # First answer, check that filter= works
+        if any(code not in codes for code in status):
+            # Ignored, got the full status anyway
+            self.filter_supported = False
+        elif all(code in status for code in codes):
+            self.filter_supported = True
+        else:
+            full = self.__ReadStatusAPI()
+            if not full:
+                return status
+            # Keys which are missing in the full status don't exist on this wallbox
+            self.filter_supported = not any(code in full for code in codes if code not in status)
+            status = full
+        if self.debug:
+            print("filter supported: {0}".format(self.filter_supported))
+        return status
+
+    def invalidate(self):
+        with self.lock:
+            self.status_times = {}
+
+    def __IsFresh(self, code, now):
+        fetched = self.status_times.get(code)
+        return fetched is not None and now - fetched < self.status_ttl
+
+    # Raw status from the cache if codes (None = status_keys) are younger than
+    # status_ttl. Otherwise one request for the missing codes and status_keys.
+    # Only values younger than status_ttl are returned, after a failed request
+    # the expired ones are missing like in a failed read.
+    def __CachedStatus(self, codes=None):
+        if codes is None:
+            codes = self.status_keys
+        with self.lock:
+            now = time.monotonic()
+            if all(self.__IsFresh(code, now) for code in codes):
+                self.stats['cache_hits'] += 1
+                status = {}
+            else:
+                self.stats['cache_misses'] += 1
+                status = self.refresh(self.status_keys + [code for code in codes if code not in self.status_keys])
+            fresh = {code : value for code, value in self.status_cache.items() if self.__IsFresh(code, now)}
+            fresh.update(status)
+            return fresh
         
     def convert_incomming_dict(self, data, raw = False):
         results = {}
@@ -77,12 +288,55 @@ class GoeCharger:
         return results
             
     def convert_outgoing_param(self, name, value):
-        for code, params in self.parameters:
+        if name in self.parameters:
+            return [name, value]
+        for code, params in self.parameters.items():
             if params[0] == name:
                 return [code, value]
             
         return [None, None]
 
+    # Set several parameters (names or api codes) with one request. Keys which
+    # already have the value are skipped. Returns {key : result}, result is
+    # 'ok', 'unchanged', 'unknown', 'read only', 'invalid' or the error of the wallbox
+    def apply(self, values):
+        results = {}
+        codes = {}
+        for name, value in values.items():
+            [code, value] = self.convert_outgoing_param(name, value)
+            if code is None:
+                results[name] = 'unknown'
+            elif code not in self.set_limits:
+                results[name] = 'read only'
+            else:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    value = None
+                [minimum, maximum] = self.set_limits[code]
+                if value is None or value < minimum or value > maximum:
+                    results[name] = 'invalid'
+                else:
+                    codes[name] = [code, value]
+
+        if codes:
+            status = self.__CachedStatus([code for [code, value] in codes.values()])
+            changed = {}
+            for name, [code, value] in codes.items():
+                if status.get(code) == value:
+                    results[name] = 'unchanged'
+                else:
+                    changed[code] = value
+            if changed:
+                answers = self.__WriteStatusAPI(changed)
+                for name, [code, value] in codes.items():
+                    if code in answers:
+                        results[name] = 'ok' if answers[code] is True else answers[code]
+
+        if self.debug:
+            print("apply {0}: {1}".format(values, results))
+        return results
+
     # pcr = read parameter convert 
     def rpc_car_status(self,value):
         car_status = {
@@ -146,7 +400,7 @@ class GoeCharger:
     def GetStatusAll(self, filtered=False):
         response = {}
         try:
-            status = self.__ReadStatusAPI()
+            status = self.__CachedStatus()
             
             response = self.convert_incomming_dict(status)
             if filtered:
@@ -161,7 +415,7 @@ class GoeCharger:
     def GetStatusNums(self, filtered=False):
         response = {}
         try:
-            status = self.__ReadStatusAPI()
+            status = self.__CachedStatus()
             
             response = self.convert_incomming_dict(status, raw = True)
             if filtered:
@@ -186,8 +440,10 @@ class GoeCharger:
                     break
             
             if code:
-                status = self.__ReadStatusAPI(params = code)
-                response = self.convert_incomming_dict(status)
+                status = self.__CachedStatus([code])
+                if code not in status:
+                    return None
+                response = self.convert_incomming_dict({code : status[code]})
             else:
                 return None
             
@@ -210,8 +466,11 @@ class GoeCharger:
                     break
             
             if code:
-                status = self.__WriteStatusAPI(parameter = code, value = value)
+                status = self.__WriteStatusAPI({code : value})
 #                response = self.convert_incomming_dict(status)
+                if status[code] is True:
+                    return True
+                return None
             else:
                 return None
             
@@ -245,10 +504,7 @@ class GoeCharger:
     
     @ForceOn.setter
     def ForceOn(self, value):
-        if self.ForceOn == value:
-            return None
-        else:
-            return self.SetStatusParam('force_state', value +1)
+        self.apply({'force_state' : value + 1})
 
     @property
     def SetPhaseMode(self):
@@ -271,7 +527,8 @@ class GoeCharger:
         print(values)
         return values['p_all']
 
-    def setChargingP(self, power):
+    # Returns the settle future of track_settle()
+    def setChargingP(self, power, on_settled=None):
         if power <= 5*230:
             power = 5*230
         elif power >= 16*3*230:
@@ -280,22 +537,104 @@ class GoeCharger:
         max_1p = 230*16*1
         car_phases = 2
         min_3p = 230*5*car_phases
-                
+
+        # Phase mode and current with one request, so the car never sees
+        # the new phase mode with the old current
+        values = {}
+        phase_mode = self.SetPhaseMode
         if (power < min_3p):
-            self.SetPhaseMode = 1
+            phase_mode = 1
+            values['phase_switch_mode'] = 1
         elif (power > max_1p):
-            self.SetPhaseMode = 3
+            phase_mode = 3
+            values['phase_switch_mode'] = 2
 
-        if self.SetPhaseMode == 3:
+        if phase_mode == 3:
             power = power / car_phases
         
         amps = int(power / 230)
         if amps > 16:
             amps = 16
+        # Between min_3p and max_1p in 3 phase mode and below 1380 W in 1 phase
+        # mode the current is below 6 A, which the wallbox rejects
+        if amps < self.set_limits['amp'][0]:
+            logging.warning("set_charging_p: {0} A is below the minimum, using {1} A".format(amps, self.set_limits['amp'][0]))
+            amps = self.set_limits['amp'][0]
         print("set_charging_p to {0} A".format(amps))
-        # if self.values['i_charge_cur_set'] != amps:
-        self.ChargerMaxCurrent = amps
-        time.sleep(10)
+        values['charger_max_current'] = amps
+        results = self.apply(values)
+        if results['charger_max_current'] not in ('ok', 'unchanged'):
+            # Nothing to wait for
+            settle = Future()
+            if on_settled:
+                settle.add_done_callback(on_settled)
+            settle.set_result(False)
+            return settle
+        return self.track_settle(amps, on_settled)
+
+    # True if the wallbox charges with amps, a car which doesn't charge
+    # only needs to see the new target current
+    def is_settled(self, status, amps):
+        if status.get('acu') != amps:
+            return False
+        if status.get('car') != 2:
+            return True
+        nrg = status.get('nrg')
+        if not nrg or len(nrg) < 7:
+            return False
+        return max(nrg[4:7]) >= amps - self.settle_tolerance
+
+    # Future with True when the new current is in effect, False on timeout and
+    # None if a later setChargingP came first. on_settled(future) is called then.
+    def track_settle(self, amps, on_settled=None):
+        if self.settle_stop is not None:
+            self.settle_stop.set()
+        future = Future()
+        if on_settled:
+            future.add_done_callback(on_settled)
+        stop = threading.Event()
+        self.settle = future
+        self.settle_stop = stop
+        thread = threading.Thread(target=self.__SettleThread, args=(amps, future, stop), daemon=True)
+        thread.start()
+        return future
+
+    # The future is always resolved, False if the thread fails unexpectedly
+    def __SettleThread(self, amps, future, stop):
+        start = time.monotonic()
+        result = False
+        try:
+            while not stop.wait(self.settle_interval):
+                try:
+                    status = self.refresh(['acu', 'car', 'nrg'])
+                except Exception as e:
+                    # A failed poll, try again until settle_timeout
+                    logging.error("GoeCharger: settle poll failed: {0}".format(e))
+                    with self.lock:
+                        self.stats['failed_requests'] += 1
+                    status = {}
+                if self.is_settled(status, amps):
+                    self.settle_time = time.monotonic() - start
+                    with self.lock:
+                        self.stats['settled'] += 1
+                    if self.debug:
+                        print("{0} A settled after {1:.1f}s".format(amps, self.settle_time))
+                    result = True
+                    return
+                if time.monotonic() - start >= self.settle_timeout:
+                    with self.lock:
+                        self.stats['settle_timeouts'] += 1
+                    if self.debug:
+                        print("{0} A not settled after {1}s".format(amps, self.settle_timeout))
+                    return
+            with self.lock:
+                self.stats['settle_superseded'] += 1
+            result = None
+        finally:
+            future.set_result(result)
+
+    def settling(self):
+        return self.settle is not None and not self.settle.done()
 
 
 
@@ -330,7 +669,8 @@ if __name__ == "__main__":
     go_e_charger = GoeCharger(args.address)
 
     if args.set_charging_p:
-        go_e_charger.setChargingP(int(args.set_charging_p))
+        settle = go_e_charger.setChargingP(int(args.set_charging_p))
+        print("settled: {0}".format(settle.result()))
 
     if args.enable_charging:
         go_e_charger.ForceOn = int(args.enable_charging)
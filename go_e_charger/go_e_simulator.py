@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+
+# Local http stand-in for a go-e charger (API v2), to run GoeCharger or
+# go_e_charger_control.py without a wallbox. Serves /api/status (with
+# filter=) and /api/set for the keys of GoeCharger.parameters and simulates
+# a car behind it: 1/2/3 phase car, delay until a new current is taken,
+# current ramps, the minimum pause between stop and start and the pause of a
+# phase switch. Latency and faults can be injected.
+# Time runs speed times faster than real time, the state is updated at every
+# request from the elapsed time.
+
+import http.server
+import threading
+import random
+import json
+import time
+import logging
+from urllib.parse import urlsplit, parse_qs
+
+# car
+car_idle = 1
+car_charging = 2
+car_waiting = 3
+car_finished = 4
+
+# modelStatus
+model_force_on = 3
+model_force_off = 4
+model_fallback_default = 15
+model_phase_switch = 23
+model_min_pause = 24
+
+# Keys a client may set, 'code' : [min, max]
+writable_keys = {
+    'amp' : [6, 32],
+    'frc' : [0, 2],
+    'psm' : [0, 2],
+}
+
+# Some of the other keys of a real status, so the full status has about the
+# size of the real one
+other_status = {
+    'alw' : True, 'cbl' : 32, 'cdi' : {'type' : 1, 'value' : 0}, 'fwv' : "055.7",
+    'ama' : 32, 'ate' : 15000, 'att' : 21600, 'awc' : 3, 'awp' : 15.0, 'cwe' : True,
+    'dwo' : None, 'err' : 0, 'esr' : 0, 'fna' : "go-eCharger", 'fsp' : False, 'lmo' : 3,
+    'lck' : 0, 'loe' : False, 'lse' : False, 'mca' : 6, 'mci' : 600000, 'mcpd' : 60000,
+    'mptwt' : 600000, 'nmo' : False, 'pha' : [True, True, True, True, True, True],
+    'rbc' : 42, 'rbt' : 123456789, 'rssi' : -62, 'sse' : "012345", 'tma' : [25.5, 27.0],
+    'tpa' : 0, 'trx' : 0, 'tsom' : 0, 'ust' : 0, 'wst' : 3, 'wak' : "********",
+    'wifis' : [{'ssid' : "home", 'key' : True, 'useStaticIp' : False, 'staticIp' : "0.0.0.0",
+                'staticSubnet' : "0.0.0.0", 'staticGateway' : "0.0.0.0", 'useStaticDns' : False,
+                'staticDns0' : "0.0.0.0", 'staticDns1' : "0.0.0.0", 'staticDns2' : "0.0.0.0"}] * 4,
+    'ccw' : {'ssid' : "home", 'encryptionType' : 3, 'pairwiseCipher' : 4, 'groupCipher' : 4,
+             'b' : True, 'g' : True, 'n' : True, 'lr' : False, 'wps' : False, 'ftmResponder' : False,
+             'ftmInitiator' : False, 'channel' : 6, 'bssid' : "00:11:22:33:44:55",
+             'ip' : "192.168.0.12", 'netmask' : "255.255.255.0", 'gw' : "192.168.0.1",
+             'ipv6' : ["fe80::1"], 'dns0' : "192.168.0.1", 'dns1' : "0.0.0.0", 'dns2' : "0.0.0.0"},
+    'sch_week' : {'control' : 0, 'ranges' : [{'begin' : {'hour' : 0, 'minute' : 0}, 'end' : {'hour' : 0, 'minute' : 0}}] * 2},
+    'sch_satur' : {'control' : 0, 'ranges' : [{'begin' : {'hour' : 0, 'minute' : 0}, 'end' : {'hour' : 0, 'minute' : 0}}] * 2},
+    'sch_sund' : {'control' : 0, 'ranges' : [{'begin' : {'hour' : 0, 'minute' : 0}, 'end' : {'hour' : 0, 'minute' : 0}}] * 2},
+    'cards' : [{'name' : "Card {0}".format(i), 'energy' : 0, 'cardId' : False} for i in range(10)],
+}
+
+
+class GoeSimulator:
+    # car_phases: phases the car charges with (eGolf: 2), car_max_current: limit of the car
+    # set_delay: seconds until the wallbox takes a new amp value (acu)
+    # start_delay: seconds from the start of charging until the car draws current
+    # ramp_rate: A/s the car follows a new current
+    # min_pause: seconds between stop and the next start
+    # phase_switch_pause: seconds without charging for a phase switch
+    def __init__(self, host='127.0.0.1', port=8080, car_phases=2, car_max_current=16, connected=True,
+                 set_delay=1.0, start_delay=5.0, ramp_rate=2.0, min_pause=60.0, phase_switch_pause=10.0,
+                 voltage=230.0, latency=0.0, fault_rate=0.0, fault_modes=('error',), speed=1.0, seed=None):
+        self.host = host
+        self.port = port
+        self.car_phases = car_phases
+        self.car_max_current = car_max_current
+        self.set_delay = set_delay
+        self.start_delay = start_delay
+        self.ramp_rate = ramp_rate
+        self.min_pause = min_pause
+        self.phase_switch_pause = phase_switch_pause
+        self.voltage = voltage
+        # Seconds before each response (real time), a number or [min, max]
+        self.latency = latency
+        # Probability per request for one of fault_modes: 'error' (http 500), 'timeout', 'disconnect'
+        self.fault_rate = fault_rate
+        self.fault_modes = list(fault_modes)
+        self.speed = speed
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.last_update = 0.0
+
+        # Settings as set by the client
+        self.amp = 6
+        self.frc = 0
+        self.psm = 1
+        # Wallbox: current in effect, when a new amp is taken
+        self.acu = None
+        self.pending_amp = None
+        self.pending_time = None
+        # Car: connected, current per phase, when it may (re)start
+        self.connected = connected
+        self.current = 0.0
+        self.charging_since = None
+        self.stopped_time = None
+        self.pause_until = None
+        self.phase_switch_until = None
+        self.phases = 1
+        self.energy_total = 1234567.0
+        self.energy_connected = 0.0
+
+        self.writes = []
+        self.stats = {
+            'connections' : 0,
+            'requests' : 0,
+            'status_requests' : 0,
+            'full_status_requests' : 0,
+            'set_requests' : 0,
+            'keys_set' : 0,
+            'bytes_sent' : 0,
+            'faults' : 0,
+        }
+
+        self.server = None
+        self.server_thread = None
+
+    # Simulated seconds since start
+    def now(self):
+        return (time.monotonic() - self.start_time) * self.speed
+
+    def wallbox_phases(self):
+        return 1 if self.psm == 1 else 3
+
+    def charge_allowed(self, now):
+        if not self.connected or self.frc == 1:
+            return False
+        if self.pause_until is not None and now < self.pause_until:
+            return False
+        if self.phase_switch_until is not None and now < self.phase_switch_until:
+            return False
+        return True
+
+    def model_status(self, now):
+        if self.phase_switch_until is not None and now < self.phase_switch_until:
+            return model_phase_switch
+        if self.pause_until is not None and now < self.pause_until and self.frc != 1:
+            return model_min_pause
+        if self.frc == 1:
+            return model_force_off
+        if self.frc == 2:
+            return model_force_on
+        return model_fallback_default
+
+    # Advance the simulation to now, in steps so ramps and energy are right
+    def update(self, now=None):
+        if now is None:
+            now = self.now()
+        with self.lock:
+            while self.last_update < now:
+                step = min(now - self.last_update, 0.1)
+                self.step(self.last_update + step, step)
+                self.last_update += step
+
+    def step(self, now, dt):
+        # New amp value is taken after set_delay
+        if self.pending_time is not None and now >= self.pending_time:
+            self.acu = self.pending_amp
+            self.pending_amp = None
+            self.pending_time = None
+
+        if self.charge_allowed(now):
+            if self.charging_since is None:
+                self.charging_since = now
+                self.phases = min(self.wallbox_phases(), self.car_phases)
+                if self.acu is None:
+                    self.acu = self.amp
+            target = min(self.acu, self.car_max_current) if now - self.charging_since >= self.start_delay else 0.0
+        else:
+            if self.charging_since is not None:
+                self.charging_since = None
+                self.stopped_time = now
+                # A phase switch is no stop of the car
+                if self.phase_switch_until is None or now >= self.phase_switch_until:
+                    self.pause_until = now + self.min_pause
+            self.acu = None
+            target = 0.0
+
+        if self.current < target:
+            self.current = min(self.current + self.ramp_rate * dt, target)
+        elif self.current > target:
+            self.current = max(self.current - self.ramp_rate * dt, target)
+
+        energy = self.current * self.voltage * self.phases * dt / 3600.0
+        self.energy_total += energy
+        if self.connected:
+            self.energy_connected += energy
+
+    def car_status(self):
+        if not self.connected:
+            return car_idle
+        if self.current > 0.0:
+            return car_charging
+        if self.frc == 1 or self.charging_since is None:
+            return car_waiting
+        return car_charging
+
+    def nrg(self):
+        currents = [self.current if phase < self.phases else 0.0 for phase in range(3)]
+        powers = [round(current * self.voltage) for current in currents]
+        return ([self.voltage, self.voltage, self.voltage, 0.0]
+                + [round(current, 1) for current in currents]
+                + powers + [0, sum(powers)]
+                + [100 if current else 0 for current in currents] + [0])
+
+    def status(self, codes=None):
+        now = self.now()
+        self.update(now)
+        with self.lock:
+            status = {
+                'car' : self.car_status(),
+                'modelStatus' : self.model_status(now),
+                'amp' : self.amp,
+                'acu' : self.acu,
+                'nrg' : self.nrg(),
+                'frc' : self.frc,
+                'eto' : int(self.energy_total),
+                'wh' : round(self.energy_connected, 2),
+                'psm' : self.psm,
+                'cus' : 3 if self.connected else 1,
+            }
+        if codes is None:
+            result = dict(other_status)
+            result.update(status)
+            return result
+        return {code : status.get(code, other_status.get(code)) for code in codes
+                if code in status or code in other_status}
+
+    # {code : value} -> {code : True or error message}
+    def set(self, values):
+        now = self.now()
+        self.update(now)
+        results = {}
+        with self.lock:
+            for code, value in values.items():
+                if code not in writable_keys:
+                    results[code] = "key not found" if code not in other_status else "key not writable"
+                    continue
+                [minimum, maximum] = writable_keys[code]
+                if not isinstance(value, int) or isinstance(value, bool) or value < minimum or value > maximum:
+                    results[code] = "value out of range"
+                    continue
+                self.writes.append([time.time(), code, value])
+                self.stats['keys_set'] += 1
+                results[code] = True
+
+                if code == 'amp':
+                    self.amp = value
+                    if self.charging_since is not None:
+                        self.pending_amp = value
+                        self.pending_time = now + self.set_delay
+                elif code == 'frc':
+                    self.frc = value
+                elif code == 'psm':
+                    if value != self.psm and self.charging_since is not None:
+                        # Charging stops for the phase switch, the car starts again afterwards
+                        self.phase_switch_until = now + self.phase_switch_pause
+                    self.psm = value
+        return results
+
+    def connect_car(self, connected=True):
+        self.update()
+        with self.lock:
+            self.connected = connected
+            if connected:
+                self.energy_connected = 0.0
+
+    def fault(self):
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            self.stats['faults'] += 1
+            return self.random.choice(self.fault_modes)
+        return None
+
+    def delay(self):
+        latency = self.latency
+        if isinstance(latency, (list, tuple)):
+            latency = self.random.uniform(latency[0], latency[1])
+        if latency:
+            time.sleep(latency)
+
+    # [http status, answer] for a request path
+    def process(self, path):
+        self.stats['requests'] += 1
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        if url.path == '/api/status':
+            self.stats['status_requests'] += 1
+            if 'filter' in query:
+                return [200, self.status(query['filter'][0].split(','))]
+            self.stats['full_status_requests'] += 1
+            return [200, self.status()]
+        elif url.path == '/api/set':
+            self.stats['set_requests'] += 1
+            values = {}
+            for code, [text] in query.items():
+                try:
+                    values[code] = json.loads(text)
+                except ValueError:
+                    values[code] = text
+            return [200, self.set(values)]
+        return [404, {'error' : "not found"}]
+
+    def start(self):
+        simulator = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # Keep-alive like the wallbox
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                simulator.stats['connections'] += 1
+
+            def do_GET(self):
+                simulator.delay()
+                fault = simulator.fault()
+                if fault == 'timeout':
+                    time.sleep(30)
+                    return
+                elif fault == 'disconnect':
+                    self.close_connection = True
+                    return
+                elif fault == 'error':
+                    [code, answer] = [500, {'error' : "internal error"}]
+                else:
+                    [code, answer] = simulator.process(self.path)
+
+                body = json.dumps(answer).encode()
+                simulator.stats['bytes_sent'] += len(body)
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        class Server(http.server.ThreadingHTTPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server((self.host, self.port), Handler)
+        # port=0 picks a free port
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        logging.info("Simulating go-e charger on {0}:{1}".format(self.host, self.port))
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+# Requests and bytes per control cycle (as in evcontrol.do_switching) and the
+# time from setChargingP until the new current is in effect
+def benchmark(simulator, cycles=10, powers=(2000, 3000, 4500, 2500, 6000, 1500)):
+    from go_e_charger.go_e_charger_httpv2 import GoeCharger
+
+    charger = GoeCharger("{0}:{1}".format(simulator.host, simulator.port),
+                         settle_interval=0.5 / simulator.speed, settle_timeout=120.0 / simulator.speed,
+                         status_ttl=1.0 / simulator.speed)
+    charger.ForceOn = 1
+
+    cycle_times = []
+    settle_times = []
+    settle_results = []
+    control_requests = 0
+    requests_before = simulator.stats['requests']
+    bytes_before = simulator.stats['bytes_sent']
+    for i in range(cycles):
+        charger.invalidate()
+        start = time.monotonic()
+        cycle_requests = charger.stats['requests']
+        charger.P_All
+        settle = None
+        if charger.CableLocked():
+            settle = charger.setChargingP(powers[i % len(powers)])
+        charger.ForceOn = 1
+        cycle_times.append(time.monotonic() - start)
+        control_requests += charger.stats['requests'] - cycle_requests
+
+        settle_results.append(settle.result() if settle else None)
+        settle_times.append((time.monotonic() - start) * simulator.speed)
+
+    stats = charger.connection_stats()
+    charger.close()
+    return {
+        'control_requests_per_cycle' : control_requests / cycles,
+        'requests_per_cycle' : (simulator.stats['requests'] - requests_before) / cycles,
+        'bytes_per_cycle' : (simulator.stats['bytes_sent'] - bytes_before) / cycles,
+        'cycle_seconds' : sum(cycle_times) / cycles,
+        'settle_seconds' : sum(settle_times) / cycles,
+        'settle_max_seconds' : max(settle_times),
+        'settled' : settle_results.count(True),
+        'new_connections' : stats['new_connections'],
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(format='go_e_simulator: %(message)s', level=logging.INFO)
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-p", "--port", help="http port",
+                           default=8080, type=int, action='store')
+    argparser.add_argument("--phases", help="Phases the car charges with",
+                           default=2, type=int, action='store')
+    argparser.add_argument("-l", "--latency", help="Latency per request in seconds",
+                           default=0.0, type=float, action='store')
+    argparser.add_argument("-f", "--fault-rate", help="Probability of a fault per request",
+                           default=0.0, type=float, action='store')
+    argparser.add_argument("--fault-modes", help="error,timeout,disconnect",
+                           default='error', action='store')
+    argparser.add_argument("-s", "--speed", help="Simulated seconds per second",
+                           default=1.0, type=float, action='store')
+    argparser.add_argument("--bench", help="Run a benchmark with N control cycles and exit",
+                           type=int, action='store')
+    args = argparser.parse_args()
+
+    simulator = GoeSimulator(port=args.port, car_phases=args.phases, latency=args.latency,
+                             fault_rate=args.fault_rate, fault_modes=args.fault_modes.split(','),
+                             speed=args.speed)
+    simulator.start()
+
+    if args.bench:
+        logging.info(benchmark(simulator, args.bench))
+        logging.info(simulator.stats)
+        simulator.stop()
+    else:
+        try:
+            while True:
+                time.sleep(60)
+                logging.info(simulator.stats)
+        except KeyboardInterrupt:
+            simulator.stop()
@@ -4,8 +4,15 @@
 # V1 Baseline
 # V2 fix consideration of min/max charging values
 # V3 use logging library 
+# V4 setChargingP doesn't block, log when the new charging current is in effect
+# V5 batched influxdb writes, the control loop doesn't wait for the DB
+# V6 last values from the DB with last() queries, settings fetched with one query
+# V7 query cache, the hourly price is fetched once per hour
+# V8 write the queued points on exit (also on SIGTERM)
+# V9 current price with first() again, the same value as the range query before V6
  
 from influxdb_cli2.influxdb_cli2 import influxdb_cli2
+from influxdb_cli2.query_cache import query_cache
 from go_e_charger.go_e_charger_httpv2 import GoeCharger
 from pv_fronius.fronius_symo import Symo
 
@@ -16,31 +23,37 @@ import paho.mqtt.client as paho
 import time
 import datetime
 import sys
+import signal
 import logging
 import statistics
 
 logging.basicConfig(format='go_e_charger_control: %(message)s', level=logging.INFO)
 
 go_e_charger = GoeCharger(ipaddr=go_e_charger_ip)
-influxdb2 = influxdb_cli2(influxdb_url, influxdb_token, influxdb_org, influxdb_bucket)
+influxdb2 = influxdb_cli2(influxdb_url, influxdb_token, influxdb_org, influxdb_bucket, batch_size=100, flush_interval=1.0,
+                          query_cache=query_cache())
 influxdb_table = go_e_table   
 
-gen24 = Symo(ipaddr=symo_ip[0])
+gen24 = Symo(ipaddr=symo_ip[0], persistent=True)
 
 if gen24 is None:
     logging.warning("Gen24 don't like to talk to us")
     sys.exit(1)
 
+# Oldest price of the last hour, as the range query before, but reduced by InfluxDB
 def get_current_price():
-    results = influxdb2.query_data('grid_tibber', 'price_total', datetime.datetime.utcnow()+datetime.timedelta(hours=-1), datetime.datetime.utcnow())
-    if results:
-        return results[0][3]
+    return influxdb2.query_first('grid_tibber', 'price_total', datetime.timedelta(hours=1))
+
+# Settings restored from the DB at startup
+db_setting_names = ['mode', 'house_battery_soc_min', 'charge_below_price', 'max_charge_power', 'min_charge_power']
 
 class evcontrol:
     def __init__(self, go_e_charger, gen24, influxdb):
         self.go_e_charger = go_e_charger
         self.gen24 = gen24
         self.influxdb = influxdb
+
+        self.db_settings = influxdb.query_last_series('ev_golf', db_setting_names, datetime.timedelta(hours=8))
         
         self.power_available = [ 3*230.0 ]
         self.power_available_len = 4   #len(self.power_available)
@@ -75,11 +88,9 @@ class evcontrol:
         self.update_values_after()
 
     def get_setting_from_db(self, name):
-        results = influxdb2.query_data('ev_golf', name, datetime.datetime.utcnow()+datetime.timedelta(hours=-8), datetime.datetime.utcnow())
-        if results:
-            return results[-1][3]
-        else:
-            return None
+        if name in db_setting_names:
+            return self.db_settings.get(name)
+        return influxdb2.query_last('ev_golf', name, datetime.timedelta(hours=8))
 
     def load_setup_from_db(self, name, target):
         value = self.get_setting_from_db(name)
@@ -277,11 +288,12 @@ class evcontrol:
     
     def update_values_before(self):
 
-        self.power_to_grid = self.gen24.read_data("Meter_Power_Total") * -1.0
-        self.power_consumption = self.gen24.read_calculated_value("Consumption_Sum") 
-        self.power_generated = self.gen24.read_calculated_value("PV_Power")
+        snapshot = self.gen24.snapshot(["Meter_Power_Total", "Consumption_Sum", "PV_Power", "Battery_SoC"])
+        self.power_to_grid = snapshot["Meter_Power_Total"] * -1.0
+        self.power_consumption = snapshot["Consumption_Sum"]
+        self.power_generated = snapshot["PV_Power"]
         self.power_to_ev = self.go_e_charger.P_All
-        self.house_battery_soc = self.gen24.read_data("Battery_SoC")
+        self.house_battery_soc = snapshot["Battery_SoC"]
         
         logging.info("pwr_gen: {0}, pwr_grid: {1}, pwr_consum: {2}, pwr_ev: {3}".format(self.power_generated, self.power_to_grid, self.power_consumption, self.power_to_ev))
 
@@ -321,6 +333,13 @@ class evcontrol:
                 return
             time.sleep(1)
 
+    # Called from the settle thread of the charger
+    def charging_settled(self, settle):
+        if settle.result() is True:
+            logging.info("Charging current in effect after {0:.1f}s".format(self.go_e_charger.settle_time))
+        elif settle.result() is False:
+            logging.warning("Charging current not in effect after {0}s".format(self.go_e_charger.settle_timeout))
+
     def do_switching(self, p_needed, force=False):
         
         while len(self.power_available) > self.power_available_len:
@@ -337,7 +356,7 @@ class evcontrol:
             logging.info("Switch on")
             value = statistics.fmean(self.power_available)
             if self.go_e_charger.CableLocked() == True:
-                self.go_e_charger.setChargingP(value)
+                self.go_e_charger.setChargingP(value, on_settled=self.charging_settled)
             self.write_value_to_db('ev_switch_state', 1 )
             
             self.go_e_charger.ForceOn = 1
@@ -405,9 +424,19 @@ mqtt.loop_start()
 
 
 
-while True:
-    
-    golfonso.opmode()
+# SIGTERM (systemd stop) ends like Ctrl-C, so the queued points are written
+def terminate(signum, frame):
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, terminate)
+
+try:
+    while True:
+
+        golfonso.opmode()
 
-    time.sleep(5)
+        time.sleep(5)
+finally:
+    mqtt.loop_stop()
+    influxdb2.close()
 
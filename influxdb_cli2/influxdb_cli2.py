@@ -2,52 +2,211 @@
 # V1 Something to start with...
 # V2 Handle force parameter better
 # V3 Remove timezone information and convert to UTC... 
+# V4 Optional write_filter (deadband/heartbeat/swinging door), keeps real zeros
+# V5 Optional batched writes from a background thread (batch_size), flush()/close()
+# V6 Points are formatted as line protocol directly, write_fields() for several fields in one line
+# V7 Optional disk spool (spool_dir), points survive InfluxDB outages and restarts
+# V8 query_last()/query_first()/query_window()/query_last_series(), reduced on the server
+# V9 Optional query_cache for the query_* lookups, updated by own writes
 #
 
 import influxdb_client
 from influxdb_client.client.write_api import SYNCHRONOUS, ASYNCHRONOUS
 
+import math
+import time
 from datetime import datetime, timedelta, timezone
 
+from influxdb_cli2.write_batcher import write_batcher
+from influxdb_cli2.write_spool import write_spool
+
+epoch = datetime(1970, 1, 1)
+
+# Line protocol escaping, as the influxdb_client Point does
+escape_measurement_table = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+escape_key_table = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n', '\t': r'\t', '\r': r'\r'})
+
+def escape_measurement(name):
+    return name.translate(escape_measurement_table)
+
+def escape_key(name):
+    return name.translate(escape_key_table)
+
+def flux_string(text):
+    return '"{0}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+# Flux duration of a timedelta or seconds
+def flux_duration(lookback):
+    if isinstance(lookback, timedelta):
+        lookback = lookback.total_seconds()
+    return "{0:d}s".format(int(math.ceil(lookback)))
+
+# Nanoseconds since epoch of a datetime, naive = UTC
+def timestamp_ns(timestamp):
+    if timestamp.tzinfo != None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    delta = timestamp - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000000 + delta.microseconds * 1000
+
 class influxdb_cli2:
-    def __init__(self, influxdb_url, token, org, bucket, debug = False):
+    # batch_size: None = every point is written at once, otherwise points are queued
+    # and written in batches, see write_batcher.py for the other batch parameters
+    # spool_dir: points go to a disk spool first and are replayed from there in
+    # batches (batch_size, default 5000), see write_spool.py. Replaces the queue.
+    def __init__(self, influxdb_url, token, org, bucket, debug = False, write_filter = None,
+                 batch_size = None, flush_interval = 1.0, queue_size = 10000,
+                 backpressure = 'drop_oldest', error_callback = None,
+                 spool_dir = None, spool_max_size = 100000000, spool_max_rate = None,
+                 query_cache = None):
         self.influxdb_client = influxdb_client.InfluxDBClient(url=influxdb_url, token=token, org=org)
         self.bucket=bucket
         self.org = org
         self.debug = debug
+        self.write_filter = write_filter
+        self.query_cache = query_cache
+
+        self.write_api = self.influxdb_client.write_api(write_options=SYNCHRONOUS)
 
-        self.write_api = self.influxdb_client.write_api(write_option=SYNCHRONOUS)
+        # (location, measurement) : 'measurement,location=location '
+        self.prefixes = {}
+        # Filter series of write_fields(), (location, measurement/field) : [measurement, field]
+        self.filter_fields = {}
+
+        self.batcher = None
+        self.spool = None
+        if spool_dir:
+            self.spool = write_spool(spool_dir, self.write_records, batch_size or 5000, flush_interval,
+                                     max_size=spool_max_size, max_rate=spool_max_rate, debug=debug)
+        elif batch_size:
+            self.batcher = write_batcher(self.write_records, batch_size, flush_interval, queue_size,
+                                         backpressure, error_callback, debug)
 
     def write_sensordata(self, location, measurement, value, timestamp = None, force = None):
         if value == None:
             return
         if timestamp == None:
-            timestamp = datetime.utcnow()
+            if self.write_filter == None:
+                timestamp = time.time_ns()
+            else:
+                timestamp = datetime.utcnow()
 
         if self.debug:
             print("Got sample: location: {0}, measurement: {1}, value {2}, timestamp {3}".format(location,measurement,value, timestamp))
 
+        if self.write_filter != None:
+            # False = failed read, real zeros are handled by the filter like any other value
+            if value is False and not force:
+                return
+            points = self.write_filter.process(location, measurement, value, timestamp, force == True)
+            for [point_value, point_timestamp] in points:
+                self.write_point(location, measurement, point_value, point_timestamp)
+            return
+
         if force == None or force == False:
             if float(value) == 0.0:
                 if self.debug:
                     print("discarding value, since zero")
                 return
 
-        write_data = [
-            {
-                'measurement': measurement,
-                'tags': {
-                    'location': location
-                },
-                'fields': {
-                    'value': float(value)
-                },
-                'time' : timestamp.isoformat()
-            }
-        ]
+        self.write_point(location, measurement, value, timestamp)
+
+    # Several values of one timestamp (e.g. a snapshot) as fields of one line.
+    # The same rules as for write_sensordata apply to every field.
+    def write_fields(self, location, measurement, fields, timestamp = None, force = None):
+        if timestamp == None:
+            if self.write_filter == None:
+                timestamp = time.time_ns()
+            else:
+                timestamp = datetime.utcnow()
+
+        if self.write_filter == None:
+            values = {}
+            for field, value in fields.items():
+                if value == None or value is False:
+                    continue
+                if (force == None or force == False) and float(value) == 0.0:
+                    continue
+                values[field] = value
+            if values:
+                self.write_line(location, measurement, values, timestamp)
+            return
+
+        # Held back points of the filter have their own timestamp, one line per timestamp
+        lines = {}
+        for field, value in fields.items():
+            if value == None or (value is False and not force):
+                continue
+            key = "{0}/{1}".format(measurement, field)
+            self.filter_fields[(location, key)] = [measurement, field]
+            for [point_value, point_timestamp] in self.write_filter.process(location, key, value, timestamp, force == True):
+                lines.setdefault(point_timestamp, {})[field] = point_value
+        for point_timestamp in sorted(lines):
+            self.write_line(location, measurement, lines[point_timestamp], point_timestamp)
+
+    def write_point(self, location, measurement, value, timestamp):
+        self.write_line(location, measurement, {'value' : value}, timestamp)
+
+    # timestamp: datetime or nanoseconds
+    def write_line(self, location, measurement, fields, timestamp):
+        prefix = self.prefixes.get((location, measurement))
+        if prefix == None:
+            prefix = "{0},location={1} ".format(escape_measurement(measurement), escape_key(location))
+            self.prefixes[(location, measurement)] = prefix
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp_ns(timestamp)
+
+        values = []
+        for field, value in fields.items():
+            value = float(value)
+            if math.isfinite(value):
+                values.append("{0}={1!r}".format(field if field == 'value' else escape_key(field), value))
+        if not values:
+            return
+        line = "{0}{1} {2:d}".format(prefix, ",".join(values), timestamp)
+
+        if self.query_cache != None:
+            self.query_cache.written(location, measurement, fields, timestamp)
+
         if self.debug:
-            print("write to influxdb: {0}".format(write_data))
-        self.write_api.write(self.bucket, self.org , write_data)
+            print("write to influxdb: {0}".format(line))
+        if self.spool != None:
+            self.spool.put(line)
+        elif self.batcher != None:
+            self.batcher.put(line)
+        else:
+            self.write_records([line])
+
+    def write_records(self, records):
+        self.write_api.write(self.bucket, self.org , records)
+
+    # Write the points held back by the write_filter and the queued points
+    def flush(self, timeout = None):
+        if self.write_filter != None:
+            for [location, measurement, value, timestamp] in self.write_filter.flush():
+                if (location, measurement) in self.filter_fields:
+                    [measurement, field] = self.filter_fields[(location, measurement)]
+                    self.write_line(location, measurement, {field : value}, timestamp)
+                else:
+                    self.write_point(location, measurement, value, timestamp)
+        if self.spool != None:
+            return self.spool.flush(timeout)
+        if self.batcher != None:
+            return self.batcher.flush(timeout)
+        return True
+
+    # With a spool, what isn't written within timeout stays in the spool
+    def close(self, timeout = None):
+        if self.spool != None:
+            if timeout == None:
+                timeout = 10.0
+            self.flush(timeout)
+            self.spool.close(timeout)
+        else:
+            self.flush(timeout)
+        if self.batcher != None:
+            self.batcher.close(timeout)
+        self.write_api.close()
+        self.influxdb_client.close()
 
 
     # working query
@@ -73,3 +232,93 @@ class influxdb_cli2:
             print("Result: {0}".format(result))
         return result
 
+    # Flux query of measurements of location within the last lookback, reduced by reduce (e.g. '|> last()')
+    def query_reduced(self, location, measurements, lookback, reduce, field = None):
+        query = 'from(bucket: {0})\
+        |> range(start: -{1})\
+        |> filter(fn:(r) => {2})\
+        |> filter(fn:(r) => r.location == {3})'.format(
+            flux_string(self.bucket), flux_duration(lookback),
+            " or ".join(["r._measurement == {0}".format(flux_string(measurement)) for measurement in measurements]),
+            flux_string(location))
+        if field != None:
+            query += '\
+        |> filter(fn:(r) => r._field == {0})'.format(flux_string(field))
+        query += '\
+        ' + reduce
+        if self.debug:
+            print("Query: {0}".format(query))
+        tables = self.influxdb_client.query_api().query(query=query)
+        records = [record for table in tables for record in table.records]
+        if self.debug:
+            print("Result: {0}".format([[record.get_time(), record.get_measurement(), record.get_value()] for record in records]))
+        return records
+
+    # [True, value] of the query_cache, [False, None] without
+    def cached(self, key):
+        if self.query_cache == None:
+            return [False, None]
+        return self.query_cache.get(key)
+
+    def cache(self, key, value, times = None):
+        if self.query_cache != None:
+            self.query_cache.put(key, value, times)
+
+    # Newest value of a measurement within lookback (timedelta or seconds), None if there is none
+    def query_last(self, location, measurement, lookback, field = None):
+        key = ('last', location, (measurement,), flux_duration(lookback), field)
+        [found, value] = self.cached(key)
+        if found:
+            return value
+        records = self.query_reduced(location, [measurement], lookback, '|> last()', field)
+        if not records:
+            value = None
+            times = None
+        else:
+            record = max(records, key=lambda record: record.get_time())
+            value = record.get_value()
+            times = {measurement : timestamp_ns(record.get_time())}
+        self.cache(key, value, times)
+        return value
+
+    # Oldest value within lookback
+    def query_first(self, location, measurement, lookback, field = None):
+        key = ('first', location, (measurement,), flux_duration(lookback), field)
+        [found, value] = self.cached(key)
+        if found:
+            return value
+        records = self.query_reduced(location, [measurement], lookback, '|> first()', field)
+        value = None
+        if records:
+            value = min(records, key=lambda record: record.get_time()).get_value()
+        self.cache(key, value)
+        return value
+
+    # [[time, value], ...] aggregated per window of every (timedelta or seconds), fn: mean, max, min, last...
+    def query_window(self, location, measurement, lookback, every, fn = 'mean', field = None):
+        key = ('window', location, (measurement,), flux_duration(lookback), field, flux_duration(every), fn)
+        [found, value] = self.cached(key)
+        if found:
+            return list(value)
+        records = self.query_reduced(location, [measurement], lookback,
+                                     '|> aggregateWindow(every: {0}, fn: {1}, createEmpty: false)'.format(flux_duration(every), fn), field)
+        value = sorted([[record.get_time(), record.get_value()] for record in records], key=lambda point: point[0])
+        self.cache(key, value)
+        return list(value)
+
+    # {measurement : newest value} of several measurements with one query,
+    # measurements without a value within lookback are missing
+    def query_last_series(self, location, measurements, lookback, field = None):
+        key = ('last_series', location, tuple(measurements), flux_duration(lookback), field)
+        [found, value] = self.cached(key)
+        if found:
+            return dict(value)
+        results = {}
+        times = {}
+        for record in self.query_reduced(location, measurements, lookback, '|> last()', field):
+            measurement = record.get_measurement()
+            if measurement not in times or record.get_time() > times[measurement]:
+                times[measurement] = record.get_time()
+                results[measurement] = record.get_value()
+        self.cache(key, results, {measurement : timestamp_ns(time) for measurement, time in times.items()})
+        return dict(results)
@@ -0,0 +1,130 @@
+#
+# V1 TTL/LRU cache for the query_last()/query_window() lookups of influxdb_cli2
+#
+# Control loops ask for the same values again and again (current price,
+# settings), most of them change seldom. Results are kept per location,
+# measurements and query shape (kind, lookback, field, window) for a TTL
+# which follows the cadence of the data:
+# - a number: seconds
+# - {'align' : seconds, 'offset' : seconds}: until the next multiple of align
+#   (UTC) plus offset, e.g. the hourly price until shortly after the top of
+#   the next hour
+# Writes of this process go through the cache: newest values (query_last,
+# query_last_series) are updated, other results of the series are dropped.
+# At most max_entries results are kept, the least recently used goes first.
+#
+
+import time
+from collections import OrderedDict
+
+# Format:
+# [part of the measurement name, ttl], first match wins, otherwise default_ttl
+default_ttls = [
+    ["price", {'align' : 3600, 'offset' : 60}],
+]
+default_ttl = 300.0
+
+class query_cache:
+    def __init__(self, ttls=default_ttls, default=default_ttl, max_entries=256, clock=time.time):
+        self.ttls = ttls
+        self.default = default
+        self.max_entries = max_entries
+        self.clock = clock
+
+        # key : [value, expires, {measurement : time of the newest value in ns}]
+        self.entries = OrderedDict()
+        # (location, measurement) : set of keys
+        self.series = {}
+
+        self.stats = {
+            'hits' : 0,
+            'misses' : 0,
+            'expired' : 0,
+            'evicted' : 0,
+            'invalidated' : 0,
+            'updated' : 0,
+        }
+
+    def ttl(self, measurement):
+        for [part, ttl] in self.ttls:
+            if part in measurement:
+                return ttl
+        return self.default
+
+    # Expiry time of a result of measurements, the earliest of all
+    def expires(self, measurements, now):
+        expires = None
+        for measurement in measurements:
+            ttl = self.ttl(measurement)
+            if isinstance(ttl, dict):
+                align = ttl['align']
+                offset = ttl.get('offset', 0)
+                until = (now - offset) // align * align + align + offset
+            else:
+                until = now + ttl
+            if expires == None or until < expires:
+                expires = until
+        return expires
+
+    # key: (kind, location, (measurements, ...), shape...), [True, value] or [False, None]
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry == None:
+            self.stats['misses'] += 1
+            return [False, None]
+        if self.clock() >= entry[1]:
+            self.stats['expired'] += 1
+            self.stats['misses'] += 1
+            self.remove(key)
+            return [False, None]
+        self.entries.move_to_end(key)
+        self.stats['hits'] += 1
+        return [True, entry[0]]
+
+    def put(self, key, value, times=None):
+        [kind, location, measurements] = key[0:3]
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = [value, self.expires(measurements, self.clock()), dict(times or {})]
+        for measurement in measurements:
+            self.series.setdefault((location, measurement), set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self.remove(next(iter(self.entries)))
+            self.stats['evicted'] += 1
+
+    def remove(self, key):
+        del self.entries[key]
+        [kind, location, measurements] = key[0:3]
+        for measurement in measurements:
+            keys = self.series.get((location, measurement))
+            if keys != None:
+                keys.discard(key)
+                if not keys:
+                    del self.series[(location, measurement)]
+
+    # This process wrote fields of a series at timestamp (ns)
+    def written(self, location, measurement, fields, timestamp):
+        for key in list(self.series.get((location, measurement), [])):
+            [kind, field] = [key[0], key[4]]
+            entry = self.entries[key]
+            if kind == 'last' or kind == 'last_series':
+                value = fields.get('value' if field == None else field)
+                if value == None:
+                    self.remove(key)
+                    self.stats['invalidated'] += 1
+                elif timestamp >= entry[2].get(measurement, 0):
+                    if kind == 'last':
+                        entry[0] = float(value)
+                    else:
+                        values = dict(entry[0])
+                        values[measurement] = float(value)
+                        entry[0] = values
+                    entry[2][measurement] = timestamp
+                    self.stats['updated'] += 1
+            else:
+                self.remove(key)
+                self.stats['invalidated'] += 1
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.series = {}
@@ -0,0 +1,156 @@
+#
+# V1 Batched background writes
+# V2 A failing error_callback doesn't stop the writer thread
+# V3 Wake the writer thread on the first queued point, fixes partial batches waiting for batch_size
+#
+# write_sensordata() only queues the point, a background thread writes the
+# queue with one request per batch_size points, at the latest flush_interval
+# seconds after the first queued point. The queue holds at most queue_size
+# points, if it is full (InfluxDB slow or away) the backpressure policy
+# decides:
+# - 'block': wait until there is space again (the caller slows down)
+# - 'drop_oldest': forget the oldest queued point
+# - 'drop_newest': forget the new point
+# Failed batches are passed to error_callback(points, exception), without a
+# callback they are logged and lost.
+#
+
+import time
+import logging
+import threading
+from collections import deque
+
+backpressure_policies = ['block', 'drop_oldest', 'drop_newest']
+
+class write_batcher:
+    # write: function(list of points), raises on errors
+    def __init__(self, write, batch_size=1000, flush_interval=1.0, queue_size=10000,
+                 backpressure='drop_oldest', error_callback=None, debug=False):
+        if backpressure not in backpressure_policies:
+            raise ValueError("Unknown backpressure policy {0}, use one of {1}".format(backpressure, backpressure_policies))
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = max(queue_size, batch_size)
+        self.backpressure = backpressure
+        self.error_callback = error_callback
+        self.debug = debug
+
+        self.queue = deque()
+        self.condition = threading.Condition()
+        # Time the oldest queued point arrived
+        self.first_time = None
+        self.in_flight = 0
+        self.flush_requested = False
+        self.closed = False
+
+        self.stats = {
+            'queued' : 0,
+            'written' : 0,
+            'batches' : 0,
+            'dropped' : 0,
+            'failed' : 0,
+            'blocked' : 0,
+        }
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Queue a point, False if it was dropped
+    def put(self, point):
+        with self.condition:
+            if self.closed:
+                self.stats['dropped'] += 1
+                return False
+            if len(self.queue) >= self.queue_size:
+                if self.backpressure == 'block':
+                    self.stats['blocked'] += 1
+                    while len(self.queue) >= self.queue_size and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        self.stats['dropped'] += 1
+                        return False
+                elif self.backpressure == 'drop_oldest':
+                    self.queue.popleft()
+                    self.stats['dropped'] += 1
+                else:
+                    self.stats['dropped'] += 1
+                    return False
+            first = not self.queue
+            if first:
+                self.first_time = time.monotonic()
+            self.queue.append(point)
+            self.stats['queued'] += 1
+            # The first point starts the flush_interval of the idle writer thread
+            if first or len(self.queue) >= self.batch_size:
+                self.condition.notify_all()
+        return True
+
+    def batch_due(self):
+        if not self.queue:
+            return False
+        if self.flush_requested or self.closed or len(self.queue) >= self.batch_size:
+            return True
+        return time.monotonic() - self.first_time >= self.flush_interval
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.batch_due():
+                    if self.closed and not self.queue:
+                        return
+                    if not self.queue:
+                        self.flush_requested = False
+                        self.condition.notify_all()
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(max(self.first_time + self.flush_interval - time.monotonic(), 0.0))
+                batch = [self.queue.popleft() for i in range(min(self.batch_size, len(self.queue)))]
+                self.in_flight = len(batch)
+                self.first_time = time.monotonic() if self.queue else None
+                # Space for blocked callers
+                self.condition.notify_all()
+
+            self.write_batch(batch)
+
+            with self.condition:
+                self.in_flight = 0
+                self.condition.notify_all()
+
+    def write_batch(self, batch):
+        try:
+            self.write(batch)
+            self.stats['written'] += len(batch)
+            self.stats['batches'] += 1
+            if self.debug:
+                print("wrote batch of {0} points".format(len(batch)))
+        except Exception as e:
+            self.stats['failed'] += len(batch)
+            if self.error_callback:
+                try:
+                    self.error_callback(batch, e)
+                except Exception as callback_error:
+                    # The writer thread has to survive, later batches would pile up
+                    logging.error("write_batcher: error_callback failed for {0} points ({1}): {2}".format(len(batch), e, callback_error))
+            else:
+                logging.error("write_batcher: writing {0} points failed: {1}".format(len(batch), e))
+
+    # Write everything queued so far, True if done within timeout
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.queue or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
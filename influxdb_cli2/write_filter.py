@@ -0,0 +1,162 @@
+#
+# V1 Deadband, heartbeat and swinging door compression per series
+#
+# Only points which carry information are passed on to InfluxDB:
+# - deadband: a value is sent if it differs more than deadband (absolute) or
+#   deadband_rel * |last sent value| from the last sent value
+# - heartbeat: a value is sent at least every heartbeat seconds
+# - swinging_door: instead of the deadband, a point is only sent if the
+#   series can't be reconstructed within +-swinging_door by a straight line
+#   between the sent points
+# With a deadband the last suppressed point is sent before a change, so a
+# flat series followed by a step doesn't show up as a ramp.
+#
+# Reference for the swinging door algorithm:
+# https://en.wikipedia.org/wiki/Swinging_door_trending (E. H. Bristol, 1990)
+
+# Format:
+# [part of the measurement name, config], first match wins, otherwise default_config
+default_config = {
+    'deadband' : 0.0,
+    'deadband_rel' : 0.0,
+    'heartbeat' : 600.0,
+    'swinging_door' : None,
+}
+
+class series_state:
+    def __init__(self, config):
+        self.config = config
+        # Last sent point
+        self.sent_value = None
+        self.sent_time = None
+        # Last received, not sent point
+        self.held_value = None
+        self.held_time = None
+        # Swinging door, range of slopes of a line from the sent point
+        # which stays within +-swinging_door of every held back point
+        self.slope_min = None
+        self.slope_max = None
+
+
+class write_filter:
+    def __init__(self, configs=[], default=default_config, debug=False):
+        self.configs = configs
+        self.default = default
+        self.debug = debug
+        # (location, measurement) : series_state
+        self.series = {}
+        self.stats = {
+            'received' : 0,
+            'written' : 0,
+        }
+
+    def config(self, measurement):
+        for [part, config] in self.configs:
+            if part in measurement:
+                result = dict(self.default)
+                result.update(config)
+                return result
+        return self.default
+
+    # Points [[value, timestamp], ...] to write for a new sample
+    def process(self, location, measurement, value, timestamp, force=False):
+        self.stats['received'] += 1
+        key = (location, measurement)
+        state = self.series.get(key)
+        if state is None:
+            state = series_state(self.config(measurement))
+            self.series[key] = state
+
+        value = float(value)
+        if force or state.sent_time is None:
+            points = [[value, timestamp]]
+        elif state.config['swinging_door'] is not None:
+            points = self.swinging_door(state, value, timestamp)
+        else:
+            points = self.deadband(state, value, timestamp)
+
+        if points:
+            [state.sent_value, state.sent_time] = points[-1]
+            if points[-1][1] == timestamp:
+                state.held_value = None
+                state.held_time = None
+                state.slope_min = None
+                state.slope_max = None
+        self.stats['written'] += len(points)
+        if self.debug and not points:
+            print("filtered: location: {0}, measurement: {1}, value {2}".format(location, measurement, value))
+        return points
+
+    def heartbeat_due(self, state, timestamp):
+        heartbeat = state.config['heartbeat']
+        return heartbeat is not None and (timestamp - state.sent_time).total_seconds() >= heartbeat
+
+    def deadband(self, state, value, timestamp):
+        config = state.config
+        band = max(config['deadband'], config['deadband_rel'] * abs(state.sent_value))
+        changed = abs(value - state.sent_value) > band or (band == 0.0 and value != state.sent_value)
+
+        if changed or self.heartbeat_due(state, timestamp):
+            points = []
+            if changed and state.held_time is not None:
+                points.append([state.held_value, state.held_time])
+            points.append([value, timestamp])
+            return points
+
+        state.held_value = value
+        state.held_time = timestamp
+        return []
+
+    def swinging_door(self, state, value, timestamp):
+        deviation = state.config['swinging_door']
+
+        if self.heartbeat_due(state, timestamp):
+            points = []
+            if state.held_time is not None:
+                points.append([state.held_value, state.held_time])
+            points.append([value, timestamp])
+            return points
+
+        dt = (timestamp - state.sent_time).total_seconds()
+        if dt <= 0:
+            return []
+        slope = (value - state.sent_value) / dt
+
+        if state.slope_min is not None and not state.slope_min <= slope <= state.slope_max:
+            # Doors closed, the line to this point would miss a held back point.
+            # Archive the previous point and restart the doors from it.
+            points = [[state.held_value, state.held_time]]
+            state.sent_value = state.held_value
+            state.sent_time = state.held_time
+            dt = (timestamp - state.sent_time).total_seconds()
+            state.slope_min = (value - state.sent_value - deviation) / dt
+            state.slope_max = (value - state.sent_value + deviation) / dt
+            state.held_value = value
+            state.held_time = timestamp
+            return points
+
+        # Doors still open, narrow them by this point
+        if state.slope_min is None:
+            state.slope_min = (value - state.sent_value - deviation) / dt
+            state.slope_max = (value - state.sent_value + deviation) / dt
+        else:
+            state.slope_min = max(state.slope_min, (value - state.sent_value - deviation) / dt)
+            state.slope_max = min(state.slope_max, (value - state.sent_value + deviation) / dt)
+        state.held_value = value
+        state.held_time = timestamp
+        return []
+
+    # Held back last points of every series, e.g. before shutdown
+    def flush(self):
+        points = []
+        for [location, measurement], state in self.series.items():
+            if state.held_time is not None:
+                points.append([location, measurement, state.held_value, state.held_time])
+                state.sent_value = state.held_value
+                state.sent_time = state.held_time
+                state.held_value = None
+                state.held_time = None
+                state.slope_min = None
+                state.slope_max = None
+        self.stats['written'] += len(points)
+        return points
@@ -0,0 +1,258 @@
+#
+# V1 Disk-backed write-ahead spool
+#
+# Line protocol lines are appended to segment files in a spool directory
+# first, a background thread replays them to InfluxDB in batches. While
+# InfluxDB is away the lines stay on disk (also over restarts), afterwards
+# the backlog is sent with at most max_rate lines per second.
+#
+# Format of a segment file (<sequence number>.spool): one line per point,
+# "<crc32 as 8 hex digits> <line protocol>\n". Lines with a wrong checksum
+# (e.g. torn by a crash) are skipped. The position of the last replayed line
+# is kept in the file "cursor". Segments are deleted when they are replayed,
+# if the spool grows beyond max_size the oldest segments are dropped.
+#
+# Replays are idempotent: every line carries its timestamp, InfluxDB keeps
+# one point per series and timestamp, so a batch which is sent again after a
+# crash before the cursor was saved only overwrites the same points.
+#
+
+import os
+import time
+import zlib
+import logging
+import threading
+
+segment_suffix = '.spool'
+
+class write_spool:
+    # write: function(list of lines), raises on errors
+    # segment_size/max_size: bytes, max_rate: lines per second while replaying, None = no limit
+    def __init__(self, directory, write, batch_size=5000, flush_interval=1.0, segment_size=1000000,
+                 max_size=100000000, max_rate=None, retry_interval=5.0, max_retry_interval=300.0,
+                 fsync=False, debug=False):
+        self.directory = directory
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_rate = max_rate
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.fsync = fsync
+        self.debug = debug
+
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.data_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.drained = threading.Condition(self.lock)
+
+        self.stats = {
+            'spooled' : 0,
+            'replayed' : 0,
+            'batches' : 0,
+            'failed_batches' : 0,
+            'corrupt' : 0,
+            'evicted_segments' : 0,
+            'evicted_bytes' : 0,
+        }
+
+        # {sequence number : size in bytes}, the last one is written
+        self.segments = {}
+        for filename in os.listdir(directory):
+            if filename.endswith(segment_suffix):
+                self.segments[int(filename[:-len(segment_suffix)])] = os.path.getsize(os.path.join(directory, filename))
+
+        # Never append to a segment of an earlier run, its last line could be torn
+        self.write_sequence = max(self.segments, default=0) + 1
+        self.segments[self.write_sequence] = 0
+        self.file = open(self.segment_path(self.write_sequence), 'a', encoding='utf-8')
+
+        [self.read_sequence, self.read_offset] = self.load_cursor()
+        # Replayed, but not deleted before the last stop
+        for sequence in [sequence for sequence in self.segments if sequence < self.read_sequence]:
+            del self.segments[sequence]
+            os.remove(self.segment_path(sequence))
+        if self.segments and self.debug:
+            print("spool: {0} segments, {1} bytes pending".format(len(self.segments), self.pending_bytes()))
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, "{0:012d}{1}".format(sequence, segment_suffix))
+
+    def cursor_path(self):
+        return os.path.join(self.directory, 'cursor')
+
+    def load_cursor(self):
+        try:
+            with open(self.cursor_path()) as f:
+                [sequence, offset] = [int(part) for part in f.read().split()]
+            if sequence in self.segments:
+                return [sequence, offset]
+        except (OSError, ValueError):
+            pass
+        return [min(self.segments), 0]
+
+    def save_cursor(self):
+        tmp = self.cursor_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write("{0} {1}\n".format(self.read_sequence, self.read_offset))
+        os.replace(tmp, self.cursor_path())
+
+    # Bytes not yet replayed
+    def pending_bytes(self):
+        return sum(size for sequence, size in self.segments.items() if sequence >= self.read_sequence) - self.read_offset
+
+    def put(self, line):
+        record = "{0:08x} {1}\n".format(zlib.crc32(line.encode('utf-8')), line)
+        with self.lock:
+            self.file.write(record)
+            self.file.flush()
+            self.segments[self.write_sequence] += len(record.encode('utf-8'))
+            self.stats['spooled'] += 1
+            if self.segments[self.write_sequence] >= self.segment_size:
+                self.rotate()
+            if sum(self.segments.values()) > self.max_size:
+                self.evict()
+        self.data_event.set()
+
+    def rotate(self):
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.file.close()
+        self.write_sequence += 1
+        self.segments[self.write_sequence] = 0
+        self.file = open(self.segment_path(self.write_sequence), 'a', encoding='utf-8')
+
+    # Drop the oldest segments until the spool fits into max_size again
+    def evict(self):
+        while sum(self.segments.values()) > self.max_size and len(self.segments) > 1:
+            sequence = min(self.segments)
+            size = self.segments.pop(sequence)
+            os.remove(self.segment_path(sequence))
+            self.stats['evicted_segments'] += 1
+            self.stats['evicted_bytes'] += size
+            logging.warning("write_spool: spool full, dropped segment {0} ({1} bytes)".format(sequence, size))
+            if sequence >= self.read_sequence:
+                self.read_sequence = min(self.segments)
+                self.read_offset = 0
+
+    # [lines, sequence, offset after the lines] from the read position
+    def read_batch(self):
+        with self.lock:
+            sequence = self.read_sequence
+            offset = self.read_offset
+            current = sequence == self.write_sequence
+        lines = []
+        with open(self.segment_path(sequence), 'rb') as f:
+            f.seek(offset)
+            while len(lines) < self.batch_size:
+                record = f.readline()
+                if not record:
+                    break
+                if not record.endswith(b'\n'):
+                    if current:
+                        # Being written, try again later
+                        break
+                    self.stats['corrupt'] += 1
+                    offset += len(record)
+                    break
+                offset += len(record)
+                [checksum, line] = [record[:8], record[9:-1]]
+                try:
+                    valid = int(checksum, 16) == zlib.crc32(line)
+                except ValueError:
+                    valid = False
+                if valid:
+                    lines.append(line.decode('utf-8'))
+                else:
+                    self.stats['corrupt'] += 1
+        return [lines, sequence, offset]
+
+    # Move the read position, delete replayed segments
+    def advance(self, sequence, offset):
+        with self.lock:
+            if sequence != self.read_sequence:
+                # Evicted meanwhile
+                return
+            self.read_offset = offset
+            while self.read_sequence != self.write_sequence and self.read_offset >= self.segments.get(self.read_sequence, 0):
+                self.segments.pop(self.read_sequence, None)
+                try:
+                    os.remove(self.segment_path(self.read_sequence))
+                except OSError:
+                    pass
+                self.read_sequence = min(self.segments)
+                self.read_offset = 0
+            self.save_cursor()
+            if self.pending_bytes() <= 0:
+                self.drained.notify_all()
+
+    def run(self):
+        retry_interval = self.retry_interval
+        while not self.stop_event.is_set():
+            try:
+                [lines, sequence, offset] = self.read_batch()
+            except FileNotFoundError:
+                # Segment evicted while reading
+                continue
+
+            if not lines:
+                with self.lock:
+                    at_end = sequence == self.write_sequence
+                if offset != self.read_offset or not at_end:
+                    # Only corrupt lines or the end of an old segment
+                    self.advance(sequence, offset)
+                    continue
+                self.data_event.wait(self.flush_interval)
+                self.data_event.clear()
+                continue
+
+            try:
+                self.write(lines)
+            except Exception as e:
+                self.stats['failed_batches'] += 1
+                logging.error("write_spool: replay of {0} lines failed, retry in {1}s: {2}".format(len(lines), retry_interval, e))
+                self.stop_event.wait(retry_interval)
+                retry_interval = min(retry_interval * 2, self.max_retry_interval)
+                continue
+            retry_interval = self.retry_interval
+
+            self.stats['replayed'] += len(lines)
+            self.stats['batches'] += 1
+            if self.debug:
+                print("spool: replayed {0} lines".format(len(lines)))
+            self.advance(sequence, offset)
+
+            if len(lines) < self.batch_size:
+                # Caught up, collect some lines for the next batch
+                self.stop_event.wait(self.flush_interval)
+            elif self.max_rate:
+                self.stop_event.wait(len(lines) / self.max_rate)
+
+    # Wait until everything is replayed, True if done within timeout
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.data_event.set()
+        with self.lock:
+            while self.pending_bytes() > 0:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.drained.wait(remaining if remaining is not None else 1.0)
+        return True
+
+    # Lines not yet replayed stay in the spool for the next start
+    def close(self, timeout=10.0):
+        self.flush(timeout)
+        self.stop_event.set()
+        self.data_event.set()
+        self.thread.join(timeout)
+        with self.lock:
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.file.close()
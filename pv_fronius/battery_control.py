@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+# V2: Rewrite rates before the InOutWRte_RvrtTm timeout of the inverter reverts them
+
+# Command layer for the storage and connection control registers of a Symo.
+# The last applied raw value of every controlled register is remembered, so
+# repeating a command causes no Modbus write at all. Changed registers with
+# adjacent addresses (Battery_OutWRte/Battery_InWRte) are committed with one
+# write_multiple_registers. The registers between Battery_StorCtl_Mod and
+# Battery_OutWRte are read only, so StorCtl_Mod and Control_conn always go
+# out as separate writes.
+# With a revert timeout (Battery_InOutWRte_RvrtTm > 0) the inverter falls back
+# to the default rates that many seconds after a write, so a requested rate
+# is written again once revert_margin of the timeout has passed, even if it
+# did not change.
+
+import time
+import logging
+
+controlled_registers = ['Battery_OutWRte', 'Battery_InWRte', 'Battery_StorCtl_Mod', 'Control_conn']
+rate_registers = ['Battery_OutWRte', 'Battery_InWRte']
+revert_register = 'Battery_InOutWRte_RvrtTm'
+
+# Part of the revert timeout after which a rate is written again
+revert_margin = 0.5
+
+# Battery_StorCtl_Mod bits
+storctl_charge_limit = 0x1
+storctl_discharge_limit = 0x2
+
+
+class BatteryControl:
+    # max_age: seconds after which the applied state is read back from the device
+    # before the next write, to notice changes by others. None = only after
+    # errors/reconnects.
+    def __init__(self, symo, max_age=300.0, verify=False):
+        self.symo = symo
+        self.max_age = max_age
+        self.verify_writes = verify
+
+        # name : raw register value as applied on the device
+        self.applied = {}
+        self.applied_time = None
+        # Seconds, 0 = rates don't revert, None = unknown
+        self.revert_timeout = None
+        # name : time the rate was written by us
+        self.rates_time = {}
+
+        # Requested, not yet committed changes
+        self.requested = {}
+        self.storctl_set = 0
+        self.storctl_clear = 0
+
+        self.stats = {
+            'commits' : 0,
+            'skipped' : 0,
+            'writes' : 0,
+            'registers_written' : 0,
+            'failed_writes' : 0,
+            'refreshes' : 0,
+            'verify_failures' : 0,
+            'revert_rewrites' : 0,
+        }
+
+    def invalidate(self):
+        self.applied = {}
+        self.applied_time = None
+        self.revert_timeout = None
+        self.rates_time = {}
+
+    # None = no limit
+    def set_charge_rate(self, power):
+        if power is None:
+            self.storctl_clear |= storctl_charge_limit
+            self.storctl_set &= ~storctl_charge_limit
+            self.requested.pop('Battery_InWRte', None)
+        else:
+            self.storctl_set |= storctl_charge_limit
+            self.storctl_clear &= ~storctl_charge_limit
+            self.requested['Battery_InWRte'] = power
+
+    def set_discharge_rate(self, power):
+        if power is None:
+            self.storctl_clear |= storctl_discharge_limit
+            self.storctl_set &= ~storctl_discharge_limit
+            self.requested.pop('Battery_OutWRte', None)
+        else:
+            self.storctl_set |= storctl_discharge_limit
+            self.storctl_clear &= ~storctl_discharge_limit
+            self.requested['Battery_OutWRte'] = power
+
+    def set_connected(self, enable):
+        self.requested['Control_conn'] = 1 if enable else 0
+
+    def available_registers(self):
+        return [name for name in controlled_registers if name in self.symo.registers]
+
+    def scalefactor(self, register, unit_id):
+        scalereg = self.symo.cached_scalefactor(unit_id, register[1])
+        if scalereg is None:
+            self.symo.modbus.unit_id = unit_id
+            scalereg = self.symo.read_scalefactor(register[1])
+        if not scalereg:
+            return None
+        return self.symo.decode_scalefactor(scalereg)
+
+    # Raw register value for a value of a parameter, None if it can't be encoded
+    def encode(self, name, value):
+        [register, datatype, unit_id] = self.symo.registers[name]
+        if value is None:
+            return 0xffff
+        elif datatype == 'uint16':
+            return int(value) & 0xffff
+        elif datatype == 'uint16_sunssf' or datatype == 'int16_sunssf':
+            scalef = self.scalefactor(register, unit_id)
+            if scalef is None:
+                logging.error("BatteryControl: could not read scale factor of {0}".format(name))
+                return None
+            return int(round(value / scalef)) & 0xffff
+        else:
+            return None
+
+    def address(self, name):
+        [register, datatype, unit_id] = self.symo.registers[name]
+        if type(register) is list:
+            return [unit_id, register[0]]
+        return [unit_id, register]
+
+    # Current raw values from the device, None if the read failed
+    def read_state(self):
+        names = self.available_registers()
+        if revert_register in self.symo.registers:
+            values = self.symo.read_parameters(names + [revert_register])
+            if values[revert_register] is not False:
+                self.revert_timeout = values[revert_register]
+        else:
+            values = self.symo.read_parameters(names)
+            self.revert_timeout = 0
+        state = {}
+        for name in names:
+            if values[name] is False:
+                return None
+            raw = self.encode(name, values[name])
+            if raw is None:
+                return None
+            state[name] = raw
+        return state
+
+    def refresh(self):
+        self.stats['refreshes'] += 1
+        state = self.read_state()
+        if state is None:
+            self.invalidate()
+            return False
+        self.applied = state
+        self.applied_time = time.monotonic()
+        return True
+
+    def is_stale(self):
+        if self.applied_time is None:
+            return True
+        return self.max_age is not None and time.monotonic() - self.applied_time > self.max_age
+
+    # True if the inverter could have reverted the rate already or will soon
+    def reverting(self, name):
+        if name not in rate_registers or not self.revert_timeout:
+            return False
+        written = self.rates_time.get(name)
+        return written is None or time.monotonic() - written >= self.revert_timeout * revert_margin
+
+    # Compare the device with the applied state, the applied state is updated
+    # to what the device reports
+    def verify(self):
+        state = self.read_state()
+        if state is None:
+            logging.error("BatteryControl: verify failed, could not read back registers")
+            self.invalidate()
+            return False
+        mismatches = [name for name in state if self.applied.get(name) != state[name]]
+        for name in mismatches:
+            logging.warning("BatteryControl: {0} is {1}, expected {2}".format(name, state[name], self.applied.get(name)))
+        self.applied = state
+        self.applied_time = time.monotonic()
+        if mismatches:
+            self.stats['verify_failures'] += 1
+            return False
+        return True
+
+    # Raw values which differ from the applied state, {name : raw}
+    def changes(self):
+        target = {}
+        if 'Battery_StorCtl_Mod' in self.applied:
+            target['Battery_StorCtl_Mod'] = (self.applied['Battery_StorCtl_Mod'] | self.storctl_set) & ~self.storctl_clear & 0xffff
+        for name, value in self.requested.items():
+            if name not in self.applied:
+                logging.error("BatteryControl: {0} not available on this device".format(name))
+                self.requested = {}
+                return None
+            raw = self.encode(name, value)
+            if raw is None:
+                return None
+            target[name] = raw
+        changes = {}
+        for name, raw in target.items():
+            if raw != self.applied[name]:
+                changes[name] = raw
+            elif name in self.requested and self.reverting(name):
+                self.stats['revert_rewrites'] += 1
+                changes[name] = raw
+        return changes
+
+    # Runs of adjacent registers, [unit id, first address, [names], [raw values]],
+    # in the order of controlled_registers (limits before StorCtl_Mod enables them)
+    def write_runs(self, changes):
+        runs = []
+        for name in controlled_registers:
+            if name not in changes:
+                continue
+            [unit_id, addr] = self.address(name)
+            for run in runs:
+                if run[0] == unit_id and addr in (run[1] - 1, run[1] + len(run[3])):
+                    if addr < run[1]:
+                        run[1] = addr
+                        run[2].insert(0, name)
+                        run[3].insert(0, changes[name])
+                    else:
+                        run[2].append(name)
+                        run[3].append(changes[name])
+                    break
+            else:
+                runs.append([unit_id, addr, [name], [changes[name]]])
+        return runs
+
+    # Write what changed. True if the device has the requested state afterwards.
+    def commit(self, verify=None):
+        if verify is None:
+            verify = self.verify_writes
+        self.stats['commits'] += 1
+
+        if self.is_stale() and not self.refresh():
+            logging.error("BatteryControl: could not read current state, nothing written")
+            return False
+
+        changes = self.changes()
+        if changes is None:
+            return False
+        if not changes:
+            self.stats['skipped'] += 1
+            return True
+
+        result = True
+        for [unit_id, addr, names, values] in self.write_runs(changes):
+            logging.info("BatteryControl: writing {0}".format(", ".join(["{0} = {1}".format(name, value) for name, value in zip(names, values)])))
+            self.symo.modbus.unit_id = unit_id
+            if len(values) == 1:
+                ok = self.symo.write_single_register(addr-1, values[0])
+            else:
+                ok = self.symo.write_multiple_registers(addr-1, values)
+            self.stats['writes'] += 1
+            if ok:
+                self.stats['registers_written'] += len(values)
+                for name, value in zip(names, values):
+                    self.applied[name] = value
+                    if name in rate_registers:
+                        self.rates_time[name] = time.monotonic()
+            else:
+                self.stats['failed_writes'] += 1
+                result = False
+
+        if not result:
+            # Unknown what arrived, read back before the next commit
+            self.invalidate()
+            return False
+
+        self.requested = {}
+        self.storctl_set = 0
+        self.storctl_clear = 0
+
+        if verify:
+            return self.verify()
+        return True
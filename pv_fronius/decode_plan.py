@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+
+# Register tables compiled once into precomputed byte offsets, struct formats
+# and scale factor positions. One planned sweep is decoded in a single pass
+# into a SymoRecord, which keeps the values in an array instead of a dict.
+
+import struct
+import math
+from array import array
+
+# Decode codes
+code_uint16 = 0
+code_uint32 = 1
+code_float = 2
+code_string = 3
+code_uint16_sunssf = 4
+code_int16_sunssf = 5
+code_acc32_sunssf = 6
+
+datatype_codes = {
+    "uint16" : code_uint16,
+    "uint32" : code_uint32,
+    "float" : code_float,
+    "string8" : code_string,
+    "string16" : code_string,
+    "uint16_sunssf" : code_uint16_sunssf,
+    "int16_sunssf" : code_int16_sunssf,
+    "acc32_sunssf" : code_acc32_sunssf,
+}
+
+# Value status in a SymoRecord, same meaning as the return values of Symo.read_data()
+status_ok = 0
+status_invalid = 1   # None, register not implemented/no data
+status_error = 2     # False, read failed
+
+struct_uint16 = struct.Struct('>H')
+struct_int16 = struct.Struct('>h')
+struct_uint32 = struct.Struct('>I')
+struct_float = struct.Struct('>f')
+
+
+class SymoRecord:
+    __slots__ = ('plan', 'values', 'status', 'strings')
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.values = array('d', bytes(8 * len(plan.names)))
+        self.status = array('b', bytes(len(plan.names)))
+        self.strings = {}
+
+    def value(self, i):
+        status = self.status[i]
+        if status == status_invalid:
+            return None
+        elif status == status_error:
+            return False
+        code = self.plan.codes[i]
+        if code == code_string:
+            return self.strings[i]
+        elif code == code_uint16 or code == code_uint32:
+            return int(self.values[i])
+        else:
+            return self.values[i]
+
+    def __getitem__(self, name):
+        return self.value(self.plan.index[name])
+
+    def __contains__(self, name):
+        return name in self.plan.index
+
+    def __len__(self):
+        return len(self.plan.names)
+
+    def get(self, name, default=None):
+        i = self.plan.index.get(name)
+        if i is None:
+            return default
+        return self.value(i)
+
+    def as_dict(self):
+        return {name : self.value(i) for i, name in enumerate(self.plan.names)}
+
+
+class DecodePlan:
+    # blocks: [unit id, start address, count] as planned by SymoBase.plan_reads()
+    def __init__(self, registers, parameters, blocks):
+        self.names = list(parameters)
+        self.index = {name : i for i, name in enumerate(self.names)}
+        self.blocks = blocks
+        self.block_structs = [struct.Struct('>{0}H'.format(count)) for [unit_id, start, count] in blocks]
+        self.codes = []
+
+        def locate(unit_id, addr, count):
+            for b, [block_unit, start, block_count] in enumerate(blocks):
+                if block_unit == unit_id and start <= addr and addr + count <= start + block_count:
+                    return [b, 2 * (addr - start)]
+            raise ValueError("address {0} of unit {1} not covered by read plan".format(addr, unit_id))
+
+        # [index, code, block, byte offset, size, sf block, sf byte offset]
+        self.entries = []
+        # [unit id, address, block, byte offset] of every scale factor in the plan
+        self.scalefactors = []
+        for i, name in enumerate(self.names):
+            [register, datatype, unit_id] = registers[name]
+            code = datatype_codes.get(datatype)
+            self.codes.append(code)
+            if code is None:
+                self.entries.append([i, None, None, 0, 0, None, 0])
+            elif type(register) is list:
+                size = 2 if code == code_acc32_sunssf else 1
+                [block, offset] = locate(unit_id, register[0], size)
+                [sf_block, sf_offset] = locate(unit_id, register[1], 1)
+                self.entries.append([i, code, block, offset, size, sf_block, sf_offset])
+                if [unit_id, register[1], sf_block, sf_offset] not in self.scalefactors:
+                    self.scalefactors.append([unit_id, register[1], sf_block, sf_offset])
+            else:
+                if code == code_string:
+                    size = 8 if datatype == "string8" else 16
+                elif code == code_uint16:
+                    size = 1
+                else:
+                    size = 2
+                [block, offset] = locate(unit_id, register, size)
+                self.entries.append([i, code, block, offset, size, None, 0])
+
+    def decode(self, buffers):
+        record = SymoRecord(self)
+        values = record.values
+        status = record.status
+
+        raws = []
+        for b, regs in enumerate(buffers):
+            if regs and len(regs) == self.blocks[b][2]:
+                raws.append(self.block_structs[b].pack(*regs))
+            else:
+                raws.append(None)
+
+        for [i, code, block, offset, size, sf_block, sf_offset] in self.entries:
+            raw = raws[block] if block is not None else None
+            if raw is None or (sf_block is not None and raws[sf_block] is None):
+                status[i] = status_error
+                continue
+
+            if code == code_uint16:
+                value = struct_uint16.unpack_from(raw, offset)[0]
+                if value == 0xffff:
+                    status[i] = status_invalid
+                else:
+                    values[i] = value
+            elif code == code_float:
+                value = struct_float.unpack_from(raw, offset)[0]
+                if math.isnan(value):
+                    status[i] = status_invalid
+                else:
+                    values[i] = value
+            elif code == code_uint32:
+                value = struct_uint32.unpack_from(raw, offset)[0]
+                if value == 0xffffffff:
+                    status[i] = status_invalid
+                else:
+                    values[i] = value
+            elif code == code_string:
+                text = raw[offset:offset + 2 * size]
+                # String ends at the first register which is 0
+                for pos in range(0, len(text), 2):
+                    if text[pos] == 0 and text[pos + 1] == 0:
+                        text = text[:pos]
+                        break
+                if text:
+                    record.strings[i] = text.decode('latin-1')
+                else:
+                    status[i] = status_error
+            else:
+                scalef = struct_int16.unpack_from(raws[sf_block], sf_offset)[0]
+                if code == code_acc32_sunssf:
+                    value = struct_uint32.unpack_from(raw, offset)[0]
+                    not_implemented = value == 0xffffffff
+                else:
+                    value = struct_uint16.unpack_from(raw, offset)[0]
+                    not_implemented = value == 0xffff
+                    if code == code_int16_sunssf and value >= 0x8000:
+                        value = value - 0x10000
+                if scalef == -32768 or not_implemented:
+                    status[i] = status_invalid
+                else:
+                    values[i] = value * 10.0**scalef
+
+        return record
+
+    # Raw scale factor registers found in the buffers, as [unit id, address, raw value]
+    def read_scalefactors(self, buffers):
+        results = []
+        for [unit_id, addr, block, offset] in self.scalefactors:
+            regs = buffers[block]
+            if regs:
+                results.append([unit_id, addr, regs[offset // 2]])
+        return results
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+
+# Derived values as formulas over registers and other derived values, e.g.
+#   "Self_Consumption_Ratio" : "1 - max(-Meter_Power_Total, 0) / AC_Output_Power"
+# Names which are not plain identifiers are written in braces, e.g. {AC_Voltage_Phase-A-N}.
+# The old form [param1, param2, operant] is still accepted.
+#
+# All formulas are compiled into one graph of nodes. Equal subexpressions
+# (including references to other derived values) end up as the same node, so
+# they are calculated only once per evaluation. Nodes are created children
+# first, so the node list is already in topological order.
+
+import re
+import math
+import logging
+
+# Node kinds
+node_const = 0
+node_ref = 1
+node_neg = 2
+node_op = 3
+node_call = 4
+
+operators = {
+    '+' : lambda a, b: a + b,
+    '-' : lambda a, b: a - b,
+    '*' : lambda a, b: a * b,
+    '/' : lambda a, b: a / b,
+}
+commutative = ('+', '*')
+
+functions = {
+    'abs' : abs,
+    'min' : min,
+    'max' : max,
+    'sqrt' : math.sqrt,
+}
+
+token_re = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][+-]?\d+)?|\.\d+)|([A-Za-z_][A-Za-z0-9_]*)|\{([^}]*)\}|(.))')
+
+
+def tokenize(formula):
+    tokens = []
+    pos = 0
+    formula = formula.rstrip()
+    while pos < len(formula):
+        match = token_re.match(formula, pos)
+        [number, name, quoted, char] = match.groups()
+        if number is not None:
+            tokens.append(['number', float(number)])
+        elif name is not None:
+            tokens.append(['name', name])
+        elif quoted is not None:
+            tokens.append(['name', quoted.strip()])
+        elif char in '+-*/(),':
+            tokens.append([char, None])
+        else:
+            raise ValueError("Unexpected '{0}' in formula '{1}'".format(char, formula))
+        pos = match.end()
+    tokens.append(['end', None])
+    return tokens
+
+
+# Recursive descent parser, result is a tree of tuples:
+# ('const', value), ('ref', name), ('neg', a), ('op', operant, a, b), ('call', function, a, b, ...)
+class Parser:
+    def __init__(self, formula):
+        self.formula = formula
+        self.tokens = tokenize(formula)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0]
+
+    def take(self, kind=None):
+        token = self.tokens[self.pos]
+        if kind is not None and token[0] != kind:
+            raise ValueError("Expected '{0}' in formula '{1}'".format(kind, self.formula))
+        self.pos += 1
+        return token
+
+    def parse(self):
+        tree = self.expression()
+        self.take('end')
+        return tree
+
+    def expression(self):
+        tree = self.term()
+        while self.peek() in ('+', '-'):
+            operant = self.take()[0]
+            tree = ('op', operant, tree, self.term())
+        return tree
+
+    def term(self):
+        tree = self.unary()
+        while self.peek() in ('*', '/'):
+            operant = self.take()[0]
+            tree = ('op', operant, tree, self.unary())
+        return tree
+
+    def unary(self):
+        if self.peek() == '-':
+            self.take()
+            return ('neg', self.unary())
+        if self.peek() == '+':
+            self.take()
+        return self.atom()
+
+    def atom(self):
+        [kind, value] = self.take()
+        if kind == 'number':
+            return ('const', value)
+        elif kind == '(':
+            tree = self.expression()
+            self.take(')')
+            return tree
+        elif kind == 'name':
+            if self.peek() != '(':
+                return ('ref', value)
+            if value not in functions:
+                raise ValueError("Unknown function '{0}' in formula '{1}'".format(value, self.formula))
+            self.take('(')
+            args = [self.expression()]
+            while self.peek() == ',':
+                self.take()
+                args.append(self.expression())
+            self.take(')')
+            return ('call', value) + tuple(args)
+        else:
+            raise ValueError("Unexpected '{0}' in formula '{1}'".format(kind, self.formula))
+
+
+def parse_formula(definition):
+    if type(definition) is list or type(definition) is tuple:
+        [param1, param2, operant] = definition
+        if operant not in operators:
+            raise ValueError("Unknown operant '{0}'".format(operant))
+        return ('op', operant, ('ref', param1), ('ref', param2))
+    return Parser(definition).parse()
+
+
+class ExpressionGraph:
+    # definitions: {name : formula string or [param1, param2, operant]}
+    # registers: names which can be read from the device. Definitions referring
+    # to anything else are left out, see self.skipped.
+    def __init__(self, definitions, registers):
+        self.definitions = {}
+        self.registers = set(registers)
+        # [kind, argument, child node indexes]
+        self.nodes = []
+        self.node_keys = {}
+        # derived name : node index
+        self.roots = {}
+        # node index : register name
+        self.refs = {}
+        self.skipped = []
+        # tuple of names : [node indexes, register names]
+        self.subsets = {}
+
+        trees = {}
+        for name, definition in definitions.items():
+            try:
+                trees[name] = parse_formula(definition)
+            except ValueError as e:
+                logging.error("Calculated value {0}: {1}".format(name, e))
+                self.skipped.append(name)
+                continue
+            self.definitions[name] = definition
+
+        for name in trees:
+            self.compile(name, trees, [])
+
+    def compile(self, name, trees, stack):
+        if name in self.roots:
+            return self.roots[name]
+        if name in self.skipped:
+            return None
+        if name in stack:
+            raise ValueError("Calculated value {0} depends on itself: {1}".format(name, ' -> '.join(stack + [name])))
+
+        stack.append(name)
+        root = self.compile_tree(trees[name], trees, stack)
+        stack.pop()
+
+        if root is None:
+            logging.debug("Calculated value {0} not available".format(name))
+            self.skipped.append(name)
+            del self.definitions[name]
+        else:
+            self.roots[name] = root
+        return root
+
+    def compile_tree(self, tree, trees, stack):
+        kind = tree[0]
+        if kind == 'const':
+            return self.node(node_const, tree[1], ())
+        elif kind == 'ref':
+            name = tree[1]
+            if name in trees:
+                return self.compile(name, trees, stack)
+            if name not in self.registers:
+                return None
+            node = self.node(node_ref, name, ())
+            self.refs[node] = name
+            return node
+
+        children = []
+        for subtree in tree[2:] if kind != 'neg' else tree[1:]:
+            child = self.compile_tree(subtree, trees, stack)
+            if child is None:
+                return None
+            children.append(child)
+
+        if kind == 'neg':
+            return self.node(node_neg, None, tuple(children))
+        elif kind == 'op':
+            if tree[1] in commutative:
+                children.sort()
+            return self.node(node_op, tree[1], tuple(children))
+        else:
+            return self.node(node_call, tree[1], tuple(children))
+
+    # Same kind, argument and children give the same node
+    def node(self, kind, argument, children):
+        key = (kind, argument, children)
+        index = self.node_keys.get(key)
+        if index is None:
+            index = len(self.nodes)
+            self.nodes.append([kind, argument, children])
+            self.node_keys[key] = index
+        return index
+
+    def names(self):
+        return list(self.roots.keys())
+
+    def __contains__(self, name):
+        return name in self.roots
+
+    # [node indexes in topological order, register names] needed for the given derived values
+    def subset(self, names=None):
+        key = None if names is None else tuple(names)
+        result = self.subsets.get(key)
+        if result is None:
+            if names is None:
+                names = self.names()
+            needed = set()
+            todo = [self.roots[name] for name in names if name in self.roots]
+            while todo:
+                index = todo.pop()
+                if index not in needed:
+                    needed.add(index)
+                    todo.extend(self.nodes[index][2])
+            order = sorted(needed)
+            registers = [self.refs[index] for index in order if index in self.refs]
+            result = [order, registers]
+            self.subsets[key] = result
+        return result
+
+    def required_registers(self, names=None):
+        return list(self.subset(names)[1])
+
+    # {name : value} of the given derived values from the register values.
+    # A value which can't be calculated (missing or invalid operand, division by zero) is False.
+    def evaluate(self, values, names=None):
+        [order, registers] = self.subset(names)
+        results = {}
+        for index in order:
+            [kind, argument, children] = self.nodes[index]
+            try:
+                if kind == node_ref:
+                    value = values[argument]
+                    if value is None or value is False or type(value) is str:
+                        value = False
+                elif kind == node_const:
+                    value = argument
+                elif any(results[child] is False for child in children):
+                    value = False
+                elif kind == node_op:
+                    value = operators[argument](results[children[0]], results[children[1]])
+                elif kind == node_neg:
+                    value = -results[children[0]]
+                else:
+                    value = functions[argument](*[results[child] for child in children])
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                value = False
+            results[index] = value
+
+        if names is None:
+            names = self.names()
+        return {name : results[self.roots[name]] if name in self.roots else False for name in names}
@@ -3,307 +3,800 @@
 # Version history:
 # V1: Baseline
 # V2: Add Enable function, argparse for testprogram
+# V3: Read planner, fetch contiguous register spans with one request
+# V4: Cache SunSpec scale factors
+# V5: Snapshot of all registers and calculated values
+# V6: Persistent connection mode with reconnect
+# V7: Split I/O free parts into SymoBase, shared with AsyncSymo
+# V8: Decode sweeps with a precompiled DecodePlan, fix int16 two's complement
+# V9: model="sunspec", register map from the SunSpec model chain
+# V10: Calculated values as formulas, evaluated from one sweep with an ExpressionGraph
+# V11: Battery/connection control through BatteryControl, skips unchanged writes
+# V12: print_raw() with the block reading RegisterScanner
+# V13: Latency/error metrics of every Modbus request
+# V14: SunSpec chains are only used and cached when no read of the walk failed
 
 # References:
 # https://stoborblog.wordpress.com/2017/03/11/sunspec-solar-viewer-fronius-modbus/
 
 from pyModbusTCP.client import ModbusClient
 from pyModbusTCP import utils
+from pyModbusTCP.constants import MB_CONNECT_ERR, MB_SEND_ERR, MB_RECV_ERR, MB_TIMEOUT_ERR, MB_FRAME_ERR, MB_SOCK_CLOSE_ERR, MB_EXCEPT_ERR
+
+from pv_fronius.decode_plan import DecodePlan
+from pv_fronius.expressions import ExpressionGraph, parse_formula
+from pv_fronius.battery_control import BatteryControl
+from pv_fronius.register_scan import RegisterScanner, symo_reader
+from pv_fronius.modbus_metrics import ModbusMetrics
+from pv_fronius import sunspec
 
 import time
 import math
 import logging
+from datetime import datetime
+from types import MappingProxyType
 
 # Overwrites, so remove
 # logging.basicConfig(format='fronius_symo: %(message)s', level=logging.INFO)
 
+# Modbus limit for one read_holding_registers request
+max_read_registers = 125
 
-class Symo:
-    def __init__(self, ipaddr, model="autodetect"):
-        self.ipaddr = ipaddr
-        self.modbus = ModbusClient(host=ipaddr, port=502, auto_open=True, auto_close=True)
+# Errors after which the socket of a persistent connection is considered dead
+connection_errors = (MB_CONNECT_ERR, MB_SEND_ERR, MB_RECV_ERR, MB_TIMEOUT_ERR, MB_FRAME_ERR, MB_SOCK_CLOSE_ERR)
+
+# Number of registers used by each (non scaled) datatype
+datatype_size = {
+    "float" : 2,
+    "uint32" : 2,
+    "uint16" : 1,
+    "string8" : 8,
+    "string16" : 16,
+}
+
+
+class RegisterBlock:
+    def __init__(self, unit_id, start, count, parameters):
+        self.unit_id = unit_id
+        self.start = start
+        self.count = count
+        self.parameters = parameters
+
+    def contains(self, addr, count=1):
+        return self.start <= addr and addr + count <= self.start + self.count
+
+
+# Immutable result of one Symo.snapshot(), all values share one timestamp
+class SymoSnapshot:
+    __slots__ = ('_timestamp', '_values')
+
+    def __init__(self, timestamp, values):
+        object.__setattr__(self, '_timestamp', timestamp)
+        object.__setattr__(self, '_values', MappingProxyType(dict(values)))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SymoSnapshot is read only")
+
+    @property
+    def timestamp(self):
+        return self._timestamp
+
+    @property
+    def values(self):
+        return self._values
+
+    def __getitem__(self, name):
+        return self._values[name]
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, name, default=None):
+        return self._values.get(name, default)
+
+    def keys(self):
+        return self._values.keys()
+
+    def items(self):
+        return self._values.items()
+
+    def __repr__(self):
+        return "SymoSnapshot({0}, {1} values)".format(self._timestamp.isoformat(), len(self._values))
+
+
+# Format:
+# "name : [register address, data type, unit 1]
+registers_gen24 = {
+# Common Block Register   
+    "Sunspec_SID" : [40001, "uint32", 1],
+    "Sunspec_Common_ID" : [40003, "uint16", 1],
+    "Sunspec_Common_L" : [40004, "uint16", 1],
+    "Sunspec_Devicename" : [40021, "string16", 1],
+    "Sunspec_Software Version" : [40045, "string8", 1],
+    "Sunspec_Inverter_ID" : [40070, "uint16", 1],
+    "Sunspec_Inverter_L" : [40071, "uint16", 1],
+    "AC_Phase-A_Current" : [40074, "float", 1],
+    "AC_Phase-B_Current" : [40076, "float", 1],
+    "AC_Phase-C_Current" : [40078, "float", 1],
+    "AC_Voltage_Phase-AB" : [40080, "float", 1],
+    "AC_Voltage_Phase-BC" : [40082, "float", 1],
+    "AC_Voltage_Phase-CA" : [40084, "float", 1],
+    "AC_Voltage_Phase-A-N" : [40086, "float", 1],
+    "AC_Voltage_Phase-B-N" : [40088, "float", 1],
+    "AC_Voltage_Phase-C-N" : [40090, "float", 1],
+    "AC_Output_Power" : [40092, "float", 1],
+    "AC_Frequency" : [40094, "float", 1],
+    "AC_Energy" : [40102, "float", 1],
+    "DC_Power" : [40108, "float", 1],
+    
+    "Cabinet_Temperature" : [40110, "float", 1],
+    "Operating_State" : [40118, "uint16", 1],
+# Nameplate model
+    "Nameplate_Continous_AC_Power" : [[40135,40136], "uint16_sunssf", 1],
+    "Nameplate_Battery_Capacity" : [[40151,40152], "uint16_sunssf", 1],
+    "Nameplate_Battery_Charge_Power" : [[40155,40156], "uint16_sunssf", 1],
+    "Nameplate_Battery_Discharge_Power" : [[40157,40158], "uint16_sunssf", 1],
+# control model
+    "Control_conn" : [40242, "uint16", 1],
+# Status model
+    # "Isolation_resistance" : [[40236,40237], "uint16_sunssf", 1],
+# Storage device (Battery)
+    "Sunspec_Battery_ID" : [40354, "uint16", 1],
+    "Sunspec_Battery_L" : [40355, "uint16", 1],
+    "Battery_Max_Charge_Power" : [[40356,40372], "uint16_sunssf", 1],
+    "Battery_WChaGra" : [40357, "uint16", 1],
+    "Battery_WDisChaGra" : [40358, "uint16", 1],
+    "Battery_StorCtl_Mod" : [40359, "uint16", 1],
+    "Battery_Min_Reserve" : [[40361,40375], "uint16_sunssf", 1],
+    "Battery_SoC" : [[40362,40376], "uint16_sunssf", 1],
+    "Battery_Status" : [40365, "uint16", 1],
+    "Battery_OutWRte" : [[40366,40379], "int16_sunssf", 1],
+    "Battery_InWRte" : [[40367,40379], "int16_sunssf", 1],
+    "Battery_InOutWRte_RvrtTm" : [40369, "uint16", 1],
+    "Battery_ChaGriSet" : [40371, "uint16", 1],
+# Multiple MPPT
+    "Sunspec_MPPT_ID" : [40264, "uint16", 1],
+    "MPPT_1_DC_Current" : [[40283,40266], "uint16_sunssf", 1],
+    "MPPT_1_DC_Voltage" : [[40284,40267], "uint16_sunssf", 1],
+    "MPPT_1_DC_Power" : [[40285,40268], "uint16_sunssf", 1],
+    "MPPT_1_DC_Energy" : [[40286,40269], "acc32_sunssf", 1],
+    "MPPT_2_DC_Current" : [[40303,40266], "uint16_sunssf", 1],
+    "MPPT_2_DC_Voltage" : [[40304,40267], "uint16_sunssf", 1],
+    "MPPT_2_DC_Power" : [[40305,40268], "uint16_sunssf", 1],
+    "MPPT_2_DC_Energy" : [[40306,40269], "acc32_sunssf", 1],
+    "MPPT_3_DC_Current" : [[40323,40266], "uint16_sunssf", 1],
+    "MPPT_3_DC_Voltage" : [[40324,40267], "uint16_sunssf", 1],
+    "MPPT_3_DC_Power" : [[40325,40268], "uint16_sunssf", 1],
+    "MPPT_3_DC_Energy" : [[40326,40269], "acc32_sunssf", 1],
+    "MPPT_4_DC_Current" : [[40343,40266], "uint16_sunssf", 1],
+    "MPPT_4_DC_Voltage" : [[40344,40267], "uint16_sunssf", 1],
+    "MPPT_4_DC_Power" : [[40345,40268], "uint16_sunssf", 1],
+    "MPPT_4_DC_Energy" : [[40346,40269], "acc32_sunssf", 1],
+# Power Meter
+    "Sunspec_Meter_ID" : [40070, "uint16", 200],
+    "Meter_Frequency" : [40096, "float", 200],
+    "Meter_Power_Total" : [40098, "float", 200],
+    "Meter_Power_L1" : [40100, "float", 200],
+    "Meter_Power_L2" : [40102, "float", 200],
+    "Meter_Power_L3" : [40104, "float", 200],
+    "Meter_Real_Energy_Exported" : [40130, "float", 200],
+    "Meter_Real_Energy_Exported_L1" : [40132, "float", 200],
+    "Meter_Real_Energy_Exported_L2" : [40134, "float", 200],
+    "Meter_Real_Energy_Exported_L3" : [40136, "float", 200],
+    "Meter_Real_Energy_Imported" : [40138, "float", 200],
+    "Meter_Real_Energy_Imported_L1" : [40140, "float", 200],
+    "Meter_Real_Energy_Imported_L2" : [40142, "float", 200],
+    "Meter_Real_Energy_Imported_L3" : [40144, "float", 200],
+}
+
+registers_symo = {
+# Common Block Register   
+    "Sunspec_SID" : [40001, "uint32", 1],
+    "Sunspec_Common_ID" : [40003, "uint16", 1],
+    "Sunspec_Common_L" : [40004, "uint16", 1],
+    "Sunspec_Devicename" : [40021, "string16", 1],
+    "Sunspec_Software Version" : [40045, "string8", 1],
+    "Sunspec_Inverter_ID" : [40070, "uint16", 1],
+    "Sunspec_Inverter_L" : [40071, "uint16", 1],
+    "AC_Phase-A_Current" : [40074, "float", 1],
+    "AC_Phase-B_Current" : [40076, "float", 1],
+    "AC_Phase-C_Current" : [40078, "float", 1],
+    "AC_Voltage_Phase-AB" : [40080, "float", 1],
+    "AC_Voltage_Phase-BC" : [40082, "float", 1],
+    "AC_Voltage_Phase-CA" : [40084, "float", 1],
+    "AC_Voltage_Phase-A-N" : [40086, "float", 1],
+    "AC_Voltage_Phase-B-N" : [40088, "float", 1],
+    "AC_Voltage_Phase-C-N" : [40090, "float", 1],
+    "AC_Output_Power" : [40092, "float", 1],
+    "AC_Frequency" : [40094, "float", 1],
+    "AC_Energy" : [40102, "float", 1],
+    "DC_Power" : [40108, "float", 1],
+    "Operating_State" : [40118, "uint16", 1],
+# Nameplate model
+    "Nameplate_Continous_AC_Power" : [[40135,40136], "uint16_sunssf", 1],
+# control model
+    "Control_conn" : [40242, "uint16", 1],
+# Multiple MPPT
+    "Sunspec_MPPT_ID" : [40264, "uint16", 1],
+    "MPPT_1_DC_Current" : [[40283,40266], "uint16_sunssf", 1],
+    "MPPT_1_DC_Voltage" : [[40284,40267], "uint16_sunssf", 1],
+    "MPPT_1_DC_Power" : [[40285,40268], "uint16_sunssf", 1],
+    "MPPT_2_DC_Current" : [[40303,40266], "uint16_sunssf", 1],
+    "MPPT_2_DC_Voltage" : [[40304,40267], "uint16_sunssf", 1],
+    "MPPT_2_DC_Power" : [[40305,40268], "uint16_sunssf", 1],
+}
+
+# Format:
+# "name" : [param1, param2, operant] or a formula over registers and other
+# calculated values, see expressions.py
+calculated_parameters_gen24 = {
+    "Consumption_Sum" : ['AC_Output_Power', 'Meter_Power_Total', '+'],
+    "Battery_Power" : ['MPPT_4_DC_Power', 'MPPT_3_DC_Power', '-'],
+    "Battery_Current" : ['MPPT_4_DC_Current', 'MPPT_3_DC_Current', '-'],
+    "PV_Power" : ['MPPT_1_DC_Power', 'MPPT_2_DC_Power', '+'],
+    "AC_Output_L1" : ['AC_Voltage_Phase-A-N', 'AC_Phase-A_Current', '*'],
+    "AC_Output_L2" : ['AC_Voltage_Phase-B-N', 'AC_Phase-B_Current', '*'],
+    "AC_Output_L3" : ['AC_Voltage_Phase-C-N', 'AC_Phase-C_Current', '*'],
+    "AC_Phase_Imbalance" : "(max(AC_Output_L1, AC_Output_L2, AC_Output_L3) - min(AC_Output_L1, AC_Output_L2, AC_Output_L3)) / ((AC_Output_L1 + AC_Output_L2 + AC_Output_L3) / 3)",
+    "Self_Consumption_Ratio" : "1 - max(-Meter_Power_Total, 0) / AC_Output_Power",
+    "Battery_Efficiency" : "MPPT_4_DC_Energy / MPPT_3_DC_Energy",
+    }
+
+calculated_parameters_symo = {
+    "PV_Power" : ['MPPT_1_DC_Power', 'MPPT_2_DC_Power', '+'],
+    "AC_Output_L1" : ['AC_Voltage_Phase-A-N', 'AC_Phase-A_Current', '*'],
+    "AC_Output_L2" : ['AC_Voltage_Phase-B-N', 'AC_Phase-B_Current', '*'],
+    "AC_Output_L3" : ['AC_Voltage_Phase-C-N', 'AC_Phase-C_Current', '*'],
+    "AC_Phase_Imbalance" : "(max(AC_Output_L1, AC_Output_L2, AC_Output_L3) - min(AC_Output_L1, AC_Output_L2, AC_Output_L3)) / ((AC_Output_L1 + AC_Output_L2 + AC_Output_L3) / 3)",
+    }
+
+
+# Register maps, planner and decoding, shared by Symo and AsyncSymo
+class SymoBase:
+    def __init__(self, model="autodetect", sf_ttl=None, sunspec_cache=sunspec.default_cache_dir):
         self.model = model
         self.name = "Unkown"
-        # self.modbus.debug(True)
+        # Directory for discovered SunSpec model chains, None disables the cache
+        self.sunspec_cache = sunspec_cache
 
-        # Format:
-        # "name : [register address, data type, unit 1]
-        registers_gen24 = {
-        # Common Block Register   
-            "Sunspec_SID" : [40001, "uint32", 1],
-            "Sunspec_Common_ID" : [40003, "uint16", 1],
-            "Sunspec_Common_L" : [40004, "uint16", 1],
-            "Sunspec_Devicename" : [40021, "string16", 1],
-            "Sunspec_Software Version" : [40045, "string8", 1],
-            "Sunspec_Inverter_ID" : [40070, "uint16", 1],
-            "Sunspec_Inverter_L" : [40071, "uint16", 1],
-            "AC_Phase-A_Current" : [40074, "float", 1],
-            "AC_Phase-B_Current" : [40076, "float", 1],
-            "AC_Phase-C_Current" : [40078, "float", 1],
-            "AC_Voltage_Phase-AB" : [40080, "float", 1],
-            "AC_Voltage_Phase-BC" : [40082, "float", 1],
-            "AC_Voltage_Phase-CA" : [40084, "float", 1],
-            "AC_Voltage_Phase-A-N" : [40086, "float", 1],
-            "AC_Voltage_Phase-B-N" : [40088, "float", 1],
-            "AC_Voltage_Phase-C-N" : [40090, "float", 1],
-            "AC_Output_Power" : [40092, "float", 1],
-            "AC_Frequency" : [40094, "float", 1],
-            "AC_Energy" : [40102, "float", 1],
-            "DC_Power" : [40108, "float", 1],
-            
-            "Cabinet_Temperature" : [40110, "float", 1],
-            "Operating_State" : [40118, "uint16", 1],
-        # Nameplate model
-            "Nameplate_Continous_AC_Power" : [[40135,40136], "uint16_sunssf", 1],
-            "Nameplate_Battery_Capacity" : [[40151,40152], "uint16_sunssf", 1],
-            "Nameplate_Battery_Charge_Power" : [[40155,40156], "uint16_sunssf", 1],
-            "Nameplate_Battery_Discharge_Power" : [[40157,40158], "uint16_sunssf", 1],
-        # control model
-            "Control_conn" : [40242, "uint16", 1],
-        # Status model
-            # "Isolation_resistance" : [[40236,40237], "uint16_sunssf", 1],
-        # Storage device (Battery)
-            "Sunspec_Battery_ID" : [40354, "uint16", 1],
-            "Sunspec_Battery_L" : [40355, "uint16", 1],
-            "Battery_Max_Charge_Power" : [[40356,40372], "uint16_sunssf", 1],
-            "Battery_WChaGra" : [40357, "uint16", 1],
-            "Battery_WDisChaGra" : [40358, "uint16", 1],
-            "Battery_StorCtl_Mod" : [40359, "uint16", 1],
-            "Battery_Min_Reserve" : [[40361,40375], "uint16_sunssf", 1],
-            "Battery_SoC" : [[40362,40376], "uint16_sunssf", 1],
-            "Battery_Status" : [40365, "uint16", 1],
-            "Battery_OutWRte" : [[40366,40379], "int16_sunssf", 1],
-            "Battery_InWRte" : [[40367,40379], "int16_sunssf", 1],
-            "Battery_InOutWRte_RvrtTm" : [40369, "uint16", 1],
-            "Battery_ChaGriSet" : [40371, "uint16", 1],
-        # Multiple MPPT
-            "Sunspec_MPPT_ID" : [40264, "uint16", 1],
-            "MPPT_1_DC_Current" : [[40283,40266], "uint16_sunssf", 1],
-            "MPPT_1_DC_Voltage" : [[40284,40267], "uint16_sunssf", 1],
-            "MPPT_1_DC_Power" : [[40285,40268], "uint16_sunssf", 1],
-            "MPPT_1_DC_Energy" : [[40286,40269], "acc32_sunssf", 1],
-            "MPPT_2_DC_Current" : [[40303,40266], "uint16_sunssf", 1],
-            "MPPT_2_DC_Voltage" : [[40304,40267], "uint16_sunssf", 1],
-            "MPPT_2_DC_Power" : [[40305,40268], "uint16_sunssf", 1],
-            "MPPT_2_DC_Energy" : [[40306,40269], "acc32_sunssf", 1],
-            "MPPT_3_DC_Current" : [[40323,40266], "uint16_sunssf", 1],
-            "MPPT_3_DC_Voltage" : [[40324,40267], "uint16_sunssf", 1],
-            "MPPT_3_DC_Power" : [[40325,40268], "uint16_sunssf", 1],
-            "MPPT_3_DC_Energy" : [[40326,40269], "acc32_sunssf", 1],
-            "MPPT_4_DC_Current" : [[40343,40266], "uint16_sunssf", 1],
-            "MPPT_4_DC_Voltage" : [[40344,40267], "uint16_sunssf", 1],
-            "MPPT_4_DC_Power" : [[40345,40268], "uint16_sunssf", 1],
-            "MPPT_4_DC_Energy" : [[40346,40269], "acc32_sunssf", 1],
-        # Power Meter
-            "Sunspec_Meter_ID" : [40070, "uint16", 200],
-            "Meter_Frequency" : [40096, "float", 200],
-            "Meter_Power_Total" : [40098, "float", 200],
-            "Meter_Power_L1" : [40100, "float", 200],
-            "Meter_Power_L2" : [40102, "float", 200],
-            "Meter_Power_L3" : [40104, "float", 200],
-            "Meter_Real_Energy_Exported" : [40130, "float", 200],
-            "Meter_Real_Energy_Exported_L1" : [40132, "float", 200],
-            "Meter_Real_Energy_Exported_L2" : [40134, "float", 200],
-            "Meter_Real_Energy_Exported_L3" : [40136, "float", 200],
-            "Meter_Real_Energy_Imported" : [40138, "float", 200],
-            "Meter_Real_Energy_Imported_L1" : [40140, "float", 200],
-            "Meter_Real_Energy_Imported_L2" : [40142, "float", 200],
-            "Meter_Real_Energy_Imported_L3" : [40144, "float", 200],
-        }
+        # Scale factors, (unit id, address) : [raw register, time of read]
+        # sf_ttl = None keeps them until invalidate_scalefactors()
+        self.sf_cache = {}
+        self.sf_ttl = sf_ttl
 
-        registers_symo = {
-        # Common Block Register   
-            "Sunspec_SID" : [40001, "uint32", 1],
-            "Sunspec_Common_ID" : [40003, "uint16", 1],
-            "Sunspec_Common_L" : [40004, "uint16", 1],
-            "Sunspec_Devicename" : [40021, "string16", 1],
-            "Sunspec_Software Version" : [40045, "string8", 1],
-            "Sunspec_Inverter_ID" : [40070, "uint16", 1],
-            "Sunspec_Inverter_L" : [40071, "uint16", 1],
-            "AC_Phase-A_Current" : [40074, "float", 1],
-            "AC_Phase-B_Current" : [40076, "float", 1],
-            "AC_Phase-C_Current" : [40078, "float", 1],
-            "AC_Voltage_Phase-AB" : [40080, "float", 1],
-            "AC_Voltage_Phase-BC" : [40082, "float", 1],
-            "AC_Voltage_Phase-CA" : [40084, "float", 1],
-            "AC_Voltage_Phase-A-N" : [40086, "float", 1],
-            "AC_Voltage_Phase-B-N" : [40088, "float", 1],
-            "AC_Voltage_Phase-C-N" : [40090, "float", 1],
-            "AC_Output_Power" : [40092, "float", 1],
-            "AC_Frequency" : [40094, "float", 1],
-            "AC_Energy" : [40102, "float", 1],
-            "DC_Power" : [40108, "float", 1],
-            "Operating_State" : [40118, "uint16", 1],
-        # Nameplate model
-            "Nameplate_Continous_AC_Power" : [[40135,40136], "uint16_sunssf", 1],
-        # control model
-            "Control_conn" : [40242, "uint16", 1],
-        # Multiple MPPT
-            "Sunspec_MPPT_ID" : [40264, "uint16", 1],
-            "MPPT_1_DC_Current" : [[40283,40266], "uint16_sunssf", 1],
-            "MPPT_1_DC_Voltage" : [[40284,40267], "uint16_sunssf", 1],
-            "MPPT_1_DC_Power" : [[40285,40268], "uint16_sunssf", 1],
-            "MPPT_2_DC_Current" : [[40303,40266], "uint16_sunssf", 1],
-            "MPPT_2_DC_Voltage" : [[40304,40267], "uint16_sunssf", 1],
-            "MPPT_2_DC_Power" : [[40305,40268], "uint16_sunssf", 1],
-        }
-        
-        calculated_parameters_gen24 = {
-            "Consumption_Sum" : ['AC_Output_Power', 'Meter_Power_Total', '+'],
-            "Battery_Power" : ['MPPT_4_DC_Power', 'MPPT_3_DC_Power', '-'],
-            "Battery_Current" : ['MPPT_4_DC_Current', 'MPPT_3_DC_Current', '-'],
-            "PV_Power" : ['MPPT_1_DC_Power', 'MPPT_2_DC_Power', '+'],
-            "AC_Output_L1" : ['AC_Voltage_Phase-A-N', 'AC_Phase-A_Current', '*'],
-            "AC_Output_L2" : ['AC_Voltage_Phase-B-N', 'AC_Phase-B_Current', '*'],
-            "AC_Output_L3" : ['AC_Voltage_Phase-C-N', 'AC_Phase-C_Current', '*'],
-            }
-
-        calculated_parameters_symo = {
-            "PV_Power" : ['MPPT_1_DC_Power', 'MPPT_2_DC_Power', '+'],
-            "AC_Output_L1" : ['AC_Voltage_Phase-A-N', 'AC_Phase-A_Current', '*'],
-            "AC_Output_L2" : ['AC_Voltage_Phase-B-N', 'AC_Phase-B_Current', '*'],
-            "AC_Output_L3" : ['AC_Voltage_Phase-C-N', 'AC_Phase-C_Current', '*'],
-            }
-
-        self.modbus.unit_id = 1
-        sunspecid = self.read_uint16(40070)
-        if sunspecid != 113:
-            logging.warning("Warning: Invalid SunspecID, wrong device ?")
+        self.registers = {}
+        self.calculated_parameters = {}
+        self.expressions = ExpressionGraph({}, [])
+        # Added with add_calculated(), kept when the register map changes
+        self.user_calculated = {}
+        # tuple of parameters (None = all) : DecodePlan
+        self.decode_plans = {}
+        self.decode_plans_max = 32
 
+    # Pick the register map, devicename is only used for autodetect
+    def select_registers(self, devicename):
+        self.decode_plans = {}
         if self.model == "autodetect":
-            self.name = self.read_string(40021, 16)
+            self.name = devicename
             if self.name == None:
                 logging.error("Error, could not identify Fronius device")
             elif "GEN24" in self.name:
                 self.registers = registers_gen24
-                self.calculated_parameters = calculated_parameters_gen24
+                self.select_calculated(calculated_parameters_gen24)
             else:
                 self.registers = registers_symo
-                self.calculated_parameters = calculated_parameters_symo
+                self.select_calculated(calculated_parameters_symo)
         elif self.model == "symo_gen24":
             self.name = "Symo GEN24 forced"
             self.registers = registers_gen24
-            self.calculated_parameters = calculated_parameters_gen24
+            self.select_calculated(calculated_parameters_gen24)
         elif self.model == "symo":
             self.name = "Symo forced"
             self.registers = registers_symo
-            self.calculated_parameters = calculated_parameters_symo
+            self.select_calculated(calculated_parameters_symo)
         else:
             logging.error("Error: Unkown symo model")
-                                      
+
+    # Register map from discovered models, {unit id : {model id : [address, length]}}
+    def select_sunspec_registers(self, models_by_unit, devicename):
+        self.decode_plans = {}
+        self.name = devicename
+        self.registers = sunspec.build_registers(models_by_unit)
+        if "Sunspec_Battery_ID" in self.registers:
+            self.select_calculated(calculated_parameters_gen24)
+        else:
+            self.select_calculated(calculated_parameters_symo)
+
+    # Compile the calculated values, the ones using registers the device doesn't have are left out
+    def select_calculated(self, definitions):
+        definitions = dict(definitions)
+        definitions.update(self.user_calculated)
+        self.expressions = ExpressionGraph(definitions, self.registers.keys())
+        self.calculated_parameters = self.expressions.definitions
+
+    # Add (or replace) a calculated value, raises ValueError for an invalid formula
+    def add_calculated(self, name, formula):
+        if name in self.registers:
+            raise ValueError("{0} is a register".format(name))
+        parse_formula(formula)
+        user_calculated = dict(self.user_calculated)
+        user_calculated[name] = formula
+        definitions = dict(self.calculated_parameters)
+        definitions.update(user_calculated)
+        expressions = ExpressionGraph(definitions, self.registers.keys())
+        if name not in expressions:
+            raise ValueError("{0} needs registers the device doesn't have".format(name))
+        self.user_calculated = user_calculated
+        self.expressions = expressions
+        self.calculated_parameters = expressions.definitions
+
+    # Discovered model chain for every unit id, from cache if the device is known
+    def discover_models(self, common_regs):
+        identity = sunspec.identify(common_regs)
+        if identity is None:
+            logging.error("Error, no SunSpec common model found")
+            return [None, None]
+
+        models_by_unit = sunspec.load_cache(self.sunspec_cache, identity)
+        if models_by_unit is not None:
+            logging.info("Using cached SunSpec models for {0} {1}".format(identity[0], identity[2]))
+        return [identity, models_by_unit]
+
+    # Use the walked model chains, False if a failed read left one incomplete.
+    # Cached only if complete, a transient error must not drop the meter or
+    # the storage model until the firmware changes.
+    def select_walked_models(self, identity, models_by_unit):
+        if any(models is None for models in models_by_unit.values()):
+            logging.error("SunSpec model chain of {0} incomplete, not used".format(identity[0]))
+            return False
+        logging.info("Discovered SunSpec models {0}".format({unit_id : list(models.keys()) for unit_id, models in models_by_unit.items()}))
+        if models_by_unit[sunspec.inverter_unit_id]:
+            sunspec.save_cache(self.sunspec_cache, identity, models_by_unit)
+        self.select_sunspec_registers(models_by_unit, identity[0])
+        return True
+
+    def invalidate_scalefactors(self, unit_id=None):
+        if unit_id is None:
+            self.sf_cache = {}
+        else:
+            for key in list(self.sf_cache.keys()):
+                if key[0] == unit_id:
+                    del self.sf_cache[key]
+
+    def cached_scalefactor(self, unit_id, addr):
+        entry = self.sf_cache.get((unit_id, addr))
+        if entry is None:
+            return None
+        if self.sf_ttl is not None and time.monotonic() - entry[1] > self.sf_ttl:
+            del self.sf_cache[(unit_id, addr)]
+            return None
+        return [entry[0]]
+
+    def store_scalefactor(self, unit_id, addr, scalereg):
+        self.sf_cache[(unit_id, addr)] = [scalereg[0], time.monotonic()]
+
+    def decode_uint16(self, regs, addr):
+        if regs[0] == 0xffff:
+            logging.error("read_uint16() - invalid value/no data - addr: {0}".format(addr))
+            return None
+        else:
+            return int(regs[0])
+
+    def decode_uint32(self, regs, addr):
+        if regs[0] == 0xffff and regs[1] == 0xffff:
+            logging.error("read_uint32() - invalid value/no data - addr: {0}".format(addr))
+            return None
+        else:
+            return int(utils.word_list_to_long(regs, big_endian=True)[0])
+
+    def decode_float(self, regs, addr):
+        list_32_bits = utils.word_list_to_long(regs, big_endian=True)
+        value = float(utils.decode_ieee(list_32_bits[0]))
+        if math.isnan(value):
+            return None
+        else:
+            return value
+
+    def decode_scalefactor(self, scalereg):
+        if scalereg[0] > 32768:   # Bad hack for int16 conversion
+            return 10**(scalereg[0]-65536)
+        else:
+            return 10**(scalereg[0])
+
+    def decode_uint16_sunssf(self, value, scalereg, addrs):
+        if scalereg[0] == 0x8000:
+            logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
+            return None
+        elif value[0] == 0xffff:
+            logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
+            return None
+        scalef = self.decode_scalefactor(scalereg)
+        return float(value[0] * scalef)
+
+    def decode_int16_sunssf(self, value, scalereg, addrs):
+        if scalereg[0] == 0x8000:
+            logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
+            return None
+        elif value[0] == 0xffff:
+            logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
+            return None
+        scalef = self.decode_scalefactor(scalereg)
+        value = value[0]
+        if value >= 0x8000:
+            value = value - 0x10000
+        return float(value * scalef)
+
+    def decode_acc32_sunssf(self, regs, scalereg, addrs):
+        value = int(utils.word_list_to_long(regs, big_endian=True)[0])
+        if scalereg[0] == 0x8000:
+            logging.error("read_acc32_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
+            return None
+        elif value == 0xffffffff:
+            logging.error("read_acc32_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
+            return None
+        scalef = self.decode_scalefactor(scalereg)
+        return float(value * scalef)
+
+    def decode_string(self, regs):
+        result = ''
+        for reg in regs:
+            if reg == 0:
+                break
+            result += (chr((reg>>8) & 0xff))
+            result += (chr(reg & 0xff))
+        if result == '':
+            return False
+        else:
+            return result
+
+    # List of [address, count] a parameter needs, including the scale factor register
+    # unless it is already cached
+    def parameter_spans(self, parameter, with_cached=False):
+        [register, datatype, unit_id] = self.registers[parameter]
+        if type(register) is list:
+            if datatype == 'acc32_sunssf':
+                spans = [[register[0], 2]]
+            else:
+                spans = [[register[0], 1]]
+            if with_cached or self.cached_scalefactor(unit_id, register[1]) is None:
+                spans.append([register[1], 1])
+            return spans
+        elif datatype in datatype_size:
+            return [[register, datatype_size[datatype]]]
+        else:
+            return []
+
+    # Group parameters by unit id into blocks of at most max_read_registers
+    def plan_reads(self, parameters=None, max_count=max_read_registers, with_cached=False):
+        if parameters is None:
+            parameters = self.get_all_parameters()
+
+        spans_by_unit = {}
+        for name in parameters:
+            unit_id = self.registers[name][2]
+            for [addr, count] in self.parameter_spans(name, with_cached):
+                spans_by_unit.setdefault(unit_id, []).append([addr, count, name])
+
+        blocks = []
+        for unit_id in sorted(spans_by_unit.keys()):
+            block = None
+            for [addr, count, name] in sorted(spans_by_unit[unit_id], key=lambda span: span[0]):
+                end = addr + count
+                if block and end - block.start <= max_count:
+                    block.count = max(block.count, end - block.start)
+                else:
+                    block = RegisterBlock(unit_id, addr, count, [])
+                    blocks.append(block)
+                if name not in block.parameters:
+                    block.parameters.append(name)
+        return blocks
+
+    # Compiled once per parameter list, always includes the scale factor registers
+    def decode_plan(self, parameters=None):
+        key = None if parameters is None else tuple(parameters)
+        plan = self.decode_plans.get(key)
+        if plan is None:
+            if parameters is None:
+                parameters = self.get_all_parameters()
+            blocks = [[block.unit_id, block.start, block.count] for block in self.plan_reads(parameters, with_cached=True)]
+            plan = DecodePlan(self.registers, parameters, blocks)
+            if len(self.decode_plans) >= self.decode_plans_max:
+                del self.decode_plans[next(iter(self.decode_plans))]
+            self.decode_plans[key] = plan
+        return plan
+
+    def decode_buffers(self, plan, buffers):
+        for [unit_id, addr, raw] in plan.read_scalefactors(buffers):
+            self.store_scalefactor(unit_id, addr, [raw])
+        return plan.decode(buffers)
+
+    def calculate_value(self, parameter, values):
+        return self.expressions.evaluate(values, [parameter])[parameter]
+
+    # Registers needed to calculate the given parameters
+    def snapshot_registers(self, parameters):
+        calculated = [name for name in parameters if name in self.calculated_parameters]
+        registers = [name for name in parameters if name in self.registers]
+        for operand in self.expressions.required_registers(calculated):
+            if operand not in registers:
+                registers.append(operand)
+        return registers
+
+    def build_snapshot(self, timestamp, parameters, values):
+        calculated = [name for name in parameters if name in self.calculated_parameters]
+        if calculated:
+            values.update(self.expressions.evaluate(values, calculated))
+        return SymoSnapshot(timestamp, values)
+
+    def get_all_parameters(self):
+        return list(self.registers.keys())
+
+    def get_all_calculated(self):
+        return list(self.calculated_parameters.keys())
+
+
+class Symo(SymoBase):
+    def __init__(self, ipaddr, model="autodetect", sf_ttl=None, persistent=False,
+                 reconnect_delay=1.0, reconnect_delay_max=60.0, timeout=5.0,
+                 sunspec_cache=sunspec.default_cache_dir, port=502, control_max_age=300.0, control_verify=False):
+        self.ipaddr = ipaddr
+        self.persistent = persistent
+        if persistent:
+            self.modbus = ModbusClient(host=ipaddr, port=port, timeout=timeout, auto_open=False, auto_close=False)
+        else:
+            self.modbus = ModbusClient(host=ipaddr, port=port, timeout=timeout, auto_open=True, auto_close=True)
+        SymoBase.__init__(self, model=model, sf_ttl=sf_ttl, sunspec_cache=sunspec_cache)
+        # self.modbus.debug(True)
+
+        # Persistent mode: reconnect with exponential backoff after failures
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_delay_max = reconnect_delay_max
+        self.next_connect_delay = reconnect_delay
+        self.next_connect_time = 0.0
+        self.was_connected = False
+        self.stats = {
+            'requests' : 0,
+            'failed_requests' : 0,
+            'connects' : 0,
+            'connect_failures' : 0,
+            'reconnects' : 0,
+            'dead_sockets' : 0,
+            'connected_since' : None,
+        }
+        # Modbus exception code of the last request, None if there was no exception reply
+        self.last_exception = None
+
+        # Latency histograms, byte and error counters
+        self.metrics = ModbusMetrics()
+
+        # Last applied battery/connection control state
+        self.battery_control = BatteryControl(self, max_age=control_max_age, verify=control_verify)
+
+        self.detect_model()
+
+    def detect_model(self):
+        self.invalidate_scalefactors()
+        self.battery_control.invalidate()
+
+        if self.model == "sunspec":
+            self.detect_sunspec_models()
+            return
+
+        self.modbus.unit_id = 1
+        sunspecid = self.read_uint16(40070)
+        if sunspecid != 113:
+            logging.warning("Warning: Invalid SunspecID, wrong device ?")
+
+        if self.model == "autodetect":
+            self.select_registers(self.read_string(40021, 16))
+        else:
+            self.select_registers(None)
+
+    def detect_sunspec_models(self, use_cache=True):
+        self.modbus.unit_id = sunspec.inverter_unit_id
+        common_regs = self.read_block(sunspec.sunspec_start, sunspec.common_block_size)
+        [identity, models_by_unit] = self.discover_models(common_regs)
+        if identity is None:
+            return
+
+        if models_by_unit is None or not use_cache:
+            models_by_unit = {}
+            for unit_id in [sunspec.inverter_unit_id, sunspec.meter_unit_id]:
+                models_by_unit[unit_id] = sunspec.run_sync(sunspec.walk_model_chain(unit_id), self.read_unit_block)
+            self.select_walked_models(identity, models_by_unit)
+            return
+
+        self.select_sunspec_registers(models_by_unit, identity[0])
+
+    # Registers for walk_model_chain, None if the unit or address doesn't exist
+    def read_unit_block(self, unit_id, addr, count):
+        self.modbus.unit_id = unit_id
+        regs = self.read_block(addr, count)
+        if regs is False and self.last_exception in sunspec.missing_exceptions:
+            return None
+        return regs
+
+    def connect(self, force=False):
+        if self.modbus.is_open:
+            return True
+        now = time.monotonic()
+        if not force and now < self.next_connect_time:
+            return False
+
+        if self.modbus.open():
+            self.stats['connects'] += 1
+            self.stats['connected_since'] = time.time()
+            if self.was_connected:
+                self.stats['reconnects'] += 1
+                logging.info("Reconnected to {0}".format(self.ipaddr))
+                # Could be a restarted/updated inverter
+                self.invalidate_scalefactors()
+                self.battery_control.invalidate()
+            self.was_connected = True
+            self.next_connect_delay = self.reconnect_delay
+            self.next_connect_time = 0.0
+            return True
+        else:
+            self.stats['connect_failures'] += 1
+            logging.error("Could not connect to {0}, retry in {1:.1f}s".format(self.ipaddr, self.next_connect_delay))
+            self.next_connect_time = now + self.next_connect_delay
+            self.next_connect_delay = min(self.next_connect_delay * 2, self.reconnect_delay_max)
+            return False
+
+    def close(self):
+        self.modbus.close()
+        self.stats['connected_since'] = None
+
+    def connection_stats(self):
+        stats = dict(self.stats)
+        stats['persistent'] = self.persistent
+        stats['connected'] = bool(self.modbus.is_open)
+        return stats
+
+    # Connection counters and Modbus metrics, see modbus_metrics.py
+    def modbus_metrics(self):
+        metrics = self.metrics.snapshot()
+        metrics['connection'] = self.connection_stats()
+        return metrics
+
+    def write_metrics(self, influxdb, location, prefix="modbus_"):
+        connection = {name : self.stats[name] for name in ['connects', 'connect_failures', 'reconnects', 'dead_sockets']}
+        self.metrics.write_influxdb(influxdb, location, prefix, connection)
+
+    def timed_request(self, function, args):
+        self.stats['requests'] += 1
+        start = time.perf_counter()
+        result = function(*args)
+        self.metrics.observe_client(self.modbus, function.__name__, args, time.perf_counter() - start, result)
+        return result
+
+    # All Modbus traffic goes through here
+    def modbus_request(self, function, *args):
+        self.last_exception = None
+        if self.persistent and not self.connect():
+            self.stats['failed_requests'] += 1
+            return None
+
+        result = self.timed_request(function, args)
+
+        # Reads return None, writes False on errors
+        if result in (None, False) and self.persistent and self.modbus.last_error in connection_errors:
+            # Dead socket, reconnect once and repeat the request
+            logging.warning("Modbus connection to {0} lost: {1}".format(self.ipaddr, self.modbus.last_error_as_txt))
+            self.stats['dead_sockets'] += 1
+            self.close()
+            if self.connect(force=True):
+                result = self.timed_request(function, args)
+
+        if result in (None, False):
+            self.stats['failed_requests'] += 1
+            if self.modbus.last_error == MB_EXCEPT_ERR:
+                # The device answered, with a Modbus exception code
+                self.last_exception = self.modbus.last_except
+        return result
+
+    def read_holding_registers(self, addr, count):
+        return self.modbus_request(self.modbus.read_holding_registers, addr, count)
+
+    def write_single_register(self, addr, value):
+        return self.modbus_request(self.modbus.write_single_register, addr, value)
+
+    def write_multiple_registers(self, addr, values):
+        return self.modbus_request(self.modbus.write_multiple_registers, addr, values)
+
+    # Scale factor register of the current unit id, from cache if possible
+    def read_scalefactor(self, addr):
+        unit_id = self.modbus.unit_id
+        scalereg = self.cached_scalefactor(unit_id, addr)
+        if scalereg is None:
+            scalereg = self.read_holding_registers(addr-1, 1)
+            if scalereg:
+                self.store_scalefactor(unit_id, addr, scalereg)
+        return scalereg
+
     def read_uint16(self, addr):
-        regs = self.modbus.read_holding_registers(addr-1, 2)
+        regs = self.read_holding_registers(addr-1, 2)
         if regs:
-            if regs[0] == 0xffff:
-                logging.error("read_uint16() - invalid value/no data - addr: {0}".format(addr))
-                return None
-            else:
-                return int(regs[0])
+            return self.decode_uint16(regs, addr)
         else:
             logging.error("read_uint16() - error")
             return False
-      
+
     def read_uint32(self, addr):
-        regs = self.modbus.read_holding_registers(addr-1, 2)
+        regs = self.read_holding_registers(addr-1, 2)
         if regs:
-            if regs[0] == 0xffff and regs[1] == 0xffff:
-                logging.error("read_uint32() - invalid value/no data - addr: {0}".format(addr))
-                return None
-            else:
-                return int(utils.word_list_to_long(regs, big_endian=True)[0])
+            return self.decode_uint32(regs, addr)
         else:
             logging.error("read_uint32() - error - addr: {0}".format(addr))
             return False
-        
+
     def read_float(self, addr):
-        regs = self.modbus.read_holding_registers(addr-1, 2)
+        regs = self.read_holding_registers(addr-1, 2)
         if not regs:
             logging.error("read_float() - error - addr: {0}".format(addr))
             return False
-
-        list_32_bits = utils.word_list_to_long(regs, big_endian=True)
-        value = float(utils.decode_ieee(list_32_bits[0]))
-        if math.isnan(value):
-            return None
-        else:
-            return value
+        return self.decode_float(regs, addr)
 
     def read_uint16_sunssf(self, addrs):
-        value = self.modbus.read_holding_registers(addrs[0]-1, 1)
-        scalereg = self.modbus.read_holding_registers(addrs[1]-1, 1)
+        value = self.read_holding_registers(addrs[0]-1, 1)
+        scalereg = self.read_scalefactor(addrs[1])
         # logging.info(value[0],scalereg[0])
         if value and scalereg:
-            if scalereg[0] == 0x8000:
-                logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
-                return None
-            elif value[0] == 0xffff:
-                logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
-                return None
-            elif scalereg[0] > 32768:   # Bad hack for int16 conversion
-                scalef = 10**(scalereg[0]-65536)
-            else:
-                scalef = 10**(scalereg[0])
-            return float(value[0] * scalef)
+            return self.decode_uint16_sunssf(value, scalereg, addrs)
         else:
             logging.error("read_uint16_sunssf() - error - addr: {0}".format(addrs[0]))
             return False
 
     def read_int16_sunssf(self, addrs):
-        value = self.modbus.read_holding_registers(addrs[0]-1, 1)
-        scalereg = self.modbus.read_holding_registers(addrs[1]-1, 1)
+        value = self.read_holding_registers(addrs[0]-1, 1)
+        scalereg = self.read_scalefactor(addrs[1])
         # logging.info(value[0],scalereg[0])
         if value and scalereg:
-            if scalereg[0] == 0x8000:
-                logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
-                return None
-            elif value[0] == 0xffff:
-                logging.error("read_uint16_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
-                return None
-            elif scalereg[0] > 32768:   # Bad hack for int16 conversion
-                scalef = 10**(scalereg[0]-65536)
-            else:
-                scalef = 10**(scalereg[0])
-            if value[0] > 0x8000:
-                value[0] = value[0] - 0xffff
-            return float(value[0] * scalef)
+            return self.decode_int16_sunssf(value, scalereg, addrs)
         else:
             logging.error("read_int16_sunssf() - error - addr: {0}".format(addrs[0]))
             return False
 
     def read_acc32_sunssf(self, addrs):
-        regs = self.modbus.read_holding_registers(addrs[0]-1, 2)
-        value = int(utils.word_list_to_long(regs, big_endian=True)[0])
-        scalereg = self.modbus.read_holding_registers(addrs[1]-1, 1)
+        regs = self.read_holding_registers(addrs[0]-1, 2)
+        scalereg = self.read_scalefactor(addrs[1])
         # logging.info(regs,scalereg[0])
         if regs and scalereg:
-            if scalereg[0] == 0x8000:
-                logging.error("read_acc32_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
-                return None
-            elif value == 0xffffffff:
-                logging.error("read_acc32_sunssf() - invalid value/no data - addr: {0}".format(addrs[0]))
-                return None
-            elif scalereg[0] > 32768:   # Bad hack for int16 conversion
-                scalef = 10**(scalereg[0]-65536)
-            else:
-                scalef = 10**(scalereg[0])
-            return float(value * scalef)
+            return self.decode_acc32_sunssf(regs, scalereg, addrs)
         else:
             logging.error("read_acc32_sunssf() - error - addr: {0}".format(addrs[0]))
             return False
 
     def read_string(self, addr, size):
-        regs = self.modbus.read_holding_registers(addr-1, size)
+        regs = self.read_holding_registers(addr-1, size)
         if regs:
-            result = ''
-            for i in range(size):
-                if regs[i] == 0:
-                    break
-                result += (chr((regs[i]>>8) & 0xff))
-                result += (chr(regs[i] & 0xff))
-            if result == '':
-                return False
-            else:
-                return result
+            return self.decode_string(regs)
+
+    def read_block(self, addr, count):
+        regs = self.read_holding_registers(addr-1, count)
+        if not regs or len(regs) != count:
+            logging.error("read_block() - error - unit: {0} addr: {1} count: {2}".format(self.modbus.unit_id, addr, count))
+            return False
+        return regs
+
+    # Read several parameters with as few Modbus requests as possible
+    def read_record(self, parameters=None):
+        plan = self.decode_plan(parameters)
+        buffers = []
+        for [unit_id, start, count] in plan.blocks:
+            self.modbus.unit_id = unit_id
+            regs = self.read_block(start, count)
+            buffers.append(regs if regs else None)
+        return self.decode_buffers(plan, buffers)
+
+    def read_parameters(self, parameters=None):
+        return self.read_record(parameters).as_dict()
 
     def read_data(self, parameter):
         [register, datatype, unit_id] = self.registers[parameter]
@@ -327,56 +820,55 @@ class Symo:
             return self.read_string(register, 16)
         else:
             return False
-        
-    def read_calculated_value(self, parameter):
-        [param1, param2, operant] = self.calculated_parameters[parameter]
-
-        try:
-            if operant == '+':
-                value = self.read_data(param1) + self.read_data(param2)
-            elif operant == '-':
-                value = self.read_data(param1) - self.read_data(param2)
-            elif operant == '*':
-                value = self.read_data(param1) * self.read_data(param2)
-            elif operant == '/':
-                value = self.read_data(param1) / self.read_data(param2)
-            else:
-                return False
-        except TypeError:
-            return False
 
-        return value
+    # With a snapshot no registers are read
+    def read_calculated_value(self, parameter, snapshot=None):
+        if snapshot is not None:
+            if parameter in snapshot:
+                return snapshot[parameter]
+            return self.calculate_value(parameter, snapshot)
+
+        return self.snapshot([parameter])[parameter]
+
+    # Read all (or the given) registers once and derive the calculated values from them
+    def snapshot(self, parameters=None):
+        if parameters is None:
+            parameters = self.get_all_parameters() + self.get_all_calculated()
+
+        timestamp = datetime.utcnow()
+        values = self.read_parameters(self.snapshot_registers(parameters))
+        return self.build_snapshot(timestamp, parameters, values)
 
     def write_float(self, addr, value):
         floats_list = [value]
         b32_l = [utils.encode_ieee(f) for f in floats_list] 
         b16_l = utils.long_list_to_word(b32_l, big_endian=False)
-        return self.modbus.write_multiple_registers(addr-1, b16_l)
+        return self.write_multiple_registers(addr-1, b16_l)
 
     def write_uint16(self, addr, value):
-        return self.modbus.write_single_register(addr-1, value)
+        return self.write_single_register(addr-1, value)
 
     def write_uint16_sunssf(self, addrs, value):
-        scalereg = self.modbus.read_holding_registers(addrs[1]-1, 1)
-        if scalereg[0] > 32768:   # Bad hack for int16 conversion
-            scalef = 10**(scalereg[0]-65536)
-        else:
-            scalef = 10**(scalereg[0])
+        scalereg = self.read_scalefactor(addrs[1])
+        if not scalereg:
+            logging.error("write_data() - error reading scale factor - addr: {0}".format(addrs[1]))
+            return False
+        scalef = self.decode_scalefactor(scalereg)
         value = int(value / scalef)
-        return self.modbus.write_single_register(addrs[0]-1, value)
+        return self.write_single_register(addrs[0]-1, value)
 
     def write_int16_sunssf(self, addrs, value):
-        scalereg = self.modbus.read_holding_registers(addrs[1]-1, 1)
-        if scalereg[0] > 32768:   # Bad hack for int16 conversion
-            scalef = 10**(scalereg[0]-65536)
-        else:
-            scalef = 10**(scalereg[0])
+        scalereg = self.read_scalefactor(addrs[1])
+        if not scalereg:
+            logging.error("write_data() - error reading scale factor - addr: {0}".format(addrs[1]))
+            return False
+        scalef = self.decode_scalefactor(scalereg)
         value = int(value / scalef)
         if value >= 0:
-            return self.modbus.write_single_register(addrs[0]-1, value)
+            return self.write_single_register(addrs[0]-1, value)
         else:
-            return self.modbus.write_single_register(addrs[0]-1, (0xffff+value) )
-   
+            return self.write_single_register(addrs[0]-1, (0x10000+value) )
+
     def write_data(self, parameter, value):
         [register, datatype, unit_id] = self.registers[parameter]
         
@@ -394,8 +886,9 @@ class Symo:
 
     def print_all(self):
         logging.info("Show all registers:")
+        values = self.read_parameters()
         for name, params in self.registers.items():
-            value = self.read_data(name)
+            value = values[name]
             if value is not None:
                 if type(params[0]) is list:
                     logging.info("{0:d}: {1:s} - {2:2.1f}".format(params[0][0], name, value))
@@ -403,76 +896,63 @@ class Symo:
                     logging.info("{0:d}: {1:s} - {2:s} ".format(params[0], name, value))
                 else:
                     logging.info("{0:d}: {1:s} - {2:2.1f}".format(params[0], name, value))
-                
+
     def print_all_calculated(self):
         logging.info("Show all calculated values:")
+        snapshot = self.snapshot(self.get_all_calculated())
         for name, params in self.calculated_parameters.items():
-            value = self.read_calculated_value(name)
+            value = snapshot[name]
             logging.info("{0:s} - {1:2.1f}".format(name, value))
-        
-    def get_all_parameters(self):
-        return list(self.registers.keys())
 
-    def get_all_calculated(self):
-        return list(self.calculated_parameters.keys())
-    
     # To search for undocument registers.... 
-    def print_raw(self):
-        logging.info("Raw read 1000-2000:")
-        for i in range(40000,40200,1):
-            value = self.read_uint16(i)
-            if value:
-#                logging.info("{0:d}: {1:2.1f}".format(i, value))
-                logging.info("{0:d}: {1:d} (0x{2:x}),".format(i, value,value))
-            #else:
-            #    logging.info("{0:d}: error".format(i))
-        
+    # See register_scan.py for json output and diffs
+    def scan_registers(self, unit_ids=[1], ranges=[[40000, 40200]]):
+        return RegisterScanner(symo_reader(self)).scan(unit_ids, ranges, device=self.name)
+
+    def print_raw(self, unit_ids=[1], ranges=[[40000, 40200]]):
+        logging.info("Raw read {0}:".format(ranges))
+        scan = self.scan_registers(unit_ids, ranges)
+        for unit_id, unit in scan["units"].items():
+            for [addr, value, datatype] in unit["registers"]:
+                if value:
+                    logging.info("{0}/{1:d}: {2:d} (0x{3:x}) {4}".format(unit_id, addr, value, value, datatype))
+
     # See https://loxwiki.atlassian.net/wiki/spaces/LOXEN/pages/1316061809/Fronius+Hybrid+with+Modbus+TCP
     # Positive = Limit Charge Power (Not more than X*100W Charge, depdend on Sun)
     # Negative = Discharge Battery (X * 100W Discharge, House + Grid)
-    def set_battery_charge_rate(self, power):
-        if power == None:
-            logging.info("Disable Battery Charge Limit")
-            reg = self.read_data('Battery_StorCtl_Mod')
-            reg = reg & 0xfffe # clear bit 0
-            self.write_data('Battery_StorCtl_Mod',reg)
-        else:
-            logging.info("Setting Charge limit to {0}".format(power))
-            reg = self.read_data('Battery_StorCtl_Mod')
-            reg = reg | 0x1 # set bit 0
-            self.write_data('Battery_StorCtl_Mod',reg)
-            self.write_data('Battery_InWRte', power)
-            
+    # None = Disable Battery Charge Limit
+    # Only changed registers are written, see BatteryControl
+    def set_battery_charge_rate(self, power, verify=None):
+        self.battery_control.set_charge_rate(power)
+        return self.battery_control.commit(verify)
+
     # Positive = Limit Discharge Power (Not more than X*100W Discharge, depend on need)
     # Negative = Force Loading of Battery (Charge X*100W into Battery)
-    def set_battery_discharge_rate(self, power):
-        if power == None:
-            logging.info("Disable Battery discharge Limit")
-            reg = self.read_data('Battery_StorCtl_Mod')
-            reg = reg & 0xfffd # clear bit 0
-            self.write_data('Battery_StorCtl_Mod',reg)
-        else:
-            logging.info("Setting discharge limit to {0}".format(power))
-            reg = self.read_data('Battery_StorCtl_Mod')
-            reg = reg | 0x2 # set bit 1
-            self.write_data('Battery_StorCtl_Mod',reg)
-            self.write_data('Battery_OutWRte', power)
+    def set_battery_discharge_rate(self, power, verify=None):
+        self.battery_control.set_discharge_rate(power)
+        return self.battery_control.commit(verify)
+
+    # Both limits with one commit
+    def set_battery_rates(self, charge, discharge, verify=None):
+        self.battery_control.set_charge_rate(charge)
+        self.battery_control.set_discharge_rate(discharge)
+        return self.battery_control.commit(verify)
 
     #
     def enable(self, enable=True, auto=False):
         if auto==True:
             if self.read_data("MPPT_1_DC_Voltage") < 70 and self.read_data("MPPT_2_DC_Voltage") < 70:
                 logging.info("Low voltage on Gen24, switch off")
-                self.write_data("Control_conn",0)
+                self.battery_control.set_connected(False)
+                self.battery_control.commit()
 
             elif self.read_data("MPPT_1_DC_Voltage") > 120 or self.read_data("MPPT_2_DC_Voltage") > 160:
                 logging.info("minimal voltage on Gen24 reached, switch on")
-                self.write_data("Control_conn",1)
+                self.battery_control.set_connected(True)
+                self.battery_control.commit()
         else:
-            if enable == True:
-                self.write_data("Control_conn",1)
-            else:
-                self.write_data("Control_conn",0)
+            self.battery_control.set_connected(enable == True)
+            self.battery_control.commit()
 
     # Does not really work?
     def trigger_isolation_measurement(self):
@@ -488,7 +968,6 @@ class Symo:
         self.write_uint16(40242,1)
         logging.info(self.read_uint16(40246))
 
-    
 # Test area
 if __name__ == "__main__":
     import argparse
@@ -505,9 +984,21 @@ if __name__ == "__main__":
     argparser.add_argument("-t", "--test", help="Enable Test functions",
                            action='store_true')
 
+    argparser.add_argument("-m", "--model", help="autodetect, symo, symo_gen24 or sunspec",
+                           default='autodetect', action='store')
+
+    argparser.add_argument("-p", "--port", help="Modbus TCP port",
+                           default=502, type=int, action='store')
+
+    argparser.add_argument("-c", "--calculated", help="Additional calculated value(s), NAME=FORMULA",
+                           default=[], nargs='+', action='store')
+
     args = argparser.parse_args()
     
-    symo = Symo(ipaddr=args.address)
+    symo = Symo(ipaddr=args.address, model=args.model, port=args.port)
+    for definition in args.calculated:
+        [name, formula] = definition.split('=', 1)
+        symo.add_calculated(name.strip(), formula)
     
     if args.dump:
         symo.print_all()
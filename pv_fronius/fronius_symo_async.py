@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline, asyncio Modbus TCP client and AsyncSymo
+# V2: Decode with precompiled DecodePlan
+# V3: model="sunspec"
+# V4: read_calculated_value() from a given snapshot
+# V5: Modbus metrics
+# V6: SunSpec chains are only used and cached when no read of the walk failed
+
+# Same register maps, planner and calculated values as Symo, but based on
+# asyncio streams. Many inverters can be polled from one event loop, requests
+# per device are limited by max_inflight.
+
+import time
+import asyncio
+import struct
+import logging
+from datetime import datetime
+
+from pv_fronius.fronius_symo import SymoBase
+from pv_fronius import sunspec
+from pv_fronius.modbus_metrics import ModbusMetrics, function_names
+from pyModbusTCP.constants import MB_TIMEOUT_ERR, MB_EXCEPT_ERR, MB_CONNECT_ERR, MB_RECV_ERR
+
+
+class AsyncModbusClient:
+    def __init__(self, host, port=502, timeout=5.0, max_inflight=1, metrics=None):
+        self.host = host
+        self.metrics = metrics
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.receiver = None
+        self.transaction_id = 0
+        # transaction id : future waiting for the response pdu
+        self.pending = {}
+        self.inflight = asyncio.Semaphore(max_inflight)
+        self.connect_lock = asyncio.Lock()
+        # Modbus exception code of the last request, 0 = no exception reply
+        self.last_except = 0
+
+    @property
+    def is_open(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def open(self):
+        async with self.connect_lock:
+            if self.is_open:
+                return True
+            try:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                logging.error("Could not connect to {0}: {1}".format(self.host, e))
+                self.reader = None
+                self.writer = None
+                return False
+            self.receiver = asyncio.ensure_future(self.receive_loop())
+            return True
+
+    async def close(self):
+        if self.receiver:
+            self.receiver.cancel()
+            self.receiver = None
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+            self.reader = None
+        self.fail_pending(ConnectionError("connection closed"))
+
+    def fail_pending(self, error):
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending = {}
+
+    async def receive_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(7)
+                [transaction_id, protocol_id, length, unit_id] = struct.unpack('>HHHB', header)
+                pdu = await self.reader.readexactly(length - 1)
+                future = self.pending.pop(transaction_id, None)
+                if future and not future.done():
+                    future.set_result(pdu)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logging.error("Connection to {0} lost: {1}".format(self.host, e))
+            if self.writer:
+                self.writer.close()
+            self.fail_pending(ConnectionError("connection lost"))
+
+    def observe(self, unit_id, pdu, start, response, error=None):
+        if self.metrics is None:
+            return
+        function = function_names.get(pdu[0], str(pdu[0]))
+        exception = None
+        registers = 0
+        if response is not None and response[0] & 0x80:
+            error = MB_EXCEPT_ERR
+            exception = response[1]
+            response = None
+        elif response is not None:
+            if pdu[0] == 0x03:
+                registers = response[1] // 2
+            else:
+                registers = struct.unpack('>H', pdu[3:5])[0] if pdu[0] == 0x10 else 1
+        address = struct.unpack('>H', pdu[1:3])[0] + 1 if error is not None else None
+        self.metrics.observe(unit_id, function, time.perf_counter() - start, len(pdu),
+                             len(response) if response is not None else 0, registers,
+                             error, exception, address)
+
+    async def request(self, unit_id, pdu):
+        async with self.inflight:
+            self.last_except = 0
+            start = time.perf_counter()
+            if not self.is_open and not await self.open():
+                self.observe(unit_id, pdu, start, None, MB_CONNECT_ERR)
+                return None
+
+            self.transaction_id = (self.transaction_id + 1) & 0xffff
+            transaction_id = self.transaction_id
+            future = asyncio.get_running_loop().create_future()
+            self.pending[transaction_id] = future
+
+            try:
+                self.writer.write(struct.pack('>HHHB', transaction_id, 0, len(pdu) + 1, unit_id) + pdu)
+                await self.writer.drain()
+                response = await asyncio.wait_for(future, self.timeout)
+            except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+                logging.error("Request to {0} failed: {1}".format(self.host, repr(e)))
+                self.pending.pop(transaction_id, None)
+                self.observe(unit_id, pdu, start, None, MB_TIMEOUT_ERR if isinstance(e, asyncio.TimeoutError) else MB_RECV_ERR)
+                # Stream state is unknown now, start over with a new connection
+                await self.close()
+                return None
+
+        self.observe(unit_id, pdu, start, response)
+        if response[0] & 0x80:
+            self.last_except = response[1]
+            return None
+        if response[0] != pdu[0]:
+            return None
+        return response
+
+    async def read_holding_registers(self, unit_id, reg_addr, reg_nb=1):
+        response = await self.request(unit_id, struct.pack('>BHH', 0x03, reg_addr, reg_nb))
+        if response is None:
+            return None
+        byte_count = response[1]
+        if byte_count != 2 * reg_nb or len(response) < 2 + byte_count:
+            return None
+        return list(struct.unpack('>{0}H'.format(reg_nb), response[2:2 + byte_count]))
+
+    async def write_single_register(self, unit_id, reg_addr, reg_value):
+        response = await self.request(unit_id, struct.pack('>BHH', 0x06, reg_addr, reg_value))
+        return response is not None
+
+    async def write_multiple_registers(self, unit_id, regs_addr, regs_value):
+        pdu = struct.pack('>BHHB', 0x10, regs_addr, len(regs_value), 2 * len(regs_value))
+        pdu += struct.pack('>{0}H'.format(len(regs_value)), *regs_value)
+        response = await self.request(unit_id, pdu)
+        return response is not None
+
+
+class AsyncSymo(SymoBase):
+    def __init__(self, ipaddr, model="autodetect", sf_ttl=None, port=502, timeout=5.0, max_inflight=1,
+                 sunspec_cache=sunspec.default_cache_dir):
+        SymoBase.__init__(self, model=model, sf_ttl=sf_ttl, sunspec_cache=sunspec_cache)
+        self.ipaddr = ipaddr
+        self.metrics = ModbusMetrics()
+        self.modbus = AsyncModbusClient(ipaddr, port=port, timeout=timeout, max_inflight=max_inflight, metrics=self.metrics)
+
+    @classmethod
+    async def create(cls, ipaddr, **kwargs):
+        symo = cls(ipaddr, **kwargs)
+        await symo.detect_model()
+        return symo
+
+    async def close(self):
+        await self.modbus.close()
+
+    def modbus_metrics(self):
+        return self.metrics.snapshot()
+
+    def write_metrics(self, influxdb, location, prefix="modbus_"):
+        self.metrics.write_influxdb(influxdb, location, prefix)
+
+    async def detect_model(self):
+        self.invalidate_scalefactors()
+
+        if self.model == "sunspec":
+            await self.detect_sunspec_models()
+            return
+
+        # Devicename (40021) up to the inverter model id (40070) in one request
+        regs = await self.read_block(1, 40021, 50)
+        if regs is False:
+            sunspecid = None
+            devicename = None
+        else:
+            sunspecid = self.decode_uint16(regs[49:50], 40070)
+            devicename = self.decode_string(regs[0:16])
+
+        if sunspecid != 113:
+            logging.warning("Warning: Invalid SunspecID, wrong device ?")
+
+        if self.model == "autodetect":
+            self.select_registers(devicename)
+        else:
+            self.select_registers(None)
+
+    async def detect_sunspec_models(self, use_cache=True):
+        common_regs = await self.read_block(sunspec.inverter_unit_id, sunspec.sunspec_start, sunspec.common_block_size)
+        [identity, models_by_unit] = self.discover_models(common_regs)
+        if identity is None:
+            return
+
+        if models_by_unit is None or not use_cache:
+            models_by_unit = {}
+            for unit_id in [sunspec.inverter_unit_id, sunspec.meter_unit_id]:
+                models_by_unit[unit_id] = await sunspec.run_async(sunspec.walk_model_chain(unit_id), self.read_unit_block)
+            self.select_walked_models(identity, models_by_unit)
+            return
+
+        self.select_sunspec_registers(models_by_unit, identity[0])
+
+    # Registers for walk_model_chain, None if the unit or address doesn't exist
+    async def read_unit_block(self, unit_id, addr, count):
+        regs = await self.read_block(unit_id, addr, count)
+        if regs is False and self.modbus.last_except in sunspec.missing_exceptions:
+            return None
+        return regs
+
+    async def read_block(self, unit_id, addr, count):
+        regs = await self.modbus.read_holding_registers(unit_id, addr-1, count)
+        if not regs:
+            logging.error("read_block() - error - {0} unit: {1} addr: {2} count: {3}".format(self.ipaddr, unit_id, addr, count))
+            return False
+        return regs
+
+    async def read_record(self, parameters=None):
+        plan = self.decode_plan(parameters)
+        buffers = await asyncio.gather(*[self.read_block(unit_id, start, count) for [unit_id, start, count] in plan.blocks])
+        buffers = [regs if regs else None for regs in buffers]
+        return self.decode_buffers(plan, buffers)
+
+    async def read_parameters(self, parameters=None):
+        record = await self.read_record(parameters)
+        return record.as_dict()
+
+    async def read_data(self, parameter):
+        values = await self.read_parameters([parameter])
+        return values[parameter]
+
+    async def read_calculated_value(self, parameter, snapshot=None):
+        if snapshot is not None:
+            if parameter in snapshot:
+                return snapshot[parameter]
+            return self.calculate_value(parameter, snapshot)
+
+        snapshot = await self.snapshot([parameter])
+        return snapshot[parameter]
+
+    async def snapshot(self, parameters=None):
+        if parameters is None:
+            parameters = self.get_all_parameters() + self.get_all_calculated()
+
+        timestamp = datetime.utcnow()
+        values = await self.read_parameters(self.snapshot_registers(parameters))
+        return self.build_snapshot(timestamp, parameters, values)
+
+    async def read_scalefactor(self, unit_id, addr):
+        scalereg = self.cached_scalefactor(unit_id, addr)
+        if scalereg is None:
+            scalereg = await self.read_block(unit_id, addr, 1)
+            if scalereg:
+                self.store_scalefactor(unit_id, addr, scalereg)
+        return scalereg
+
+    async def write_data(self, parameter, value):
+        [register, datatype, unit_id] = self.registers[parameter]
+
+        if datatype == "uint16":
+            return await self.modbus.write_single_register(unit_id, register-1, value)
+        elif datatype == 'uint16_sunssf' or datatype == 'int16_sunssf':
+            scalereg = await self.read_scalefactor(unit_id, register[1])
+            if not scalereg:
+                logging.error("write_data() - error reading scale factor - addr: {0}".format(register[1]))
+                return False
+            value = int(value / self.decode_scalefactor(scalereg))
+            if value < 0:
+                value = 0x10000 + value
+            return await self.modbus.write_single_register(unit_id, register[0]-1, value)
+        else:
+            return False
+
+
+# Snapshot of every inverter, concurrently. Failed devices return the exception.
+async def poll_fleet(symos, parameters=None):
+    return await asyncio.gather(*[symo.snapshot(parameters) for symo in symos], return_exceptions=True)
+
+
+# Test area
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(format='fronius_symo_async: %(message)s', level=logging.INFO)
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-a", "--address", help="IP address(es) Fronius Symo",
+                           default=['192.168.0.123'], nargs='+', action='store')
+    argparser.add_argument("-p", "--port", help="Modbus TCP port",
+                           default=502, type=int, action='store')
+
+    args = argparser.parse_args()
+
+    async def main():
+        symos = await asyncio.gather(*[AsyncSymo.create(ipaddr, port=args.port) for ipaddr in args.address])
+        start = time.monotonic()
+        snapshots = await poll_fleet(symos)
+        logging.info("Polled {0} inverters in {1:.3f}s".format(len(symos), time.monotonic() - start))
+        for symo, snapshot in zip(symos, snapshots):
+            logging.info("{0} ({1}): {2}".format(symo.ipaddr, symo.name, snapshot))
+        for symo in symos:
+            await symo.close()
+
+    asyncio.run(main())
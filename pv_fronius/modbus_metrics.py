@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+# V2: Buckets below 5ms, quantiles interpolated within the bucket
+
+# Metrics of the Modbus traffic of one device: latency histograms, request,
+# byte and error counters per unit id and function, and the addresses which
+# failed most. Queryable with snapshot(), write_influxdb() writes them as
+# measurements with the given prefix.
+
+import math
+
+from pyModbusTCP.constants import MB_TIMEOUT_ERR, MB_EXCEPT_ERR
+
+# Upper bounds of the latency buckets in seconds, the last one takes the rest
+latency_buckets = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, math.inf]
+
+# MBAP header
+mbap_size = 7
+
+function_names = {
+    0x03 : "read_holding_registers",
+    0x06 : "write_single_register",
+    0x10 : "write_multiple_registers",
+}
+
+# Failed addresses kept per device
+max_failed_addresses = 32
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.counts = [0] * len(latency_buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, seconds):
+        for i, bound in enumerate(latency_buckets):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    # Quantile q, linear within the bucket which contains it. The bounds of the
+    # bucket are narrowed to min/max, so a quantile never leaves the observed range.
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            if count and total + count >= rank:
+                lower = max(latency_buckets[i - 1] if i > 0 else 0.0, self.min)
+                upper = min(latency_buckets[i], self.max)
+                return lower + (upper - lower) * max(rank - total, 0.0) / count
+            total += count
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count' : self.count,
+            'mean' : self.sum / self.count if self.count else None,
+            'min' : self.min,
+            'max' : self.max,
+            'p50' : self.quantile(0.5),
+            'p90' : self.quantile(0.9),
+            'p99' : self.quantile(0.99),
+            'buckets' : list(zip(latency_buckets, self.counts)),
+        }
+
+
+class FunctionMetrics:
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        # Modbus exception code : count
+        self.exceptions = {}
+        self.registers = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def as_dict(self):
+        return {
+            'requests' : self.requests,
+            'errors' : self.errors,
+            'timeouts' : self.timeouts,
+            'exceptions' : dict(self.exceptions),
+            'registers' : self.registers,
+            'bytes_sent' : self.bytes_sent,
+            'bytes_received' : self.bytes_received,
+            'latency' : self.latency.as_dict(),
+        }
+
+
+# [request pdu size, response pdu size, registers] of a request
+def pdu_sizes(function, args, result):
+    if function == "read_holding_registers":
+        count = args[1]
+        return [5, 2 + 2 * count if result else 0, count if result else 0]
+    elif function == "write_single_register":
+        return [5, 5 if result else 0, 1 if result else 0]
+    elif function == "write_multiple_registers":
+        count = len(args[1])
+        return [6 + 2 * count, 5 if result else 0, count if result else 0]
+    return [0, 0, 0]
+
+
+class ModbusMetrics:
+    def __init__(self):
+        # (unit id, function name) : FunctionMetrics
+        self.functions = {}
+        # (unit id, address) : failures
+        self.failed_addresses = {}
+
+    def function_metrics(self, unit_id, function):
+        key = (unit_id, function)
+        metrics = self.functions.get(key)
+        if metrics is None:
+            metrics = FunctionMetrics()
+            self.functions[key] = metrics
+        return metrics
+
+    # error: None if successful, else the pyModbusTCP last_error, exception: Modbus exception code
+    def observe(self, unit_id, function, seconds, request_size, response_size, registers,
+                error=None, exception=None, address=None):
+        metrics = self.function_metrics(unit_id, function)
+        metrics.requests += 1
+        metrics.latency.observe(seconds)
+        metrics.bytes_sent += mbap_size + request_size
+        if response_size:
+            metrics.bytes_received += mbap_size + response_size
+        metrics.registers += registers
+
+        if error is not None:
+            metrics.errors += 1
+            if error == MB_TIMEOUT_ERR:
+                metrics.timeouts += 1
+            elif error == MB_EXCEPT_ERR:
+                metrics.exceptions[exception] = metrics.exceptions.get(exception, 0) + 1
+                # Exception response: function code + exception code
+                metrics.bytes_received += mbap_size + 2
+            if address is not None:
+                self.failed_address(unit_id, address)
+
+    def failed_address(self, unit_id, address):
+        key = (unit_id, address)
+        self.failed_addresses[key] = self.failed_addresses.get(key, 0) + 1
+        if len(self.failed_addresses) > max_failed_addresses:
+            # Forget the address with the fewest failures
+            del self.failed_addresses[min(self.failed_addresses, key=self.failed_addresses.get)]
+
+    # Observe a request given as a function of a pyModbusTCP client
+    def observe_client(self, client, function, args, seconds, result):
+        [request_size, response_size, registers] = pdu_sizes(function, args, result)
+        if result is None or result is False:
+            error = client.last_error
+            exception = client.last_except if error == MB_EXCEPT_ERR else None
+            # Symo addresses start at 1
+            address = args[0] + 1 if args else None
+        else:
+            error = None
+            exception = None
+            address = None
+        self.observe(client.unit_id, function, seconds, request_size, response_size, registers,
+                     error, exception, address)
+
+    def totals(self):
+        totals = FunctionMetrics()
+        for metrics in self.functions.values():
+            totals.requests += metrics.requests
+            totals.errors += metrics.errors
+            totals.timeouts += metrics.timeouts
+            for code, count in metrics.exceptions.items():
+                totals.exceptions[code] = totals.exceptions.get(code, 0) + count
+            totals.registers += metrics.registers
+            totals.bytes_sent += metrics.bytes_sent
+            totals.bytes_received += metrics.bytes_received
+            for i, count in enumerate(metrics.latency.counts):
+                totals.latency.counts[i] += count
+            totals.latency.count += metrics.latency.count
+            totals.latency.sum += metrics.latency.sum
+            for value in [metrics.latency.min, metrics.latency.max]:
+                if value is not None:
+                    if totals.latency.min is None or value < totals.latency.min:
+                        totals.latency.min = value
+                    if totals.latency.max is None or value > totals.latency.max:
+                        totals.latency.max = value
+        return totals
+
+    def snapshot(self):
+        return {
+            'total' : self.totals().as_dict(),
+            'functions' : {"{0}/{1}".format(unit_id, function) : metrics.as_dict()
+                           for [unit_id, function], metrics in sorted(self.functions.items())},
+            'failed_addresses' : sorted([[unit_id, address, count] for [unit_id, address], count in self.failed_addresses.items()],
+                                        key=lambda entry: -entry[2]),
+        }
+
+    def reset(self):
+        self.functions = {}
+        self.failed_addresses = {}
+
+    # [measurement, value] pairs, per unit id/function and total
+    def points(self, prefix="modbus_"):
+        points = []
+        entries = [["total", self.totals()]] + [["{0}_{1}".format(unit_id, function), metrics]
+                                                 for [unit_id, function], metrics in sorted(self.functions.items())]
+        for [name, metrics] in entries:
+            latency = metrics.latency
+            values = [
+                ["requests", metrics.requests],
+                ["errors", metrics.errors],
+                ["timeouts", metrics.timeouts],
+                ["exceptions", sum(metrics.exceptions.values())],
+                ["registers", metrics.registers],
+                ["bytes_sent", metrics.bytes_sent],
+                ["bytes_received", metrics.bytes_received],
+                ["latency_mean", latency.sum / latency.count if latency.count else None],
+                ["latency_p90", latency.quantile(0.9)],
+                ["latency_max", latency.max],
+            ]
+            for [field, value] in values:
+                if value is not None:
+                    points.append(["{0}{1}_{2}".format(prefix, name, field), value])
+        return points
+
+    def write_influxdb(self, influxdb, location, prefix="modbus_", extra=None):
+        points = self.points(prefix)
+        if extra:
+            points += [["{0}{1}".format(prefix, name), value] for name, value in extra.items()]
+        for [measurement, value] in points:
+            influxdb.write_sensordata(location, measurement, value, force=True)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+
+# Poll scheduler, every parameter gets a period from its poll class: static
+# values (nameplate, IDs) are read once, power values every few seconds,
+# energy counters once a minute. Parameters with the same period share one
+# deadline, all parameters due at a tick are read with one snapshot, so the
+# read planner merges them into the fewest block reads. Deadlines are based
+# on time.monotonic().
+
+import time
+import logging
+
+# Format:
+# [part of the parameter name, poll class], first match wins, otherwise default_class
+poll_classes = [
+    ["Sunspec_", "static"],
+    ["Nameplate_", "static"],
+    ["Battery_Max_Charge_Power", "static"],
+    ["Energy", "energy"],
+    ["Efficiency", "energy"],
+    ["Temperature", "state"],
+    ["Operating_State", "state"],
+    ["Battery_SoC", "state"],
+    ["Battery_Status", "state"],
+    ["Battery_StorCtl_Mod", "state"],
+    ["Battery_Min_Reserve", "state"],
+    ["Battery_WChaGra", "state"],
+    ["Battery_WDisChaGra", "state"],
+    ["WRte", "state"],
+    ["Battery_ChaGriSet", "state"],
+    ["Control_conn", "state"],
+]
+default_class = "power"
+
+# Seconds, None = only once (until read successfully)
+poll_periods = {
+    "static" : None,
+    "power" : 5.0,
+    "state" : 30.0,
+    "energy" : 60.0,
+}
+
+
+def poll_class(name):
+    for [part, pclass] in poll_classes:
+        if part in name:
+            return pclass
+    return default_class
+
+
+class PollGroup:
+    def __init__(self, period, names, next_time):
+        self.period = period
+        self.names = names
+        self.next_time = next_time
+
+
+class PollScheduler:
+    def __init__(self, names, periods=poll_periods, clock=time.monotonic):
+        self.clock = clock
+        now = self.clock()
+
+        by_period = {}
+        for name in names:
+            period = periods[poll_class(name)]
+            by_period.setdefault(period, []).append(name)
+        # Fast groups first, the order of the due list only matters for logging
+        self.groups = [PollGroup(period, group_names, now)
+                       for period, group_names in sorted(by_period.items(), key=lambda item: (item[0] is None, item[0] or 0))]
+
+        # Groups returned by the last due()
+        self.pending = []
+
+        self.stats = {
+            'ticks' : 0,
+            'polled' : 0,
+            'late' : 0,
+        }
+
+        for group in self.groups:
+            logging.info("Poll every {0}: {1}".format("once" if group.period is None else "{0}s".format(group.period), ", ".join(group.names)))
+
+    def due_groups(self, now=None):
+        if now is None:
+            now = self.clock()
+        return [group for group in self.groups if group.next_time is not None and group.next_time <= now]
+
+    # Names to read now
+    def due(self, now=None):
+        self.pending = self.due_groups(now)
+        names = []
+        for group in self.pending:
+            names += group.names
+        return names
+
+    # After reading the names of the last due(), values = snapshot (or dict) of the read.
+    # Static groups stay due until all values could be read.
+    def completed(self, values, now=None):
+        if now is None:
+            now = self.clock()
+        groups = self.pending
+        self.pending = []
+        self.stats['ticks'] += 1
+        for group in groups:
+            self.stats['polled'] += len(group.names)
+            if group.period is None:
+                if all(values.get(name) is not False for name in group.names):
+                    group.next_time = None
+                continue
+            group.next_time += group.period
+            if group.next_time <= now:
+                # Fell behind more than one period, don't catch up with a burst
+                self.stats['late'] += 1
+                group.next_time = now + group.period
+
+    def next_deadline(self):
+        deadlines = [group.next_time for group in self.groups if group.next_time is not None]
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    # Seconds until the next group is due
+    def sleep_time(self, now=None, maximum=60.0):
+        if now is None:
+            now = self.clock()
+        deadline = self.next_deadline()
+        if deadline is None:
+            return maximum
+        return min(max(deadline - now, 0.0), maximum)
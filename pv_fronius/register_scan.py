@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+
+# Scanner to search for (undocumented) registers. Address ranges of several
+# unit ids are read with blocks of max_read_registers. A block answered with
+# "illegal data address" is split in halves until the readable registers are
+# found, so gaps in the address space cost only a few extra requests.
+# The result is a json map of address, raw value and a guessed type per
+# register, two maps can be compared to see which registers changed.
+
+import json
+import math
+import struct
+import logging
+from datetime import datetime
+
+from pyModbusTCP.constants import MB_EXCEPT_ERR, EXP_DATA_ADDRESS, EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND
+
+# Modbus limit for one read_holding_registers request
+max_read_registers = 125
+
+# Blocks up to this size are read register by register instead of bisected,
+# an unreadable area costs one request per register anyway
+bisect_min = 8
+
+
+# Guess the data type of every register of a contiguous block:
+# "string", "float" (first register) + "float_lo", "sunssf", "unimplemented", "int16", "uint16"
+def is_printable(reg):
+    high = (reg >> 8) & 0xff
+    low = reg & 0xff
+    return 0x20 <= high < 0x7f and (low == 0 or 0x20 <= low < 0x7f)
+
+def is_float(high, low):
+    if high == 0 and low == 0:
+        return False
+    value = struct.unpack('>f', struct.pack('>HH', high, low))[0]
+    if math.isnan(value) or math.isinf(value):
+        return False
+    return 1e-3 <= abs(value) <= 1e7
+
+def guess_types(regs):
+    types = [None] * len(regs)
+
+    # Strings: at least two printable registers in a row
+    i = 0
+    while i < len(regs):
+        end = i
+        while end < len(regs) and is_printable(regs[end]):
+            end += 1
+        if end - i >= 2:
+            for j in range(i, end):
+                types[j] = "string"
+        i = max(end, i + 1)
+
+    for i, reg in enumerate(regs):
+        if types[i] is not None:
+            continue
+        if reg == 0xffff or reg == 0x8000:
+            types[i] = "unimplemented"
+        elif i + 1 < len(regs) and types[i + 1] is None and reg != 0 and is_float(reg, regs[i + 1]):
+            types[i] = "float"
+            types[i + 1] = "float_lo"
+        elif reg >= 0xfff6:
+            # -10..-1, typical SunSpec scale factor
+            types[i] = "sunssf"
+        elif reg >= 0x8000:
+            types[i] = "int16"
+        else:
+            types[i] = "uint16"
+    return types
+
+
+class RegisterScanner:
+    # read: function(unit_id, address, count) returning [registers or None, Modbus exception code or None]
+    def __init__(self, read, block_size=max_read_registers):
+        self.read = read
+        self.block_size = block_size
+        self.stats = {
+            'requests' : 0,
+            'illegal_address' : 0,
+            'failed' : 0,
+        }
+
+    # [[address, [registers]], ...] of the readable parts, [[address, count], ...] unreadable and failed
+    def scan_range(self, unit_id, start, count):
+        readable = []
+        unreadable = []
+        failed = []
+
+        todo = []
+        for addr in range(start, start + count, self.block_size):
+            todo.append([addr, min(self.block_size, start + count - addr)])
+        todo.reverse()
+
+        while todo:
+            [addr, size] = todo.pop()
+            self.stats['requests'] += 1
+            [regs, exception] = self.read(unit_id, addr, size)
+            if regs:
+                readable.append([addr, list(regs)])
+            elif exception == EXP_DATA_ADDRESS:
+                self.stats['illegal_address'] += 1
+                if size == 1:
+                    unreadable.append([addr, 1])
+                elif size <= bisect_min:
+                    for single in reversed(range(addr, addr + size)):
+                        todo.append([single, 1])
+                else:
+                    # Bisect, lower half first
+                    half = size // 2
+                    todo.append([addr + half, size - half])
+                    todo.append([addr, half])
+            elif exception in (EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND):
+                # No device behind this unit id, skip the rest
+                self.stats['failed'] += 1
+                logging.warning("scan_range() - no unit {0}".format(unit_id))
+                failed.append([addr, size])
+                failed += todo
+                todo = []
+            else:
+                self.stats['failed'] += 1
+                logging.error("scan_range() - unit {0} address {1} count {2} failed, exception {3}".format(unit_id, addr, size, exception))
+                failed.append([addr, size])
+
+        return [self.merge(readable), self.merge_spans(unreadable), self.merge_spans(failed)]
+
+    def merge(self, blocks):
+        merged = []
+        for [addr, regs] in sorted(blocks, key=lambda block: block[0]):
+            if merged and merged[-1][0] + len(merged[-1][1]) == addr:
+                merged[-1][1].extend(regs)
+            else:
+                merged.append([addr, list(regs)])
+        return merged
+
+    def merge_spans(self, spans):
+        merged = []
+        for [addr, count] in sorted(spans):
+            if merged and merged[-1][0] + merged[-1][1] == addr:
+                merged[-1][1] += count
+            else:
+                merged.append([addr, count])
+        return merged
+
+    # ranges: [[first address, last address], ...]
+    def scan(self, unit_ids, ranges, device=None):
+        result = {
+            "device" : device,
+            "time" : datetime.utcnow().isoformat(),
+            "units" : {},
+        }
+        for unit_id in unit_ids:
+            unit = {"registers" : [], "unreadable" : [], "failed" : []}
+            for [first, last] in ranges:
+                [readable, unreadable, failed] = self.scan_range(unit_id, first, last - first + 1)
+                for [addr, regs] in readable:
+                    for i, [reg, datatype] in enumerate(zip(regs, guess_types(regs))):
+                        unit["registers"].append([addr + i, reg, datatype])
+                unit["unreadable"] += unreadable
+                unit["failed"] += failed
+            logging.info("Unit {0}: {1} registers readable".format(unit_id, len(unit["registers"])))
+            result["units"][str(unit_id)] = unit
+        return result
+
+
+def save_scan(scan, filename):
+    with open(filename, 'w') as f:
+        json.dump(scan, f, indent=1)
+
+def load_scan(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+# {unit id : [[address, old raw, new raw, type], ...]}, added/removed
+# registers have None as old/new value
+def diff_scans(old, new):
+    result = {}
+    for unit_id in sorted(set(old["units"]) | set(new["units"]), key=int):
+        old_regs = {addr : [raw, datatype] for [addr, raw, datatype] in old["units"].get(unit_id, {}).get("registers", [])}
+        new_regs = {addr : [raw, datatype] for [addr, raw, datatype] in new["units"].get(unit_id, {}).get("registers", [])}
+        changes = []
+        for addr in sorted(set(old_regs) | set(new_regs)):
+            old_raw = old_regs.get(addr, [None, None])[0]
+            [new_raw, datatype] = new_regs.get(addr, [None, old_regs.get(addr, [None, None])[1]])
+            if old_raw != new_raw:
+                changes.append([addr, old_raw, new_raw, datatype])
+        if changes:
+            result[int(unit_id)] = changes
+    return result
+
+
+# Read function for a pyModbusTCP based Symo
+def symo_reader(symo):
+    def read(unit_id, addr, count):
+        symo.modbus.unit_id = unit_id
+        regs = symo.read_holding_registers(addr-1, count)
+        if regs:
+            return [regs, None]
+        if symo.modbus.last_error == MB_EXCEPT_ERR:
+            return [None, symo.modbus.last_except]
+        return [None, None]
+    return read
+
+def parse_range(text):
+    if '-' in text:
+        [first, last] = text.split('-', 1)
+        return [int(first), int(last)]
+    return [int(text), int(text)]
+
+
+# Test area
+if __name__ == "__main__":
+    import argparse
+    from pv_fronius.fronius_symo import Symo
+
+    logging.basicConfig(format='register_scan: %(message)s', level=logging.INFO)
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-a", "--address", help="IP address Fronius Symo",
+                           default='192.168.0.123', action='store')
+    argparser.add_argument("-p", "--port", help="Modbus TCP port",
+                           default=502, type=int, action='store')
+    argparser.add_argument("-u", "--unit", help="Unit id(s) to scan",
+                           default=[1], type=int, nargs='+', action='store')
+    argparser.add_argument("-r", "--range", help="Address range(s), e.g. 40001-40400",
+                           default=['40001-40400'], nargs='+', action='store')
+    argparser.add_argument("-o", "--output", help="Write the scan to this json file",
+                           action='store')
+    argparser.add_argument("-d", "--diff", help="Compare two json scans", nargs=2,
+                           metavar=('OLD', 'NEW'), action='store')
+
+    args = argparser.parse_args()
+
+    if args.diff:
+        for unit_id, changes in diff_scans(load_scan(args.diff[0]), load_scan(args.diff[1])).items():
+            for [addr, old_raw, new_raw, datatype] in changes:
+                logging.info("unit {0} {1:d}: {2} -> {3} ({4})".format(unit_id, addr, old_raw, new_raw, datatype))
+    else:
+        symo = Symo(ipaddr=args.address, port=args.port, persistent=True)
+        scanner = RegisterScanner(symo_reader(symo))
+        scan = scanner.scan(args.unit, [parse_range(text) for text in args.range], device=symo.name)
+        symo.close()
+        logging.info("{0} requests, {1} illegal address, {2} failed".format(
+            scanner.stats['requests'], scanner.stats['illegal_address'], scanner.stats['failed']))
+        if args.output:
+            save_scan(scan, args.output)
+        else:
+            print(json.dumps(scan, indent=1))
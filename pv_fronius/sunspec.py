@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+# V2: A failed read leaves the chain incomplete instead of ending it
+
+# SunSpec model chain discovery. Instead of fixed addresses the registers are
+# given relative to the start of their model, the model start addresses are
+# found by walking the ID/L headers from 40003 on. The result is cached on
+# disk, keyed by serial number and firmware version of the device.
+#
+# References:
+# https://sunspec.org/wp-content/uploads/2015/06/SunSpec-Information-Models-12041.pdf
+
+import os
+import re
+import json
+import logging
+
+from pyModbusTCP.constants import EXP_ILLEGAL_FUNCTION, EXP_DATA_ADDRESS, EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND
+
+sunspec_start = 40001
+sunspec_marker = [0x5375, 0x6e53]   # 'SunS'
+end_model_id = 0xffff
+max_models = 64
+
+# 'SunS' + common model (ID, L and 65 registers)
+common_block_size = 69
+
+inverter_unit_id = 1
+meter_unit_id = 200
+
+# Modbus exception codes meaning that the unit id or the address doesn't exist,
+# gateway target failed to respond = no meter behind the datamanager
+missing_exceptions = (EXP_ILLEGAL_FUNCTION, EXP_DATA_ADDRESS, EXP_GATEWAY_PATH_UNAVAILABLE, EXP_GATEWAY_TARGET_DEVICE_FAILED_TO_RESPOND)
+
+# Same model layout for the float and the int+SF variants is not given, only
+# the float variants are supported (Fronius "float" Modbus setting)
+inverter_models = (111, 112, 113)
+meter_models = (211, 212, 213)
+
+# Format:
+# "name : [unit id, model ids, offset to model ID register, data type, offset of scale factor]
+# MPPT module registers use "mppt_module" to skip modules the device doesn't have
+model_registers = {
+# Common Block Register
+    "Sunspec_Common_ID" : [inverter_unit_id, (1,), 0, "uint16", None],
+    "Sunspec_Common_L" : [inverter_unit_id, (1,), 1, "uint16", None],
+    "Sunspec_Devicename" : [inverter_unit_id, (1,), 18, "string16", None],
+    "Sunspec_Software Version" : [inverter_unit_id, (1,), 42, "string8", None],
+# Inverter model
+    "Sunspec_Inverter_ID" : [inverter_unit_id, inverter_models, 0, "uint16", None],
+    "Sunspec_Inverter_L" : [inverter_unit_id, inverter_models, 1, "uint16", None],
+    "AC_Phase-A_Current" : [inverter_unit_id, inverter_models, 4, "float", None],
+    "AC_Phase-B_Current" : [inverter_unit_id, inverter_models, 6, "float", None],
+    "AC_Phase-C_Current" : [inverter_unit_id, inverter_models, 8, "float", None],
+    "AC_Voltage_Phase-AB" : [inverter_unit_id, inverter_models, 10, "float", None],
+    "AC_Voltage_Phase-BC" : [inverter_unit_id, inverter_models, 12, "float", None],
+    "AC_Voltage_Phase-CA" : [inverter_unit_id, inverter_models, 14, "float", None],
+    "AC_Voltage_Phase-A-N" : [inverter_unit_id, inverter_models, 16, "float", None],
+    "AC_Voltage_Phase-B-N" : [inverter_unit_id, inverter_models, 18, "float", None],
+    "AC_Voltage_Phase-C-N" : [inverter_unit_id, inverter_models, 20, "float", None],
+    "AC_Output_Power" : [inverter_unit_id, inverter_models, 22, "float", None],
+    "AC_Frequency" : [inverter_unit_id, inverter_models, 24, "float", None],
+    "AC_Energy" : [inverter_unit_id, inverter_models, 32, "float", None],
+    "DC_Power" : [inverter_unit_id, inverter_models, 38, "float", None],
+    "Cabinet_Temperature" : [inverter_unit_id, inverter_models, 40, "float", None],
+    "Operating_State" : [inverter_unit_id, inverter_models, 48, "uint16", None],
+# Nameplate model
+    "Nameplate_Continous_AC_Power" : [inverter_unit_id, (120,), 3, "uint16_sunssf", 4],
+    "Nameplate_Battery_Capacity" : [inverter_unit_id, (120,), 19, "uint16_sunssf", 20],
+    "Nameplate_Battery_Charge_Power" : [inverter_unit_id, (120,), 23, "uint16_sunssf", 24],
+    "Nameplate_Battery_Discharge_Power" : [inverter_unit_id, (120,), 25, "uint16_sunssf", 26],
+# Immediate control model
+    "Control_conn" : [inverter_unit_id, (123,), 4, "uint16", None],
+# Storage device (Battery)
+    "Sunspec_Battery_ID" : [inverter_unit_id, (124,), 0, "uint16", None],
+    "Sunspec_Battery_L" : [inverter_unit_id, (124,), 1, "uint16", None],
+    "Battery_Max_Charge_Power" : [inverter_unit_id, (124,), 2, "uint16_sunssf", 18],
+    "Battery_WChaGra" : [inverter_unit_id, (124,), 3, "uint16", None],
+    "Battery_WDisChaGra" : [inverter_unit_id, (124,), 4, "uint16", None],
+    "Battery_StorCtl_Mod" : [inverter_unit_id, (124,), 5, "uint16", None],
+    "Battery_Min_Reserve" : [inverter_unit_id, (124,), 7, "uint16_sunssf", 21],
+    "Battery_SoC" : [inverter_unit_id, (124,), 8, "uint16_sunssf", 22],
+    "Battery_Status" : [inverter_unit_id, (124,), 11, "uint16", None],
+    "Battery_OutWRte" : [inverter_unit_id, (124,), 12, "int16_sunssf", 25],
+    "Battery_InWRte" : [inverter_unit_id, (124,), 13, "int16_sunssf", 25],
+    "Battery_InOutWRte_RvrtTm" : [inverter_unit_id, (124,), 15, "uint16", None],
+    "Battery_ChaGriSet" : [inverter_unit_id, (124,), 17, "uint16", None],
+# Multiple MPPT
+    "Sunspec_MPPT_ID" : [inverter_unit_id, (160,), 0, "uint16", None],
+# Power Meter
+    "Sunspec_Meter_ID" : [meter_unit_id, meter_models, 0, "uint16", None],
+    "Meter_Frequency" : [meter_unit_id, meter_models, 26, "float", None],
+    "Meter_Power_Total" : [meter_unit_id, meter_models, 28, "float", None],
+    "Meter_Power_L1" : [meter_unit_id, meter_models, 30, "float", None],
+    "Meter_Power_L2" : [meter_unit_id, meter_models, 32, "float", None],
+    "Meter_Power_L3" : [meter_unit_id, meter_models, 34, "float", None],
+    "Meter_Real_Energy_Exported" : [meter_unit_id, meter_models, 60, "float", None],
+    "Meter_Real_Energy_Exported_L1" : [meter_unit_id, meter_models, 62, "float", None],
+    "Meter_Real_Energy_Exported_L2" : [meter_unit_id, meter_models, 64, "float", None],
+    "Meter_Real_Energy_Exported_L3" : [meter_unit_id, meter_models, 66, "float", None],
+    "Meter_Real_Energy_Imported" : [meter_unit_id, meter_models, 68, "float", None],
+    "Meter_Real_Energy_Imported_L1" : [meter_unit_id, meter_models, 70, "float", None],
+    "Meter_Real_Energy_Imported_L2" : [meter_unit_id, meter_models, 72, "float", None],
+    "Meter_Real_Energy_Imported_L3" : [meter_unit_id, meter_models, 74, "float", None],
+}
+
+# Multiple MPPT model 160: 8 registers header, then 20 registers per module
+mppt_model = 160
+mppt_header_size = 8
+mppt_module_size = 20
+mppt_registers = {
+    # "suffix" : [offset in module, data type, offset of scale factor in model]
+    "DC_Current" : [9, "uint16_sunssf", 2],
+    "DC_Voltage" : [10, "uint16_sunssf", 3],
+    "DC_Power" : [11, "uint16_sunssf", 4],
+    "DC_Energy" : [12, "acc32_sunssf", 5],
+}
+
+
+# Generator walking the model chain of one unit id. Yields read requests
+# [unit id, address, count], gets the registers sent back, None if the device
+# answered that the unit or address doesn't exist (missing_exceptions) or
+# False if the read failed. Returns {model id : [address of ID register, length]},
+# {} if the unit has no SunSpec registers and None if a failed read left the
+# chain incomplete.
+def walk_model_chain(unit_id):
+    regs = yield [unit_id, sunspec_start, 2]
+    if regs is False:
+        logging.error("Reading the SunSpec marker of unit {0} failed".format(unit_id))
+        return None
+    if regs is None or list(regs) != sunspec_marker:
+        logging.warning("No SunSpec marker on unit {0}".format(unit_id))
+        return {}
+
+    models = {}
+    addr = sunspec_start + 2
+    for i in range(max_models):
+        regs = yield [unit_id, addr, 2]
+        if regs is False:
+            logging.error("Reading the SunSpec model header at {0} of unit {1} failed".format(addr, unit_id))
+            return None
+        if regs is None:
+            # Chain without end model
+            break
+        [model_id, length] = regs
+        if model_id == end_model_id:
+            break
+        if model_id not in models:
+            models[model_id] = [addr, length]
+        addr += 2 + length
+    return models
+
+def run_sync(generator, read_block):
+    try:
+        request = next(generator)
+        while True:
+            request = generator.send(read_block(*request))
+    except StopIteration as result:
+        return result.value
+
+async def run_async(generator, read_block):
+    try:
+        request = next(generator)
+        while True:
+            request = generator.send(await read_block(*request))
+    except StopIteration as result:
+        return result.value
+
+
+def registers_to_string(regs):
+    result = ''
+    for reg in regs:
+        if reg == 0:
+            break
+        result += chr((reg>>8) & 0xff)
+        result += chr(reg & 0xff)
+    return result.strip('\x00 ')
+
+# [devicename, software version, serial number] from the first common_block_size registers
+def identify(regs):
+    if not regs or len(regs) < common_block_size or list(regs[0:2]) != sunspec_marker:
+        return None
+    # Offsets relative to 40001
+    devicename = registers_to_string(regs[20:36])
+    version = registers_to_string(regs[44:52])
+    serial = registers_to_string(regs[52:68])
+    return [devicename, version, serial]
+
+
+# {unit id : {model id : [address, length]}} to the Symo register format
+def build_registers(models_by_unit):
+    registers = {}
+    registers["Sunspec_SID"] = [sunspec_start, "uint32", inverter_unit_id]
+
+    for name, [unit_id, model_ids, offset, datatype, sf_offset] in model_registers.items():
+        models = models_by_unit.get(unit_id, {})
+        for model_id in model_ids:
+            if model_id in models:
+                base = models[model_id][0]
+                if sf_offset is None:
+                    registers[name] = [base + offset, datatype, unit_id]
+                else:
+                    registers[name] = [[base + offset, base + sf_offset], datatype, unit_id]
+                break
+
+    models = models_by_unit.get(inverter_unit_id, {})
+    if mppt_model in models:
+        [base, length] = models[mppt_model]
+        for module in range((length - mppt_header_size) // mppt_module_size):
+            module_base = base + 2 + mppt_header_size + module * mppt_module_size
+            for suffix, [offset, datatype, sf_offset] in mppt_registers.items():
+                name = "MPPT_{0}_{1}".format(module + 1, suffix)
+                registers[name] = [[module_base + offset, base + sf_offset], datatype, inverter_unit_id]
+
+    return registers
+
+
+def cache_file(cache_dir, identity):
+    [devicename, version, serial] = identity
+    key = re.sub(r'[^A-Za-z0-9_.-]', '_', "{0}_{1}".format(serial, version))
+    return os.path.join(cache_dir, "sunspec_{0}.json".format(key))
+
+def load_cache(cache_dir, identity):
+    if cache_dir is None or identity is None:
+        return None
+    filename = cache_file(cache_dir, identity)
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # json only knows string keys
+    return {int(unit_id) : {int(model_id) : model for model_id, model in models.items()}
+            for unit_id, models in data.items()}
+
+def save_cache(cache_dir, identity, models_by_unit):
+    if cache_dir is None or identity is None:
+        return
+    filename = cache_file(cache_dir, identity)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(models_by_unit, f, indent=1)
+        os.replace(filename + '.tmp', filename)
+    except OSError as e:
+        logging.warning("Could not write SunSpec cache {0}: {1}".format(filename, e))
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'pvev-control')
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+
+# Version history:
+# V1: Baseline
+
+# Local Modbus TCP stand-in for a Fronius Symo / Symo GEN24, to run Symo,
+# fronius_influxdb.py or simple_batterycontrol.py without an inverter.
+# Serves the registers_gen24/registers_symo address space (unit 200 = meter)
+# behind a SunSpec model chain, plays back recorded or scripted values,
+# accepts writes to the battery/connection control registers and injects
+# latency and faults.
+
+import socketserver
+import threading
+import struct
+import random
+import json
+import time
+import math
+import logging
+
+from pv_fronius.fronius_symo import registers_gen24, registers_symo
+from pv_fronius import sunspec
+
+# Modbus exception codes
+exp_illegal_function = 0x01
+exp_data_address = 0x02
+exp_data_value = 0x03
+exp_slave_device_busy = 0x06
+exp_gateway_target_failed = 0x0b
+
+# SunSpec model chain per unit id, [model id, length] from 40003 on
+model_chains = {
+    "symo_gen24" : {
+        1 : [[1, 65], [113, 60], [120, 26], [121, 30], [122, 44], [123, 24], [160, 88], [124, 24]],
+        200 : [[1, 65], [213, 124]],
+    },
+    "symo" : {
+        1 : [[1, 65], [113, 60], [120, 26], [121, 30], [122, 44], [123, 24], [160, 48]],
+    },
+}
+
+model_registers = {
+    "symo_gen24" : registers_gen24,
+    "symo" : registers_symo,
+}
+
+# Registers a client may write
+writable_parameters = ["Battery_StorCtl_Mod", "Battery_InWRte", "Battery_OutWRte", "Control_conn"]
+
+default_values = {
+    "symo_gen24" : {
+        "Sunspec_Devicename" : "Primo GEN24 6.0 Plus",
+        "Sunspec_Software Version" : "1.30.7-1",
+        "AC_Phase-A_Current" : 2.2, "AC_Phase-B_Current" : 2.2, "AC_Phase-C_Current" : 2.2,
+        "AC_Voltage_Phase-AB" : 400.0, "AC_Voltage_Phase-BC" : 400.0, "AC_Voltage_Phase-CA" : 400.0,
+        "AC_Voltage_Phase-A-N" : 230.0, "AC_Voltage_Phase-B-N" : 230.0, "AC_Voltage_Phase-C-N" : 230.0,
+        "AC_Output_Power" : 1500.0, "AC_Frequency" : 50.0, "AC_Energy" : 12345678.0,
+        "DC_Power" : 1600.0, "Cabinet_Temperature" : 35.0, "Operating_State" : 4,
+        "Nameplate_Continous_AC_Power" : 6000, "Nameplate_Battery_Capacity" : 10200,
+        "Nameplate_Battery_Charge_Power" : 6000, "Nameplate_Battery_Discharge_Power" : 6000,
+        "Control_conn" : 1,
+        "Battery_Max_Charge_Power" : 10200, "Battery_WChaGra" : 100, "Battery_WDisChaGra" : 100,
+        "Battery_StorCtl_Mod" : 0, "Battery_Min_Reserve" : 5.0, "Battery_SoC" : 55.0, "Battery_Status" : 3,
+        "Battery_OutWRte" : 100.0, "Battery_InWRte" : 100.0, "Battery_InOutWRte_RvrtTm" : 0, "Battery_ChaGriSet" : 1,
+        "MPPT_1_DC_Current" : 3.0, "MPPT_1_DC_Voltage" : 400.0, "MPPT_1_DC_Power" : 1200.0, "MPPT_1_DC_Energy" : 9000000.0,
+        "MPPT_2_DC_Current" : 1.0, "MPPT_2_DC_Voltage" : 400.0, "MPPT_2_DC_Power" : 400.0, "MPPT_2_DC_Energy" : 3000000.0,
+        "MPPT_3_DC_Current" : 0.0, "MPPT_3_DC_Voltage" : 380.0, "MPPT_3_DC_Power" : 0.0, "MPPT_3_DC_Energy" : 2000000.0,
+        "MPPT_4_DC_Current" : 0.5, "MPPT_4_DC_Voltage" : 380.0, "MPPT_4_DC_Power" : 190.0, "MPPT_4_DC_Energy" : 1800000.0,
+        "Meter_Frequency" : 50.0, "Meter_Power_Total" : -300.0,
+        "Meter_Power_L1" : -100.0, "Meter_Power_L2" : -100.0, "Meter_Power_L3" : -100.0,
+        "Meter_Real_Energy_Exported" : 5000000.0, "Meter_Real_Energy_Exported_L1" : 1700000.0,
+        "Meter_Real_Energy_Exported_L2" : 1600000.0, "Meter_Real_Energy_Exported_L3" : 1700000.0,
+        "Meter_Real_Energy_Imported" : 4000000.0, "Meter_Real_Energy_Imported_L1" : 1300000.0,
+        "Meter_Real_Energy_Imported_L2" : 1400000.0, "Meter_Real_Energy_Imported_L3" : 1300000.0,
+    },
+    "symo" : {
+        "Sunspec_Devicename" : "Symo 8.2-3-M",
+        "Sunspec_Software Version" : "3.25.2-1",
+        "AC_Phase-A_Current" : 2.2, "AC_Phase-B_Current" : 2.2, "AC_Phase-C_Current" : 2.2,
+        "AC_Voltage_Phase-AB" : 400.0, "AC_Voltage_Phase-BC" : 400.0, "AC_Voltage_Phase-CA" : 400.0,
+        "AC_Voltage_Phase-A-N" : 230.0, "AC_Voltage_Phase-B-N" : 230.0, "AC_Voltage_Phase-C-N" : 230.0,
+        "AC_Output_Power" : 1500.0, "AC_Frequency" : 50.0, "AC_Energy" : 23456789.0,
+        "DC_Power" : 1600.0, "Operating_State" : 4,
+        "Nameplate_Continous_AC_Power" : 8200, "Control_conn" : 1,
+        "MPPT_1_DC_Current" : 3.0, "MPPT_1_DC_Voltage" : 400.0, "MPPT_1_DC_Power" : 1200.0,
+        "MPPT_2_DC_Current" : 1.0, "MPPT_2_DC_Voltage" : 400.0, "MPPT_2_DC_Power" : 400.0,
+    },
+}
+
+
+def encode_string(text, size):
+    data = text.encode('latin-1')[:2 * size].ljust(2 * size, b'\x00')
+    return list(struct.unpack('>{0}H'.format(size), data))
+
+def encode_float(value):
+    return list(struct.unpack('>HH', struct.pack('>f', value)))
+
+
+class SymoSimulator:
+    def __init__(self, model="symo_gen24", host='127.0.0.1', port=1502, latency=0.0,
+                 fault_rate=0.0, fault_modes=('exception',), max_connections=None, seed=None):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.registers = model_registers[model]
+        # Seconds before each response, a number or [min, max]
+        self.latency = latency
+        # Probability per request for one of fault_modes: 'exception', 'timeout', 'disconnect'
+        self.fault_rate = fault_rate
+        self.fault_modes = list(fault_modes)
+        self.max_connections = max_connections
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        # unit id : {0 based address : register}
+        self.images = {}
+        self.end_address = {}
+        self.build_image()
+        self.set_values(default_values[model])
+
+        self.writes = []
+        self.stats = {
+            'connections' : 0,
+            'refused_connections' : 0,
+            'requests' : 0,
+            'read_requests' : 0,
+            'write_requests' : 0,
+            'registers_read' : 0,
+            'exceptions' : 0,
+            'faults' : 0,
+        }
+        self.connections = 0
+
+        self.server = None
+        self.server_thread = None
+        self.playback_thread = None
+        self.playback_stop = threading.Event()
+
+    def build_image(self):
+        for unit_id, chain in model_chains[self.model].items():
+            image = {}
+            image[sunspec.sunspec_start - 1] = sunspec.sunspec_marker[0]
+            image[sunspec.sunspec_start] = sunspec.sunspec_marker[1]
+            addr = sunspec.sunspec_start + 2
+            for [model_id, length] in chain:
+                image[addr - 1] = model_id
+                image[addr] = length
+                for i in range(length):
+                    image.setdefault(addr + 1 + i, 0)
+                addr += 2 + length
+            image[addr - 1] = sunspec.end_model_id
+            image[addr] = 0
+            self.images[unit_id] = image
+            self.end_address[unit_id] = addr + 1
+
+        # Scale factors, 0 for power and energy (to fit into 16 bit), -2 otherwise
+        for name, [register, datatype, unit_id] in self.registers.items():
+            if type(register) is list:
+                if datatype == "acc32_sunssf" or name.startswith("Nameplate") or "Power" in name:
+                    scalef = 0
+                else:
+                    scalef = -2
+                self.images[unit_id][register[1] - 1] = scalef & 0xffff
+
+    def encode(self, name, value):
+        [register, datatype, unit_id] = self.registers[name]
+        if datatype == "uint16":
+            return [register, [int(value) & 0xffff]]
+        elif datatype == "uint32":
+            value = int(value)
+            return [register, [(value >> 16) & 0xffff, value & 0xffff]]
+        elif datatype == "float":
+            return [register, encode_float(value)]
+        elif datatype == "string8":
+            return [register, encode_string(value, 8)]
+        elif datatype == "string16":
+            return [register, encode_string(value, 16)]
+
+        scalereg = self.images[unit_id][register[1] - 1]
+        scalef = scalereg - 0x10000 if scalereg >= 0x8000 else scalereg
+        raw = int(round(value / 10.0**scalef))
+        if datatype == "acc32_sunssf":
+            return [register[0], [(raw >> 16) & 0xffff, raw & 0xffff]]
+        else:
+            return [register[0], [raw & 0xffff]]
+
+    def set_value(self, name, value):
+        if name not in self.registers:
+            logging.warning("set_value() - unknown register {0}".format(name))
+            return
+        unit_id = self.registers[name][2]
+        [addr, regs] = self.encode(name, value)
+        with self.lock:
+            for i, reg in enumerate(regs):
+                self.images[unit_id][addr - 1 + i] = reg
+
+    def set_values(self, values):
+        for name, value in values.items():
+            self.set_value(name, value)
+
+    def get_registers(self, unit_id, addr, count):
+        with self.lock:
+            image = self.images[unit_id]
+            return [image.get(addr - 1 + i, 0) for i in range(count)]
+
+    # Playback of recorded/scripted frames, a list of {name : value}
+    def start_playback(self, frames, interval=1.0, loop=True):
+        self.stop_playback()
+        self.playback_stop.clear()
+
+        def playback():
+            while True:
+                for frame in frames:
+                    self.set_values(frame)
+                    if self.playback_stop.wait(interval):
+                        return
+                if not loop:
+                    return
+
+        self.playback_thread = threading.Thread(target=playback, daemon=True)
+        self.playback_thread.start()
+
+    def stop_playback(self):
+        if self.playback_thread:
+            self.playback_stop.set()
+            self.playback_thread.join()
+            self.playback_thread = None
+
+    def load_playback(self, filename, interval=1.0, loop=True):
+        with open(filename) as f:
+            frames = json.load(f)
+        self.start_playback(frames, interval, loop)
+
+    def writable_addresses(self, unit_id):
+        addresses = {}
+        for name in writable_parameters:
+            if name in self.registers and self.registers[name][2] == unit_id:
+                register = self.registers[name][0]
+                if type(register) is list:
+                    register = register[0]
+                addresses[register - 1] = name
+        return addresses
+
+    def fault(self):
+        if self.fault_rate and self.random.random() < self.fault_rate:
+            self.stats['faults'] += 1
+            return self.random.choice(self.fault_modes)
+        return None
+
+    def exception(self, function, code):
+        self.stats['exceptions'] += 1
+        return struct.pack('>BB', function | 0x80, code)
+
+    # Response pdu for a request pdu, None = no response
+    def process(self, unit_id, pdu):
+        self.stats['requests'] += 1
+        function = pdu[0]
+
+        if unit_id not in self.images:
+            return self.exception(function, exp_gateway_target_failed)
+
+        if function == 0x03:
+            self.stats['read_requests'] += 1
+            [addr, count] = struct.unpack('>HH', pdu[1:5])
+            if count < 1 or count > 125:
+                return self.exception(function, exp_data_value)
+            if addr + 1 < sunspec.sunspec_start or addr + count > self.end_address[unit_id]:
+                return self.exception(function, exp_data_address)
+            regs = self.get_registers(unit_id, addr + 1, count)
+            self.stats['registers_read'] += count
+            return struct.pack('>BB', function, 2 * count) + struct.pack('>{0}H'.format(count), *regs)
+
+        elif function == 0x06 or function == 0x10:
+            self.stats['write_requests'] += 1
+            if function == 0x06:
+                [addr, value] = struct.unpack('>HH', pdu[1:5])
+                values = [value]
+            else:
+                [addr, count, byte_count] = struct.unpack('>HHB', pdu[1:6])
+                values = list(struct.unpack('>{0}H'.format(count), pdu[6:6 + 2 * count]))
+
+            writable = self.writable_addresses(unit_id)
+            for i in range(len(values)):
+                if addr + i not in writable:
+                    return self.exception(function, exp_data_address)
+            with self.lock:
+                for i, value in enumerate(values):
+                    self.images[unit_id][addr + i] = value
+                    self.writes.append([time.time(), unit_id, writable[addr + i], value])
+            # Both echo address and value/count
+            return pdu[0:5]
+
+        return self.exception(function, exp_illegal_function)
+
+    def delay(self):
+        latency = self.latency
+        if isinstance(latency, (list, tuple)):
+            latency = self.random.uniform(latency[0], latency[1])
+        if latency:
+            time.sleep(latency)
+
+    def start(self):
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def recv_exact(self, size):
+                data = b''
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        return None
+                    data += chunk
+                return data
+
+            def handle(self):
+                with simulator.lock:
+                    if simulator.max_connections and simulator.connections >= simulator.max_connections:
+                        simulator.stats['refused_connections'] += 1
+                        return
+                    simulator.connections += 1
+                    simulator.stats['connections'] += 1
+                try:
+                    while True:
+                        header = self.recv_exact(7)
+                        if header is None:
+                            return
+                        [transaction_id, protocol_id, length, unit_id] = struct.unpack('>HHHB', header)
+                        pdu = self.recv_exact(length - 1)
+                        if pdu is None:
+                            return
+
+                        simulator.delay()
+                        fault = simulator.fault()
+                        if fault == 'timeout':
+                            continue
+                        elif fault == 'disconnect':
+                            return
+                        elif fault == 'exception':
+                            response = simulator.exception(pdu[0], exp_slave_device_busy)
+                        else:
+                            response = simulator.process(unit_id, pdu)
+
+                        self.request.sendall(struct.pack('>HHHB', transaction_id, 0, len(response) + 1, unit_id) + response)
+                except OSError:
+                    return
+                finally:
+                    with simulator.lock:
+                        simulator.connections -= 1
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server((self.host, self.port), Handler)
+        # port=0 picks a free port
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        logging.info("Simulating {0} on {1}:{2}".format(self.model, self.host, self.port))
+        return self
+
+    def stop(self):
+        self.stop_playback()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+# Record snapshots of a real inverter in the playback format
+def record(symo, filename, count, interval):
+    frames = []
+    for i in range(count):
+        snapshot = symo.snapshot(symo.get_all_parameters())
+        frames.append({name : value for name, value in snapshot.items()
+                       if value is not None and value is not False})
+        time.sleep(interval)
+    with open(filename, 'w') as f:
+        json.dump(frames, f, indent=1)
+
+
+# Sweeps per second and control latency of Symo against the simulator
+def benchmark(simulator, sweeps=50, persistent=True):
+    from pv_fronius.fronius_symo import Symo
+
+    symo = Symo("127.0.0.1", port=simulator.port, persistent=persistent, sunspec_cache=None)
+    requests_before = simulator.stats['requests']
+
+    start = time.monotonic()
+    for i in range(sweeps):
+        symo.snapshot()
+    sweep_time = (time.monotonic() - start) / sweeps
+    requests = (simulator.stats['requests'] - requests_before) / sweeps
+
+    start = time.monotonic()
+    for i in range(sweeps):
+        symo.set_battery_charge_rate(10 + i % 2)
+    control_time = (time.monotonic() - start) / sweeps
+
+    symo.close()
+    return {
+        'sweep_seconds' : sweep_time,
+        'sweeps_per_second' : 1.0 / sweep_time if sweep_time > 0 else math.inf,
+        'requests_per_sweep' : requests,
+        'control_seconds' : control_time,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(format='symo_simulator: %(message)s', level=logging.INFO)
+
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("-m", "--model", help="symo_gen24 or symo",
+                           default='symo_gen24', action='store')
+    argparser.add_argument("-p", "--port", help="Modbus TCP port",
+                           default=1502, type=int, action='store')
+    argparser.add_argument("-l", "--latency", help="Latency per request in seconds",
+                           default=0.0, type=float, action='store')
+    argparser.add_argument("-f", "--fault-rate", help="Probability of a fault per request",
+                           default=0.0, type=float, action='store')
+    argparser.add_argument("--fault-modes", help="exception,timeout,disconnect",
+                           default='exception', action='store')
+    argparser.add_argument("--playback", help="JSON file with recorded frames",
+                           action='store')
+    argparser.add_argument("--interval", help="Seconds per playback frame",
+                           default=1.0, type=float, action='store')
+    argparser.add_argument("--record", help="Record frames from the inverter at this address into --playback file",
+                           action='store')
+    argparser.add_argument("--bench", help="Run a benchmark with N sweeps and exit",
+                           type=int, action='store')
+    args = argparser.parse_args()
+
+    if args.record:
+        from pv_fronius.fronius_symo import Symo
+        record(Symo(args.record, persistent=True), args.playback, 60, args.interval)
+    else:
+        simulator = SymoSimulator(model=args.model, port=args.port, latency=args.latency,
+                                  fault_rate=args.fault_rate, fault_modes=args.fault_modes.split(','))
+        simulator.start()
+        if args.playback:
+            simulator.load_playback(args.playback, args.interval)
+
+        if args.bench:
+            logging.info(benchmark(simulator, args.bench))
+            logging.info(simulator.stats)
+            simulator.stop()
+        else:
+            try:
+                while True:
+                    time.sleep(60)
+                    logging.info(simulator.stats)
+            except KeyboardInterrupt:
+                simulator.stop()
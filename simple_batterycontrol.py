@@ -2,6 +2,7 @@
 
 from pv_fronius.fronius_symo import Symo
 from influxdb_cli2.influxdb_cli2 import influxdb_cli2
+from influxdb_cli2.query_cache import query_cache
 
 from configparser import RawConfigParser
 
@@ -21,7 +22,7 @@ config.read(config.configfile)
 
 logging.basicConfig(format='simple_batterycontrol: %(message)s', level=logging.INFO)
 
-gen24 = Symo(ipaddr=config.get('symo','ipaddr'))
+gen24 = Symo(ipaddr=config.get('symo','ipaddr'), persistent=True)
 
 if gen24 is None:
     logging.warning("Gen24 don't like to talk to us")
@@ -191,9 +192,10 @@ class battery:
             gen24.set_battery_charge_rate(0)
             self.state_change = False
 
-        battery_soc = gen24.read_data("Battery_SoC")
-        pwr_pv = gen24.read_calculated_value("PV_Power")
-        pwr_consumption = gen24.read_calculated_value("Consumption_Sum")
+        snapshot = gen24.snapshot(["Battery_SoC", "PV_Power", "Consumption_Sum"])
+        battery_soc = snapshot["Battery_SoC"]
+        pwr_pv = snapshot["PV_Power"]
+        pwr_consumption = snapshot["Consumption_Sum"]
         logging.info("Battery SOC {0}%, PV PWR = {1}W, Consumption = {2}W".format(battery_soc, pwr_pv, pwr_consumption))
         
         if battery_soc < self.summer_min_charge and not self.override:
@@ -319,14 +321,11 @@ influxdb = influxdb_cli2(config.get('influxdb','url', raw=True),
                         org=config.get('influxdb','org'), 
                         bucket=config.get('influxdb','bucket'),
                         debug=False,
+                        query_cache=query_cache(),
                         )
 
 def get_last_from_db(name, searchinterval=24, location='pv_fronius'):
-    results = influxdb.query_data(location, name, datetime.datetime.utcnow()+datetime.timedelta(hours=(searchinterval*-1)), datetime.datetime.utcnow())
-    if results:
-        # print(results)
-        # print(results[-1][3])
-        return results[-1][3]
+    return influxdb.query_last(location, name, datetime.timedelta(hours=searchinterval))
 
 def get_current_price():
     return get_last_from_db(name='price_total', searchinterval=1, location='grid_tibber')
@@ -366,9 +365,11 @@ mqtt.connect(config.get('mqtt','server'),config.getint('mqtt','port'))
 mqtt.loop_start()
 
 bat = battery(gen24)
-bat.set_soc_lim_discharge(get_last_from_db('battery_soc_lim_discharge', searchinterval=96))
-bat.set_price_lim_discharge(get_last_from_db('battery_price_lim_discharge', searchinterval=96))
-bat.set_price_lim_charge(get_last_from_db('battery_price_lim_charge', searchinterval=96))
+limits = influxdb.query_last_series('pv_fronius', ['battery_soc_lim_discharge', 'battery_price_lim_discharge', 'battery_price_lim_charge'],
+                                    datetime.timedelta(hours=96))
+bat.set_soc_lim_discharge(limits.get('battery_soc_lim_discharge'))
+bat.set_price_lim_discharge(limits.get('battery_price_lim_discharge'))
+bat.set_price_lim_charge(limits.get('battery_price_lim_charge'))
 
 bat.summer_min_charge = config.getint('battery','summer_min_charge', fallback = 50)
 bat.summer_power_cap = config.getint('battery','summer_power_cap', fallback = 6500)
@@ -0,0 +1,39 @@
+#
+# Shared fixtures, the simulators run on free local ports
+#
+
+import os
+import sys
+
+import pytest
+
+# The repository root is a package itself, make the top level modules importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pv_fronius.symo_simulator import SymoSimulator
+from pv_fronius.fronius_symo import Symo
+from go_e_charger.go_e_simulator import GoeSimulator
+
+
+@pytest.fixture
+def symo_simulator():
+    simulator = SymoSimulator(port=0, seed=1).start()
+    yield simulator
+    simulator.stop()
+
+
+@pytest.fixture
+def symo(symo_simulator):
+    symo = Symo("127.0.0.1", port=symo_simulator.port, persistent=True, timeout=2.0, sunspec_cache=None)
+    yield symo
+    symo.close()
+
+
+
+@pytest.fixture
+def goe_simulator():
+    # Fast simulated time, so settling takes a fraction of a second
+    simulator = GoeSimulator(port=0, speed=50.0, seed=1)
+    simulator.start()
+    yield simulator
+    simulator.stop()
@@ -0,0 +1,99 @@
+#
+# BatteryControl against the Modbus simulator: unchanged commands cause no
+# writes, adjacent rate registers go out with one request
+#
+
+from pv_fronius import battery_control
+
+
+def writes(simulator):
+    return simulator.stats['write_requests']
+
+
+def written(simulator, start):
+    return [[name, value] for [time, unit_id, name, value] in simulator.writes[start:]]
+
+
+def test_rates_are_coalesced(symo, symo_simulator):
+    before = writes(symo_simulator)
+    assert symo.set_battery_rates(40, 60) is True
+    # OutWRte/InWRte with one write_multiple_registers, StorCtl_Mod separately
+    assert writes(symo_simulator) - before == 2
+    names = [name for [name, value] in written(symo_simulator, 0)]
+    assert sorted(names) == ["Battery_InWRte", "Battery_OutWRte", "Battery_StorCtl_Mod"]
+    values = symo.read_parameters(["Battery_InWRte", "Battery_OutWRte", "Battery_StorCtl_Mod"])
+    assert values == {"Battery_InWRte" : 40.0, "Battery_OutWRte" : 60.0, "Battery_StorCtl_Mod" : 3}
+
+
+def test_unchanged_commands_are_skipped(symo, symo_simulator):
+    symo.set_battery_charge_rate(50)
+    before = writes(symo_simulator)
+    for i in range(5):
+        assert symo.set_battery_charge_rate(50) is True
+    assert writes(symo_simulator) == before
+    assert symo.battery_control.stats['skipped'] == 5
+
+
+def test_only_changed_register_is_written(symo, symo_simulator):
+    symo.set_battery_rates(40, 60)
+    start = len(symo_simulator.writes)
+    symo.set_battery_rates(40, 70)
+    assert written(symo_simulator, start) == [["Battery_OutWRte", 7000]]
+
+
+def test_limit_removal_clears_storctl_bit(symo, symo_simulator):
+    symo.set_battery_rates(40, 60)
+    symo.set_battery_charge_rate(None)
+    assert symo.read_parameters(["Battery_StorCtl_Mod"])["Battery_StorCtl_Mod"] == battery_control.storctl_discharge_limit
+
+
+def test_verify_notices_changes_by_others(symo, symo_simulator):
+    symo.set_battery_charge_rate(50)
+    symo_simulator.set_value("Battery_InWRte", 80.0)
+    assert symo.battery_control.verify() is False
+    assert symo.battery_control.stats['verify_failures'] == 1
+
+
+def test_failed_write_invalidates_state(symo, symo_simulator):
+    symo.set_battery_charge_rate(50)
+    symo_simulator.fault = lambda: 'exception'
+    assert symo.set_battery_charge_rate(30) is False
+    assert symo.battery_control.applied == {}
+    symo_simulator.fault = lambda: None
+    assert symo.set_battery_charge_rate(30) is True
+    assert symo.read_parameters(["Battery_InWRte"])["Battery_InWRte"] == 30.0
+
+
+class fake_time:
+    now = 1000.0
+
+    @classmethod
+    def monotonic(cls):
+        return cls.now
+
+
+def test_rates_rewritten_before_revert_timeout(symo, symo_simulator, monkeypatch):
+    monkeypatch.setattr(battery_control, 'time', fake_time)
+    fake_time.now = 1000.0
+    symo_simulator.set_value("Battery_InOutWRte_RvrtTm", 60)
+    symo.set_battery_charge_rate(50)
+
+    before = writes(symo_simulator)
+    fake_time.now += 20
+    symo.set_battery_charge_rate(50)
+    assert writes(symo_simulator) == before
+
+    fake_time.now += 15
+    symo.set_battery_charge_rate(50)
+    assert writes(symo_simulator) == before + 1
+    assert symo.battery_control.stats['revert_rewrites'] == 1
+
+
+def test_no_rewrite_without_revert_timeout(symo, symo_simulator, monkeypatch):
+    monkeypatch.setattr(battery_control, 'time', fake_time)
+    fake_time.now = 1000.0
+    symo.set_battery_charge_rate(50)
+    before = writes(symo_simulator)
+    fake_time.now += 200
+    symo.set_battery_charge_rate(50)
+    assert writes(symo_simulator) == before
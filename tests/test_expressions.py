@@ -0,0 +1,72 @@
+#
+# Formulas of calculated values, compiled into one ExpressionGraph
+#
+
+import pytest
+
+from pv_fronius.expressions import ExpressionGraph, parse_formula
+
+
+def evaluate(definitions, values, names=None):
+    return ExpressionGraph(definitions, values.keys()).evaluate(values, names)
+
+
+def test_arithmetic_and_precedence():
+    values = {"a" : 2.0, "b" : 3.0, "c" : 4.0}
+    results = evaluate({"x" : "a + b * c", "y" : "(a + b) * c", "z" : "-a - -b", "w" : "c / a / 2"}, values)
+    assert results == {"x" : 14.0, "y" : 20.0, "z" : 1.0, "w" : 1.0}
+
+
+def test_functions_and_braced_names():
+    values = {"AC_Voltage_Phase-A-N" : -230.0, "b" : 16.0}
+    results = evaluate({"x" : "abs({AC_Voltage_Phase-A-N}) + sqrt(b)", "y" : "max(b, 1, 20) - min(b, 3)"}, values)
+    assert results == {"x" : 234.0, "y" : 17.0}
+
+
+def test_old_list_form():
+    assert evaluate({"sum" : ["a", "b", "+"]}, {"a" : 1.0, "b" : 2.0}) == {"sum" : 3.0}
+    with pytest.raises(ValueError):
+        parse_formula(["a", "b", "%"])
+
+
+def test_derived_values_refer_to_each_other():
+    definitions = {
+        "PV_Power" : "m1 + m2",
+        "Ratio" : "PV_Power / total",
+    }
+    assert evaluate(definitions, {"m1" : 100.0, "m2" : 300.0, "total" : 800.0}) == {"PV_Power" : 400.0, "Ratio" : 0.5}
+
+
+def test_common_subexpressions_share_nodes():
+    graph = ExpressionGraph({"x" : "a * b + 1", "y" : "b * a + 2"}, ["a", "b"])
+    products = [node for node in graph.nodes if node[0:2] == [3, '*']]
+    assert len(products) == 1
+
+
+def test_invalid_operands_give_false():
+    definitions = {"ratio" : "a / b", "sum" : "a + c"}
+    assert evaluate(definitions, {"a" : 1.0, "b" : 0.0, "c" : None}) == {"ratio" : False, "sum" : False}
+    assert evaluate(definitions, {"a" : False, "b" : 2.0, "c" : 1.0}) == {"ratio" : False, "sum" : False}
+
+
+def test_missing_registers_are_skipped():
+    graph = ExpressionGraph({"x" : "a + missing", "y" : "x * 2", "z" : "a * 2"}, ["a"])
+    assert graph.names() == ["z"]
+    assert sorted(graph.skipped) == ["x", "y"]
+
+
+def test_syntax_errors_are_skipped():
+    graph = ExpressionGraph({"bad" : "a +", "good" : "a"}, ["a"])
+    assert "bad" in graph.skipped
+    assert "good" in graph
+
+
+def test_cycles_are_rejected():
+    with pytest.raises(ValueError):
+        ExpressionGraph({"x" : "y + 1", "y" : "x + 1"}, [])
+
+
+def test_required_registers_of_subset():
+    graph = ExpressionGraph({"x" : "a + b", "y" : "c * 2"}, ["a", "b", "c"])
+    assert sorted(graph.required_registers(["x"])) == ["a", "b"]
+    assert graph.evaluate({"a" : 1.0, "b" : 2.0}, ["x"]) == {"x" : 3.0}
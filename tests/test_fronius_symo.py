@@ -0,0 +1,136 @@
+#
+# Symo against the Modbus simulator
+#
+
+import struct
+
+import pytest
+
+from pv_fronius.fronius_symo import registers_gen24, max_read_registers
+from pv_fronius.decode_plan import DecodePlan
+
+
+def test_detects_gen24(symo):
+    assert symo.name == "Primo GEN24 6.0 Plus"
+    assert symo.registers is registers_gen24
+
+
+def test_plan_covers_all_parameters_with_few_requests(symo):
+    blocks = symo.plan_reads()
+    assert len(blocks) < len(symo.get_all_parameters()) / 4
+    for block in blocks:
+        assert block.count <= max_read_registers
+    planned = set()
+    for block in blocks:
+        planned.update(block.parameters)
+    assert planned == set(symo.get_all_parameters())
+
+
+def test_plan_splits_per_unit_id(symo):
+    units = {block.unit_id for block in symo.plan_reads(["AC_Output_Power", "Meter_Power_Total"])}
+    assert units == {1, 200}
+
+
+def test_sweep_matches_single_reads(symo):
+    values = symo.read_parameters()
+    for name in symo.get_all_parameters():
+        single = symo.read_data(name)
+        if isinstance(single, float):
+            assert values[name] == pytest.approx(single), name
+        else:
+            assert values[name] == single, name
+
+
+def test_sweep_uses_one_request_per_block(symo, symo_simulator):
+    plan = symo.decode_plan()
+    before = symo_simulator.stats['read_requests']
+    symo.read_parameters()
+    assert symo_simulator.stats['read_requests'] - before == len(plan.blocks)
+
+
+def test_scalefactors_are_cached(symo, symo_simulator):
+    symo.read_data("Battery_InWRte")
+    before = symo_simulator.stats['read_requests']
+    symo.read_data("Battery_InWRte")
+    assert symo_simulator.stats['read_requests'] - before == 1
+
+
+def test_snapshot_calculated_values(symo, symo_simulator):
+    symo_simulator.set_values({"AC_Output_Power" : 2000.0, "Meter_Power_Total" : -500.0})
+    snapshot = symo.snapshot(["Self_Consumption_Ratio", "AC_Output_Power"])
+    assert snapshot["AC_Output_Power"] == 2000.0
+    assert snapshot["Self_Consumption_Ratio"] == pytest.approx(0.75)
+    assert symo.read_calculated_value("Self_Consumption_Ratio", snapshot) == snapshot["Self_Consumption_Ratio"]
+
+
+def test_snapshot_is_read_only(symo):
+    snapshot = symo.snapshot(["AC_Output_Power"])
+    with pytest.raises(AttributeError):
+        snapshot.foo = 1
+    with pytest.raises(TypeError):
+        snapshot.values["AC_Output_Power"] = 1
+
+
+def test_reconnects_after_dead_socket_on_write(symo, symo_simulator):
+    symo.read_parameters(["AC_Output_Power"])
+    faults = ['disconnect']
+    symo_simulator.fault = lambda: faults.pop() if faults else None
+    addr = min(symo_simulator.writable_addresses(1))
+    assert symo.write_single_register(addr, 5) is True
+    assert symo.stats['dead_sockets'] == 1
+    assert symo.stats['failed_requests'] == 0
+
+
+def test_failed_write_is_counted(symo, symo_simulator):
+    symo.read_parameters(["AC_Output_Power"])
+    symo_simulator.fault = lambda: 'disconnect'
+    addr = min(symo_simulator.writable_addresses(1))
+    assert symo.write_single_register(addr, 5) is False
+    assert symo.stats['failed_requests'] == 1
+
+
+@pytest.mark.parametrize("name,value", [
+    ["Battery_OutWRte", -50.0],
+    ["Battery_InWRte", -12.5],
+    ["Battery_InWRte", 75.0],
+    ["Meter_Power_Total", -1234.5],
+])
+def test_negative_values(symo, symo_simulator, name, value):
+    symo_simulator.set_value(name, value)
+    assert symo.read_parameters([name])[name] == pytest.approx(value)
+    assert symo.read_data(name) == pytest.approx(value)
+
+
+def test_int16_two_complement():
+    # -1 is 0xffff, which means "not implemented", -2 is a real value
+    registers = {"rate" : [[1, 2], "int16_sunssf", 1]}
+    plan = DecodePlan(registers, ["rate"], [[1, 1, 2]])
+    assert plan.decode([[0xfffe, 0xfffe]])["rate"] == pytest.approx(-0.02)
+    assert plan.decode([[0xffff, 0xfffe]])["rate"] is None
+    assert plan.decode([[0x7fff, 0]])["rate"] == 32767.0
+    assert plan.decode([[0x8000, 0]])["rate"] == -32768.0
+
+
+def test_decode_plan_types():
+    registers = {
+        "u16" : [1, "uint16", 1],
+        "u32" : [2, "uint32", 1],
+        "f" : [4, "float", 1],
+        "s" : [6, "string8", 1],
+        "acc" : [[14, 16], "acc32_sunssf", 1],
+    }
+    regs = [7, 1, 2] + list(struct.unpack('>HH', struct.pack('>f', 1.5))) + [0x4142, 0x4344] + [0] * 6 + [0, 1234, 0xffff]
+    plan = DecodePlan(registers, list(registers), [[1, 1, 16]])
+    record = plan.decode([regs])
+    assert record.as_dict() == {"u16" : 7, "u32" : 65538, "f" : 1.5, "s" : "ABCD", "acc" : pytest.approx(123.4)}
+
+
+def test_decode_plan_failed_block():
+    registers = {"a" : [1, "uint16", 1], "b" : [1, "uint16", 200]}
+    plan = DecodePlan(registers, ["a", "b"], [[1, 1, 1], [200, 1, 1]])
+    assert plan.decode([[5], None]).as_dict() == {"a" : 5, "b" : False}
+
+
+def test_decode_plan_rejects_uncovered_address():
+    with pytest.raises(ValueError):
+        DecodePlan({"a" : [10, "uint16", 1]}, ["a"], [[1, 1, 5]])
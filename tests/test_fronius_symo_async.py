@@ -0,0 +1,112 @@
+#
+# AsyncSymo against the Modbus simulator
+#
+
+import asyncio
+import socket
+
+import pytest
+
+from pv_fronius.symo_simulator import SymoSimulator
+from pv_fronius.fronius_symo_async import AsyncSymo, poll_fleet
+import fronius_influxdb
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def test_same_values_as_symo(symo, symo_simulator):
+    async def read():
+        asymo = await AsyncSymo.create("127.0.0.1", port=symo_simulator.port, timeout=2.0, sunspec_cache=None)
+        try:
+            return [asymo.name, await asymo.read_parameters()]
+        finally:
+            await asymo.close()
+
+    [name, values] = asyncio.run(read())
+    assert name == symo.name
+    expected = symo.read_parameters()
+    for parameter, value in expected.items():
+        if isinstance(value, float):
+            assert values[parameter] == pytest.approx(value), parameter
+        else:
+            assert values[parameter] == value, parameter
+
+
+def test_pipelined_sweep_uses_one_request_per_block(symo_simulator):
+    async def read():
+        asymo = await AsyncSymo.create("127.0.0.1", port=symo_simulator.port, timeout=2.0, max_inflight=4, sunspec_cache=None)
+        try:
+            before = symo_simulator.stats['read_requests']
+            values = await asymo.read_parameters()
+            return [symo_simulator.stats['read_requests'] - before, len(asymo.decode_plan().blocks), values]
+        finally:
+            await asymo.close()
+
+    [requests, blocks, values] = asyncio.run(read())
+    assert requests == blocks
+    assert not any(value is False for value in values.values())
+
+
+def test_fleet_snapshot():
+    simulators = [SymoSimulator(port=0, seed=i).start() for i in range(3)]
+    simulators[1].set_value("AC_Output_Power", 4321.0)
+
+    async def poll():
+        symos = [await AsyncSymo.create("127.0.0.1", port=simulator.port, timeout=2.0, sunspec_cache=None) for simulator in simulators]
+        try:
+            return await poll_fleet(symos, ["AC_Output_Power", "Self_Consumption_Ratio"])
+        finally:
+            for symo in symos:
+                await symo.close()
+
+    try:
+        snapshots = asyncio.run(poll())
+    finally:
+        for simulator in simulators:
+            simulator.stop()
+    assert len(snapshots) == 3
+    assert snapshots[1]["AC_Output_Power"] == 4321.0
+    assert all(snapshot["Self_Consumption_Ratio"] is not False for snapshot in snapshots)
+
+
+def test_reconnects_after_dead_connection(symo_simulator):
+    faults = []
+    symo_simulator.fault = lambda: faults.pop() if faults else None
+
+    async def run():
+        asymo = AsyncSymo("127.0.0.1", port=symo_simulator.port, timeout=1.0, sunspec_cache=None)
+        await asymo.detect_model()
+        try:
+            faults.append('disconnect')
+            failed = await asymo.read_parameters(["AC_Output_Power"])
+            return [failed, await asymo.read_parameters(["AC_Output_Power"])]
+        finally:
+            await asymo.close()
+
+    [failed, values] = asyncio.run(run())
+    assert failed["AC_Output_Power"] is False
+    assert values["AC_Output_Power"] == 1500.0
+
+
+def test_unreachable_device_is_detected_later():
+    port = free_port()
+
+    async def run():
+        asymo = AsyncSymo("127.0.0.1", port=port, timeout=1.0, sunspec_cache=None)
+        try:
+            missing = await fronius_influxdb.detect(asymo)
+            simulator = SymoSimulator(port=port).start()
+            try:
+                return [missing, await fronius_influxdb.detect(asymo)]
+            finally:
+                simulator.stop()
+        finally:
+            await asymo.close()
+
+    assert asyncio.run(run()) == [False, True]
@@ -0,0 +1,237 @@
+#
+# GoeCharger against the go-e simulator
+#
+
+import time
+import logging
+
+import pytest
+
+from go_e_charger.go_e_charger_httpv2 import GoeCharger
+from go_e_charger.go_e_simulator import benchmark
+
+
+@pytest.fixture
+def connect(goe_simulator):
+    chargers = []
+
+    def connect(**kwargs):
+        kwargs.setdefault('retry_backoff', 0.01)
+        charger = GoeCharger("{0}:{1}".format(goe_simulator.host, goe_simulator.port), **kwargs)
+        chargers.append(charger)
+        return charger
+
+    yield connect
+    for charger in chargers:
+        charger.close()
+
+
+def test_requests_share_one_connection(goe_simulator, connect):
+    goe = connect(status_ttl=0.0)
+    for i in range(5):
+        assert goe.ChargerMaxCurrent == 6
+    stats = goe.connection_stats()
+    assert stats['requests'] == 5
+    assert stats['new_connections'] == 1
+    assert stats['reused_connections'] == 4
+    assert goe_simulator.stats['connections'] == 1
+
+
+def test_status_reads_are_retried(goe_simulator, connect):
+    goe = connect(status_ttl=0.0, retries=2)
+    goe.ChargerMaxCurrent
+    goe_simulator.fault_rate = 1.0
+    goe_simulator.fault_modes = ['disconnect']
+    assert goe.ChargerMaxCurrent is None
+    assert goe.stats['retries'] == 2
+    assert goe.stats['failed_requests'] == 1
+    goe_simulator.fault_rate = 0.0
+    assert goe.ChargerMaxCurrent == 6
+
+
+def test_property_reads_share_one_status_request(goe_simulator, connect):
+    goe = connect()
+    goe.ChargerMaxCurrent
+    goe.ForceOn
+    goe.SetPhaseMode
+    goe.P_All
+    assert goe_simulator.stats['status_requests'] == 1
+    assert goe.stats['cache_hits'] == 3
+
+
+def test_status_expires_after_ttl(goe_simulator, connect):
+    goe = connect(status_ttl=0.1)
+    goe.ChargerMaxCurrent
+    goe.ChargerMaxCurrent
+    assert goe_simulator.stats['status_requests'] == 1
+    time.sleep(0.15)
+    goe.ChargerMaxCurrent
+    assert goe_simulator.stats['status_requests'] == 2
+
+
+def test_no_stale_values_after_failed_read(goe_simulator, connect):
+    goe = connect(status_ttl=0.1, retries=0)
+    assert goe.ChargerMaxCurrent == 6
+    goe_simulator.fault_rate = 1.0
+    goe_simulator.fault_modes = ['disconnect']
+    time.sleep(0.15)
+    assert goe.ChargerMaxCurrent is None
+    assert goe.GetStatusAll() == {}
+
+
+def test_sets_update_the_cache(goe_simulator, connect):
+    goe = connect()
+    goe.ChargerMaxCurrent
+    goe.ChargerMaxCurrent = 10
+    assert goe.ChargerMaxCurrent == 10
+    assert goe_simulator.stats['status_requests'] == 1
+    assert goe_simulator.amp == 10
+
+
+def test_apply_results(goe_simulator, connect):
+    goe = connect()
+    results = goe.apply({
+        'charger_max_current' : 10,
+        'frc' : 2,
+        'phase_switch_mode' : 7,
+        'energy_total' : 5,
+        'foo' : 1,
+    })
+    assert results == {
+        'charger_max_current' : 'ok',
+        'frc' : 'ok',
+        'phase_switch_mode' : 'invalid',
+        'energy_total' : 'read only',
+        'foo' : 'unknown',
+    }
+    assert goe_simulator.stats['set_requests'] == 1
+    assert [goe_simulator.amp, goe_simulator.frc] == [10, 2]
+
+
+def test_apply_skips_unchanged_keys(goe_simulator, connect):
+    goe = connect()
+    goe.apply({'charger_max_current' : 10})
+    assert goe.apply({'charger_max_current' : 10, 'psm' : 2}) == {'charger_max_current' : 'unchanged', 'psm' : 'ok'}
+    assert goe.apply({'charger_max_current' : 10, 'psm' : 2}) == {'charger_max_current' : 'unchanged', 'psm' : 'unchanged'}
+    assert goe_simulator.stats['set_requests'] == 2
+    assert goe_simulator.stats['keys_set'] == 2
+
+
+def test_low_power_is_raised_to_minimum_current(goe_simulator, connect, caplog):
+    goe = connect(settle_interval=0.02)
+    goe.apply({'psm' : 2})
+    with caplog.at_level(logging.WARNING):
+        goe.setChargingP(2500)
+    # 1250 W per phase of a 2 phase car = 5 A
+    assert goe_simulator.amp == 6
+    assert "5 A is below the minimum" in caplog.text
+
+
+def test_set_charging_p_returns_before_settling(goe_simulator, connect):
+    goe = connect(settle_interval=0.02, settle_timeout=5.0)
+    goe.ForceOn = 1
+    start = time.monotonic()
+    settle = goe.setChargingP(4500)
+    assert time.monotonic() - start < 1.0
+    assert goe.settling()
+    assert settle.result(timeout=5.0) is True
+    assert not goe.settling()
+    # 3 phase mode, 2250 W per phase
+    assert [goe_simulator.psm, goe_simulator.acu] == [2, 9]
+    assert goe.stats['settled'] == 1
+
+
+def test_later_set_supersedes(goe_simulator, connect):
+    goe = connect(settle_interval=0.02, settle_timeout=5.0)
+    goe.ForceOn = 1
+    settled = []
+    first = goe.setChargingP(4500, on_settled=settled.append)
+    second = goe.setChargingP(6000)
+    assert first.result(timeout=5.0) is None
+    assert second.result(timeout=5.0) is True
+    assert settled == [first]
+
+
+def test_settle_timeout(goe_simulator, connect):
+    goe = connect(settle_interval=0.02, settle_timeout=0.2)
+    # Forced off, the car never draws the current
+    goe.ForceOn = 0
+    goe_simulator.set_delay = 100.0
+    assert goe.setChargingP(4500).result(timeout=5.0) is False
+    assert goe.stats['settle_timeouts'] == 1
+
+
+def test_failed_settle_polls_resolve_the_future(goe_simulator, connect):
+    goe = connect(settle_interval=0.02, settle_timeout=0.3)
+    refresh = goe.refresh
+
+    def broken_refresh(codes=None):
+        if codes == ['acu', 'car', 'nrg']:
+            raise ValueError("truncated reply")
+        return refresh(codes)
+
+    goe.refresh = broken_refresh
+    settle = goe.setChargingP(4500)
+    assert settle.result(timeout=5.0) is False
+    assert not goe.settling()
+
+
+def test_status_reads_use_filter(goe_simulator, connect):
+    goe = connect()
+    assert goe.ChargerMaxCurrent == 6
+    assert goe.filter_supported is True
+    goe.invalidate()
+    goe.ChargerMaxCurrent
+    assert goe_simulator.stats['full_status_requests'] == 0
+    assert goe.connection_stats()['bytes_received'] < 1000
+
+
+def test_full_status_if_filter_is_ignored(goe_simulator, connect):
+    process = goe_simulator.process
+    # Older firmware, filter= is ignored
+    goe_simulator.process = lambda path: process(path.split('?')[0] if path.startswith('/api/status') else path)
+    goe = connect()
+    assert goe.ChargerMaxCurrent == 6
+    assert goe.filter_supported is False
+    goe.invalidate()
+    assert goe.ChargerMaxCurrent == 6
+    assert goe_simulator.stats['full_status_requests'] == 2
+    assert goe_simulator.stats['status_requests'] == 2
+
+
+def test_missing_keys_are_checked_with_full_status(goe_simulator, connect):
+    status = goe_simulator.status
+    # A firmware without the cus key
+    goe_simulator.status = lambda codes=None: {code : value for code, value in status(codes).items() if code != 'cus'}
+    goe = connect()
+    assert goe.ChargerMaxCurrent == 6
+    assert goe.filter_supported is True
+    assert goe_simulator.stats['full_status_requests'] == 1
+
+
+def test_failed_reply_keeps_filter_detection_open(goe_simulator, connect):
+    goe = connect(retries=0)
+    goe_simulator.fault_rate = 1.0
+    goe_simulator.fault_modes = ['error']
+    assert goe.ChargerMaxCurrent is None
+    assert goe.filter_supported is None
+    goe_simulator.fault_rate = 0.0
+    assert goe.ChargerMaxCurrent == 6
+    assert goe.filter_supported is True
+
+
+def test_benchmark_settles_every_cycle(goe_simulator):
+    results = benchmark(goe_simulator, cycles=3)
+    assert results['settled'] == 3
+    assert results['new_connections'] == 1
+    assert results['control_requests_per_cycle'] <= 3
+
+
+def test_simulator_rejects_invalid_sets(goe_simulator):
+    assert goe_simulator.set({'amp' : 5, 'frc' : 2, 'fna' : "x", 'foo' : 1}) == {
+        'amp' : "value out of range",
+        'frc' : True,
+        'fna' : "key not writable",
+        'foo' : "key not found",
+    }
+    assert goe_simulator.amp == 6
@@ -0,0 +1,166 @@
+#
+# influxdb_cli2 without a server: written lines and query results
+#
+
+import datetime
+
+import pytest
+from influxdb_client import Point
+
+from influxdb_cli2.influxdb_cli2 import influxdb_cli2, timestamp_ns
+from influxdb_cli2.write_filter import write_filter
+
+time = datetime.datetime(2024, 6, 1, 12, 0, 0)
+ns = timestamp_ns(time)
+
+
+@pytest.fixture
+def connect():
+    databases = []
+
+    # Nothing is sent, lines are collected in db.lines
+    def connect(**kwargs):
+        db = influxdb_cli2("http://127.0.0.1:1", "token", "org", "bucket", **kwargs)
+        db.lines = []
+        db.write_records = db.lines.extend
+        databases.append(db)
+        return db
+
+    yield connect
+    for db in databases:
+        db.close()
+
+
+def test_line_protocol_escaping(connect):
+    db = connect()
+    db.write_sensordata("pv fronius,1", "Battery Power=x", 1.5, timestamp=time)
+    assert db.lines == [r"Battery\ Power=x,location=pv\ fronius\,1 value=1.5 {0}".format(ns)]
+
+
+def test_same_lines_as_point(connect):
+    db = connect()
+    # Point writes integral floats without ".0", both are floats for InfluxDB
+    for [location, measurement, value] in [["pv", "AC_Output_Power", 1500.5], ["a b", "c,d", -0.25], ["x=y", "z", 1e-7]]:
+        db.write_sensordata(location, measurement, value, timestamp=time)
+        point = Point(measurement).tag("location", location).field("value", float(value)).time(ns)
+        assert db.lines[-1] == point.to_line_protocol()
+
+
+def test_zero_only_when_forced(connect):
+    db = connect()
+    db.write_sensordata("pv", "Power", 0.0, timestamp=time)
+    db.write_sensordata("pv", "Power", None, timestamp=time, force=True)
+    assert db.lines == []
+    db.write_sensordata("pv", "Power", 0, timestamp=time, force=True)
+    assert db.lines == ["Power,location=pv value=0.0 {0}".format(ns)]
+
+
+def test_fields_in_one_line(connect):
+    db = connect()
+    db.write_fields("pv", "symo", {"AC Power" : 1500, "zero" : 0.0, "failed" : False, "missing" : None, "nan" : float('nan'), "SoC" : 55.5}, timestamp=time)
+    assert db.lines == [r"symo,location=pv AC\ Power=1500.0,SoC=55.5 {0}".format(ns)]
+
+
+def test_filtered_fields_keep_their_timestamps(connect):
+    db = connect(write_filter=write_filter([["", {'deadband' : 1.0, 'heartbeat' : None}]]))
+    for [seconds, values] in [[0, {"a" : 10.0, "b" : 5.0}], [1, {"a" : 10.2, "b" : 5.0}], [2, {"a" : 20.0, "b" : 5.1}]]:
+        db.write_fields("pv", "symo", values, timestamp=time + datetime.timedelta(seconds=seconds))
+    second = ns + 1000000000
+    assert db.lines == [
+        "symo,location=pv a=10.0,b=5.0 {0}".format(ns),
+        # Held back a, sent with the step
+        "symo,location=pv a=10.2 {0}".format(second),
+        "symo,location=pv a=20.0 {0}".format(second + 1000000000),
+    ]
+    db.flush()
+    assert db.lines[-1] == "symo,location=pv b=5.1 {0}".format(second + 1000000000)
+
+
+class record:
+    def __init__(self, measurement, time, value):
+        self.measurement = measurement
+        self.time = time
+        self.value = value
+
+    def get_measurement(self):
+        return self.measurement
+
+    def get_time(self):
+        return self.time
+
+    def get_value(self):
+        return self.value
+
+
+class table:
+    def __init__(self, records):
+        self.records = records
+
+
+# Query api returning records, the flux queries are kept in queries
+class query_api:
+    def __init__(self, records):
+        self.records = records
+        self.queries = []
+
+    def query(self, query):
+        self.queries.append(query)
+        return [table([record]) for record in self.records]
+
+
+def answer(db, records):
+    api = query_api(records)
+    db.influxdb_client.query_api = lambda: api
+    return api
+
+
+def at(minutes):
+    return datetime.datetime(2024, 6, 1, 12, minutes, tzinfo=datetime.timezone.utc)
+
+
+def test_query_last_is_reduced_on_the_server(connect):
+    db = connect()
+    api = answer(db, [record("price_total", at(0), 0.30), record("price_total", at(5), 0.25)])
+    assert db.query_last("grid", "price_total", datetime.timedelta(hours=1)) == 0.25
+    [query] = api.queries
+    assert "range(start: -3600s)" in query
+    assert 'r._measurement == "price_total"' in query
+    assert 'r.location == "grid"' in query
+    assert "|> last()" in query
+
+
+def test_query_last_without_value(connect):
+    db = connect()
+    answer(db, [])
+    assert db.query_last("grid", "price_total", 3600) is None
+
+
+def test_query_last_series_with_one_query(connect):
+    db = connect()
+    api = answer(db, [
+        record("Battery_SoC", at(1), 50.0),
+        record("Battery_SoC", at(3), 52.0),
+        record("Meter_Power_Total", at(2), -300.0),
+    ])
+    values = db.query_last_series("pv", ["Battery_SoC", "Meter_Power_Total", "AC_Output_Power"], 600)
+    assert values == {"Battery_SoC" : 52.0, "Meter_Power_Total" : -300.0}
+    [query] = api.queries
+    assert 'r._measurement == "Battery_SoC" or r._measurement == "Meter_Power_Total" or r._measurement == "AC_Output_Power"' in query
+
+
+def test_query_strings_are_quoted(connect):
+    db = connect()
+    api = answer(db, [])
+    db.query_first('my "pv"', "a\\b", 60, field="value")
+    [query] = api.queries
+    assert r'r.location == "my \"pv\""' in query
+    assert r'r._measurement == "a\\b"' in query
+    assert 'r._field == "value"' in query
+    assert "|> first()" in query
+
+
+def test_query_window(connect):
+    db = connect()
+    api = answer(db, [record("Power", at(10), 2.0), record("Power", at(5), 1.0)])
+    assert db.query_window("pv", "Power", 3600, 300, fn="max") == [[at(5), 1.0], [at(10), 2.0]]
+    assert "aggregateWindow(every: 300s, fn: max, createEmpty: false)" in api.queries[0]
@@ -0,0 +1,42 @@
+#
+# Latency histogram and request counters of ModbusMetrics
+#
+
+import pytest
+
+from pv_fronius.modbus_metrics import LatencyHistogram
+
+
+def test_quantiles_below_max_for_fast_replies():
+    histogram = LatencyHistogram()
+    for i in range(99):
+        histogram.observe(0.0011 + i * 0.00002)
+    histogram.observe(0.040)
+    assert histogram.quantile(0.5) < 0.003
+    assert histogram.quantile(0.9) < 0.005
+    assert histogram.quantile(0.5) < histogram.quantile(0.9) <= histogram.max
+
+
+def test_quantiles_stay_within_min_max():
+    histogram = LatencyHistogram()
+    histogram.observe(0.003)
+    assert histogram.quantile(0.5) == pytest.approx(0.003)
+    assert histogram.quantile(0.99) == pytest.approx(0.003)
+    assert LatencyHistogram().quantile(0.5) is None
+
+
+def test_quantile_is_interpolated():
+    histogram = LatencyHistogram()
+    for value in [0.011, 0.019]:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(0.015)
+
+
+def test_requests_against_simulator(symo):
+    symo.metrics.reset()
+    symo.read_parameters()
+    metrics = symo.modbus_metrics()
+    total = metrics['total']
+    assert total['requests'] == len(symo.decode_plan().blocks)
+    assert total['errors'] == 0
+    assert total['latency']['p50'] <= total['latency']['max']
@@ -0,0 +1,75 @@
+#
+# PollScheduler deadlines with an injected clock
+#
+
+from pv_fronius.poll_scheduler import PollScheduler, poll_class
+
+
+class clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+names = ["AC_Output_Power", "Battery_SoC", "AC_Energy", "Nameplate_Battery_Capacity"]
+periods = {"static" : None, "power" : 5.0, "state" : 30.0, "energy" : 60.0}
+
+
+def test_poll_classes():
+    assert [poll_class(name) for name in names] == ["power", "state", "energy", "static"]
+    assert poll_class("Battery_InWRte") == "state"
+
+
+def test_everything_due_at_start():
+    scheduler = PollScheduler(names, periods, clock=clock(100.0))
+    assert sorted(scheduler.due()) == sorted(names)
+
+
+def test_groups_follow_their_periods():
+    now = clock(100.0)
+    scheduler = PollScheduler(names, periods, clock=now)
+    scheduler.completed({name : 1.0 for name in scheduler.due()})
+    assert scheduler.due() == []
+    assert scheduler.sleep_time() == 5.0
+
+    now.now = 105.0
+    assert scheduler.due() == ["AC_Output_Power"]
+    scheduler.completed({"AC_Output_Power" : 1.0})
+
+    now.now = 130.0
+    assert scheduler.due() == ["AC_Output_Power", "Battery_SoC"]
+
+
+def test_deadlines_dont_drift():
+    now = clock(100.0)
+    scheduler = PollScheduler(["AC_Output_Power"], periods, clock=now)
+    scheduler.due()
+    # Read finished late
+    now.now = 101.5
+    scheduler.completed({"AC_Output_Power" : 1.0})
+    assert scheduler.sleep_time() == 3.5
+
+
+def test_late_group_is_rescheduled_without_burst():
+    now = clock(100.0)
+    scheduler = PollScheduler(["AC_Output_Power"], periods, clock=now)
+    scheduler.due()
+    now.now = 117.0
+    scheduler.completed({"AC_Output_Power" : 1.0})
+    assert scheduler.stats['late'] == 1
+    assert scheduler.due() == []
+    assert scheduler.sleep_time() == 5.0
+
+
+def test_static_values_until_read():
+    now = clock(100.0)
+    scheduler = PollScheduler(["Nameplate_Battery_Capacity"], periods, clock=now)
+    scheduler.due()
+    scheduler.completed({"Nameplate_Battery_Capacity" : False})
+    assert scheduler.due() == ["Nameplate_Battery_Capacity"]
+    scheduler.completed({"Nameplate_Battery_Capacity" : 10200})
+    assert scheduler.due() == []
+    assert scheduler.next_deadline() is None
+    assert scheduler.sleep_time(maximum=60.0) == 60.0
@@ -0,0 +1,167 @@
+#
+# TTL/LRU query cache, alone and behind influxdb_cli2.query_last()
+#
+
+import datetime
+
+import pytest
+
+from influxdb_cli2.query_cache import query_cache
+from influxdb_cli2.influxdb_cli2 import influxdb_cli2, timestamp_ns
+
+
+class clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def key(measurement, kind='last', location='loc'):
+    return (kind, location, (measurement,), '1h', None)
+
+
+def test_hit_and_miss():
+    cache = query_cache(clock=clock(1000.0))
+    assert cache.get(key('a')) == [False, None]
+    cache.put(key('a'), 1.5)
+    assert cache.get(key('a')) == [True, 1.5]
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+def test_none_results_are_cached():
+    cache = query_cache(clock=clock(1000.0))
+    cache.put(key('a'), None)
+    assert cache.get(key('a')) == [True, None]
+
+
+def test_ttl_expires():
+    now = clock(1000.0)
+    cache = query_cache(ttls=[], default=60.0, clock=now)
+    cache.put(key('a'), 1.0)
+    now.now += 59.0
+    assert cache.get(key('a'))[0]
+    now.now += 1.0
+    assert cache.get(key('a')) == [False, None]
+    assert cache.stats['expired'] == 1
+
+
+def test_aligned_ttl_until_next_hour():
+    # 10:30 UTC
+    now = clock(36 * 3600 + 10 * 3600 + 1800.0)
+    cache = query_cache(clock=now)
+    cache.put(key('price_total'), 0.30)
+    now.now = 36 * 3600 + 11 * 3600 + 59.0
+    assert cache.get(key('price_total')) == [True, 0.30]
+    now.now += 1.0
+    assert cache.get(key('price_total')) == [False, None]
+
+
+def test_aligned_ttl_shortly_after_the_hour():
+    # 11:00:30, the price of 11:00 could still be missing, expire at 11:01
+    now = clock(11 * 3600 + 30.0)
+    cache = query_cache(clock=now)
+    assert cache.expires(['price_total'], now.now) == 11 * 3600 + 60.0
+
+
+def test_least_recently_used_goes_first():
+    cache = query_cache(max_entries=2, clock=clock(1000.0))
+    cache.put(key('a'), 1.0)
+    cache.put(key('b'), 2.0)
+    cache.get(key('a'))
+    cache.put(key('c'), 3.0)
+    assert cache.get(key('b')) == [False, None]
+    assert cache.get(key('a')) == [True, 1.0]
+    assert cache.stats['evicted'] == 1
+
+
+def test_written_updates_last_values():
+    cache = query_cache(clock=clock(1000.0))
+    cache.put(key('a'), 1.0, {'a' : 100})
+    cache.put(('last_series', 'loc', ('a', 'b'), '1h', None), {'a' : 1.0, 'b' : 2.0}, {'a' : 100, 'b' : 100})
+    cache.written('loc', 'a', {'value' : 5.0}, 200)
+    assert cache.get(key('a')) == [True, 5.0]
+    assert cache.get(('last_series', 'loc', ('a', 'b'), '1h', None)) == [True, {'a' : 5.0, 'b' : 2.0}]
+    assert cache.stats['updated'] == 2
+
+
+def test_written_ignores_older_points():
+    cache = query_cache(clock=clock(1000.0))
+    cache.put(key('a'), 1.0, {'a' : 300})
+    cache.written('loc', 'a', {'value' : 5.0}, 200)
+    assert cache.get(key('a')) == [True, 1.0]
+
+
+def test_written_drops_other_results_of_the_series():
+    cache = query_cache(clock=clock(1000.0))
+    cache.put(key('a', kind='first'), 1.0)
+    cache.put(key('b', kind='first'), 2.0)
+    cache.written('loc', 'a', {'value' : 5.0}, 200)
+    assert cache.get(key('a', kind='first')) == [False, None]
+    assert cache.get(key('b', kind='first')) == [True, 2.0]
+    assert cache.stats['invalidated'] == 1
+
+
+def test_other_locations_are_not_touched():
+    cache = query_cache(clock=clock(1000.0))
+    cache.put(key('a', location='other'), 1.0)
+    cache.written('loc', 'a', {'value' : 5.0}, 200)
+    assert cache.get(key('a', location='other')) == [True, 1.0]
+
+
+class record:
+    def __init__(self, measurement, time, value):
+        self.measurement = measurement
+        self.time = time
+        self.value = value
+
+    def get_measurement(self):
+        return self.measurement
+
+    def get_time(self):
+        return self.time
+
+    def get_value(self):
+        return self.value
+
+
+@pytest.fixture
+def influxdb():
+    # No request is sent, queries and writes are replaced
+    db = influxdb_cli2("http://127.0.0.1:1", "token", "org", "bucket", query_cache=query_cache())
+    db.queries = []
+    db.records = []
+    time = datetime.datetime(2024, 6, 1, 10, 0, tzinfo=datetime.timezone.utc)
+
+    def query_reduced(location, measurements, lookback, reduce, field=None):
+        db.queries.append([location, measurements, reduce])
+        return [record(measurement, time, 0.25) for measurement in measurements]
+
+    db.query_reduced = query_reduced
+    db.write_records = db.records.extend
+    db.time = time
+    yield db
+    db.close()
+
+
+def test_query_last_is_cached(influxdb):
+    assert influxdb.query_last('grid', 'price_total', 3600) == 0.25
+    assert influxdb.query_last('grid', 'price_total', 3600) == 0.25
+    assert len(influxdb.queries) == 1
+
+
+def test_query_last_sees_own_writes(influxdb):
+    influxdb.query_last('ev', 'mode', 3600)
+    influxdb.write_sensordata('ev', 'mode', 3.0, force=True)
+    assert influxdb.query_last('ev', 'mode', 3600) == 3.0
+    assert len(influxdb.queries) == 1
+    assert len(influxdb.records) == 1
+
+
+def test_query_first_is_dropped_by_writes(influxdb):
+    assert influxdb.query_first('grid', 'price_total', 3600) == 0.25
+    influxdb.write_sensordata('grid', 'price_total', 0.5, timestamp=timestamp_ns(influxdb.time) + 1, force=True)
+    influxdb.query_first('grid', 'price_total', 3600)
+    assert len(influxdb.queries) == 2
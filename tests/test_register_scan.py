@@ -0,0 +1,60 @@
+#
+# RegisterScanner against the Modbus simulator, type guessing and scan diffs
+#
+
+import struct
+
+from pv_fronius.register_scan import RegisterScanner, symo_reader, guess_types, diff_scans
+
+
+def scanner(symo):
+    return RegisterScanner(symo_reader(symo))
+
+
+def test_gaps_are_bisected(symo, symo_simulator):
+    scan = scanner(symo)
+    [readable, unreadable, failed] = scan.scan_range(1, 39990, 200)
+    assert unreadable == [[39990, 11]]
+    assert failed == []
+    assert readable[0][0] == 40001
+    assert len(readable[0][1]) == 189
+    # Far fewer requests than registers
+    assert scan.stats['requests'] < 30
+
+
+def test_registers_match_reads(symo, symo_simulator):
+    scan = scanner(symo).scan([1], [[40001, 40100]], device=symo.name)
+    registers = scan["units"]["1"]["registers"]
+    symo.modbus.unit_id = 1
+    assert [raw for [addr, raw, datatype] in registers] == symo.read_block(40001, 100)
+    types = {addr : datatype for [addr, raw, datatype] in registers}
+    # 'SunS' marker and the device name
+    assert types[40001] == "string"
+    assert types[40021] == "string"
+
+
+def test_unit_without_device_is_skipped(symo, symo_simulator):
+    scan = scanner(symo)
+    [readable, unreadable, failed] = scan.scan_range(7, 40001, 300)
+    assert readable == []
+    assert failed == [[40001, 300]]
+    assert scan.stats['requests'] == 1
+
+
+def test_guess_types():
+    regs = [0x4142, 0x4300] + list(struct.unpack('>HH', struct.pack('>f', 1500.0))) + [0xffff, 0xfffe, 0xff00, 42]
+    assert guess_types(regs) == ["string", "string", "float", "float_lo", "unimplemented", "sunssf", "int16", "uint16"]
+
+
+def test_diff_shows_changed_registers(symo, symo_simulator):
+    old = scanner(symo).scan([1, 200], [[40001, 40300]])
+    symo_simulator.set_value("Operating_State", 7)
+    new = scanner(symo).scan([1, 200], [[40001, 40300]])
+    [register, datatype, unit_id] = symo.registers["Operating_State"]
+    assert diff_scans(old, new) == {1 : [[register, 4, 7, "uint16"]]}
+
+
+def test_diff_of_added_and_removed_registers():
+    old = {"units" : {"1" : {"registers" : [[40001, 1, "uint16"], [40002, 2, "uint16"]]}}}
+    new = {"units" : {"1" : {"registers" : [[40002, 2, "uint16"], [40003, 3, "uint16"]]}}}
+    assert diff_scans(old, new) == {1 : [[40001, 1, None, "uint16"], [40003, None, 3, "uint16"]]}
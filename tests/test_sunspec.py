@@ -0,0 +1,93 @@
+#
+# SunSpec model chain walk and the on-disk cache of discovered chains
+#
+
+import os
+
+from pv_fronius import sunspec
+from pv_fronius.symo_simulator import SymoSimulator, exp_slave_device_busy
+from pv_fronius.fronius_symo import Symo
+
+
+# Read function for walk_model_chain over {address : [ID, L]}, failures at addresses
+def chain_reader(headers, failures=()):
+    def read(unit_id, addr, count):
+        if addr in failures:
+            return False
+        if addr == sunspec.sunspec_start:
+            return list(sunspec.sunspec_marker)
+        return headers.get(addr)
+    return read
+
+
+def walk(read):
+    return sunspec.run_sync(sunspec.walk_model_chain(1), read)
+
+
+def test_walk_until_end_model():
+    headers = {40003 : [1, 65], 40070 : [113, 60], 40132 : [sunspec.end_model_id, 0]}
+    assert walk(chain_reader(headers)) == {1 : [40003, 65], 113 : [40070, 60]}
+
+
+def test_walk_ends_at_missing_address():
+    headers = {40003 : [1, 65], 40070 : [113, 60]}
+    assert walk(chain_reader(headers)) == {1 : [40003, 65], 113 : [40070, 60]}
+
+
+def test_unit_without_sunspec():
+    assert walk(lambda unit_id, addr, count: None) == {}
+    assert walk(lambda unit_id, addr, count: [0, 0]) == {}
+
+
+def test_failed_reads_leave_chain_incomplete():
+    headers = {40003 : [1, 65], 40070 : [113, 60], 40132 : [sunspec.end_model_id, 0]}
+    assert walk(chain_reader(headers, failures=[sunspec.sunspec_start])) is None
+    assert walk(chain_reader(headers, failures=[40070])) is None
+
+
+def sunspec_symo(simulator, cache_dir):
+    return Symo("127.0.0.1", port=simulator.port, model="sunspec", timeout=1.0, sunspec_cache=str(cache_dir))
+
+
+def test_discovered_registers(symo_simulator, tmp_path):
+    symo = sunspec_symo(symo_simulator, tmp_path)
+    values = symo.read_parameters(["AC_Output_Power", "Meter_Power_Total", "Battery_SoC"])
+    assert values["AC_Output_Power"] == 1500.0
+    assert values["Meter_Power_Total"] is not False
+    assert values["Battery_SoC"] is not False
+    assert "MPPT_1_DC_Power" in symo.registers
+
+
+def test_cache_saves_the_walk(symo_simulator, tmp_path):
+    first = sunspec_symo(symo_simulator, tmp_path)
+    assert len(os.listdir(tmp_path)) == 1
+    before = symo_simulator.stats['read_requests']
+    second = sunspec_symo(symo_simulator, tmp_path)
+    # Only the common block to identify the device
+    assert symo_simulator.stats['read_requests'] - before == 1
+    assert second.registers == first.registers
+
+
+def test_device_without_meter_is_cached(tmp_path):
+    simulator = SymoSimulator(model="symo", port=0).start()
+    try:
+        symo = sunspec_symo(simulator, tmp_path)
+    finally:
+        simulator.stop()
+    assert "AC_Output_Power" in symo.registers
+    assert "Meter_Power_Total" not in symo.registers
+    assert len(os.listdir(tmp_path)) == 1
+
+
+def test_failed_walk_is_not_cached(symo_simulator, tmp_path):
+    process = symo_simulator.process
+    # Busy is a transient error, not a missing meter
+    symo_simulator.process = lambda unit_id, pdu: symo_simulator.exception(pdu[0], exp_slave_device_busy) if unit_id == 200 else process(unit_id, pdu)
+    symo = sunspec_symo(symo_simulator, tmp_path)
+    assert symo.registers == {}
+    assert os.listdir(tmp_path) == []
+
+    symo_simulator.process = process
+    symo.detect_model()
+    assert "Meter_Power_Total" in symo.registers
+    assert len(os.listdir(tmp_path)) == 1
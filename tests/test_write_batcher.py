@@ -0,0 +1,148 @@
+#
+# Batching, backpressure and error handling of write_batcher
+#
+
+import time
+import threading
+
+import pytest
+
+from influxdb_cli2.write_batcher import write_batcher
+
+
+class recorder:
+    def __init__(self, fail=0):
+        self.batches = []
+        self.fail = fail
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def write(self, batch):
+        self.gate.wait(5)
+        if self.fail:
+            self.fail -= 1
+            raise IOError("influxdb down")
+        self.batches.append(list(batch))
+
+
+# Until the writer thread took a batch and hangs in write()
+def wait_in_flight(batcher):
+    deadline = time.monotonic() + 5
+    while not batcher.in_flight and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert batcher.in_flight
+
+
+def test_batches_of_batch_size():
+    out = recorder()
+    batcher = write_batcher(out.write, batch_size=100, flush_interval=60.0)
+    for i in range(250):
+        batcher.put(i)
+    assert batcher.flush(5)
+    assert [len(batch) for batch in out.batches] == [100, 100, 50]
+    assert sum(out.batches, []) == list(range(250))
+    batcher.close(5)
+
+
+def test_flush_interval_writes_partial_batch():
+    out = recorder()
+    batcher = write_batcher(out.write, batch_size=100, flush_interval=0.05)
+    batcher.put(1)
+    time.sleep(0.5)
+    assert out.batches == [[1]]
+    batcher.close(5)
+
+
+def test_drop_oldest():
+    out = recorder()
+    out.gate.clear()
+    batcher = write_batcher(out.write, batch_size=2, flush_interval=60.0, queue_size=4, backpressure='drop_oldest')
+    batcher.put(0)
+    batcher.put(1)
+    wait_in_flight(batcher)
+    for i in range(2, 9):
+        batcher.put(i)
+    out.gate.set()
+    assert batcher.flush(5)
+    assert sum(out.batches, []) == [0, 1, 5, 6, 7, 8]
+    assert batcher.stats['dropped'] == 3
+    batcher.close(5)
+
+
+def test_drop_newest():
+    out = recorder()
+    out.gate.clear()
+    batcher = write_batcher(out.write, batch_size=2, flush_interval=60.0, queue_size=4, backpressure='drop_newest')
+    batcher.put(0)
+    batcher.put(1)
+    wait_in_flight(batcher)
+    results = [batcher.put(i) for i in range(2, 9)]
+    out.gate.set()
+    assert batcher.flush(5)
+    assert results == [True, True, True, True, False, False, False]
+    assert sum(out.batches, []) == [0, 1, 2, 3, 4, 5]
+    batcher.close(5)
+
+
+def test_block_waits_for_space():
+    out = recorder()
+    out.gate.clear()
+    batcher = write_batcher(out.write, batch_size=2, flush_interval=60.0, queue_size=2, backpressure='block')
+    batcher.put(0)
+    batcher.put(1)
+    wait_in_flight(batcher)
+    batcher.put(2)
+    batcher.put(3)
+    producer = threading.Thread(target=batcher.put, args=(4,))
+    producer.start()
+    producer.join(0.2)
+    assert producer.is_alive()
+    out.gate.set()
+    producer.join(5)
+    assert batcher.flush(5)
+    assert sum(out.batches, []) == [0, 1, 2, 3, 4]
+    assert batcher.stats['blocked'] == 1
+    batcher.close(5)
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        write_batcher(lambda batch: None, backpressure='wait')
+
+
+def test_error_callback_gets_failed_batch():
+    out = recorder(fail=1)
+    failed = []
+    batcher = write_batcher(out.write, batch_size=2, flush_interval=60.0, error_callback=lambda batch, e: failed.append(batch))
+    for i in range(4):
+        batcher.put(i)
+    assert batcher.flush(5)
+    assert failed == [[0, 1]]
+    assert out.batches == [[2, 3]]
+    assert batcher.stats['failed'] == 2
+    batcher.close(5)
+
+
+def test_failing_error_callback_keeps_writer_alive():
+    out = recorder(fail=1)
+
+    def callback(batch, e):
+        raise RuntimeError("broken callback")
+
+    batcher = write_batcher(out.write, batch_size=2, flush_interval=60.0, error_callback=callback)
+    for i in range(6):
+        batcher.put(i)
+    assert batcher.flush(5)
+    assert batcher.thread.is_alive()
+    assert out.batches == [[2, 3], [4, 5]]
+    batcher.close(5)
+
+
+def test_close_writes_rest_and_rejects_new_points():
+    out = recorder()
+    batcher = write_batcher(out.write, batch_size=100, flush_interval=60.0)
+    batcher.put(1)
+    batcher.close(5)
+    assert out.batches == [[1]]
+    assert not batcher.thread.is_alive()
+    assert batcher.put(2) is False
@@ -0,0 +1,94 @@
+#
+# Deadband, heartbeat and swinging door of write_filter
+#
+
+import datetime
+
+from influxdb_cli2.write_filter import write_filter
+
+start = datetime.datetime(2024, 6, 1, 12, 0, 0)
+
+
+def at(seconds):
+    return start + datetime.timedelta(seconds=seconds)
+
+
+def feed(wf, samples, measurement="Voltage"):
+    points = []
+    for [seconds, value] in samples:
+        points += wf.process("loc", measurement, value, at(seconds))
+    return points
+
+
+def test_deadband_suppresses_small_changes():
+    wf = write_filter([["Voltage", {'deadband' : 1.0, 'heartbeat' : None}]])
+    points = feed(wf, [[0, 230.0], [1, 230.5], [2, 229.4], [3, 230.9]])
+    assert points == [[230.0, at(0)]]
+
+
+def test_deadband_sends_held_point_before_a_step():
+    wf = write_filter([["Voltage", {'deadband' : 1.0, 'heartbeat' : None}]])
+    points = feed(wf, [[0, 230.0], [1, 230.2], [2, 230.1], [3, 235.0]])
+    assert points == [[230.0, at(0)], [230.1, at(2)], [235.0, at(3)]]
+
+
+def test_relative_deadband():
+    wf = write_filter([["Power", {'deadband_rel' : 0.1, 'heartbeat' : None}]])
+    points = feed(wf, [[0, 1000.0], [1, 1090.0], [2, 1110.0]], "Power")
+    assert [value for [value, timestamp] in points] == [1000.0, 1090.0, 1110.0]
+
+
+def test_zero_deadband_passes_every_change_and_real_zeros():
+    wf = write_filter([["State", {'deadband' : 0.0, 'heartbeat' : None}]])
+    points = feed(wf, [[0, 1], [1, 1], [2, 0], [3, 0], [4, 2], [5, 2]], "State")
+    # Steps, not ramps: the last value before each change is sent with it
+    assert points == [[1.0, at(0)], [1.0, at(1)], [0.0, at(2)], [0.0, at(3)], [2.0, at(4)]]
+
+
+def test_heartbeat():
+    wf = write_filter([["Energy", {'heartbeat' : 60.0}]])
+    points = feed(wf, [[0, 5.0], [30, 5.0], [59, 5.0], [60, 5.0], [90, 5.0], [121, 5.0]], "Energy")
+    assert [timestamp for [value, timestamp] in points] == [at(0), at(60), at(121)]
+
+
+def test_force_always_writes():
+    wf = write_filter([["Voltage", {'deadband' : 10.0, 'heartbeat' : None}]])
+    wf.process("loc", "Voltage", 230.0, at(0))
+    assert wf.process("loc", "Voltage", 230.0, at(1), force=True) == [[230.0, at(1)]]
+
+
+def test_swinging_door_drops_points_on_a_line():
+    wf = write_filter([["Power", {'swinging_door' : 1.0, 'heartbeat' : None}]])
+    points = feed(wf, [[t, 100.0 + 10.0 * t] for t in range(10)], "Power")
+    assert points == [[100.0, at(0)]]
+    assert wf.flush() == [["loc", "Power", 190.0, at(9)]]
+
+
+def test_swinging_door_keeps_the_corner():
+    wf = write_filter([["Power", {'swinging_door' : 1.0, 'heartbeat' : None}]])
+    samples = [[t, 100.0 + 10.0 * t] for t in range(6)] + [[t, 150.0] for t in range(6, 10)]
+    points = feed(wf, samples, "Power")
+    assert [100.0, at(0)] in points
+    assert [150.0, at(5)] in points
+    # Reconstruction by straight lines between the sent points stays within the deviation
+    points += [[value, timestamp] for [location, measurement, value, timestamp] in wf.flush()]
+    sent = sorted(points, key=lambda point: point[1])
+    for [seconds, value] in samples:
+        for [[v0, t0], [v1, t1]] in zip(sent, sent[1:]):
+            if t0 <= at(seconds) <= t1:
+                fraction = (at(seconds) - t0) / (t1 - t0)
+                assert abs(v0 + (v1 - v0) * fraction - value) <= 1.0
+                break
+
+
+def test_flush_returns_held_points_once():
+    wf = write_filter([["Voltage", {'deadband' : 1.0, 'heartbeat' : None}]])
+    feed(wf, [[0, 230.0], [1, 230.3]])
+    assert wf.flush() == [["loc", "Voltage", 230.3, at(1)]]
+    assert wf.flush() == []
+
+
+def test_series_are_independent():
+    wf = write_filter([["Voltage", {'deadband' : 1.0, 'heartbeat' : None}]])
+    assert wf.process("a", "Voltage", 230.0, at(0)) == [[230.0, at(0)]]
+    assert wf.process("b", "Voltage", 230.0, at(0)) == [[230.0, at(0)]]
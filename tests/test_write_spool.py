@@ -0,0 +1,139 @@
+#
+# Disk spool: replay, outages, restarts, torn lines and eviction
+#
+
+import os
+import time
+import threading
+
+from influxdb_cli2.write_spool import write_spool, segment_suffix
+
+
+class influxdb:
+    def __init__(self, up=True):
+        self.up = up
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def write(self, lines):
+        if not self.up:
+            raise IOError("influxdb down")
+        with self.lock:
+            self.lines.extend(lines)
+
+
+def spool(directory, db, **kwargs):
+    options = {'flush_interval' : 0.01, 'retry_interval' : 0.02, 'max_retry_interval' : 0.05}
+    options.update(kwargs)
+    return write_spool(str(directory), db.write, **options)
+
+
+def lines(count, start=0):
+    return ["m,location=x value={0} {0}".format(i) for i in range(start, start + count)]
+
+
+def segments(directory):
+    return sorted(name for name in os.listdir(str(directory)) if name.endswith(segment_suffix))
+
+
+def test_replays_in_order(tmp_path):
+    db = influxdb()
+    s = spool(tmp_path, db, batch_size=7)
+    for line in lines(50):
+        s.put(line)
+    assert s.flush(5)
+    assert db.lines == lines(50)
+    assert s.stats['replayed'] == 50
+    s.close()
+
+
+def test_keeps_lines_while_influxdb_is_down(tmp_path):
+    db = influxdb(up=False)
+    s = spool(tmp_path, db)
+    for line in lines(20):
+        s.put(line)
+    assert not s.flush(0.2)
+    assert s.stats['failed_batches'] >= 1
+    assert db.lines == []
+    db.up = True
+    assert s.flush(5)
+    assert db.lines == lines(20)
+    s.close()
+
+
+def test_survives_restart_without_duplicates(tmp_path):
+    db = influxdb(up=False)
+    s = spool(tmp_path, db)
+    for line in lines(10):
+        s.put(line)
+    s.close(timeout=0.1)
+
+    db.up = True
+    s = spool(tmp_path, db)
+    for line in lines(5, start=10):
+        s.put(line)
+    assert s.flush(5)
+    s.close()
+
+    s = spool(tmp_path, db)
+    assert s.flush(1)
+    s.close()
+    assert db.lines == lines(15)
+
+
+def test_replayed_segments_are_deleted(tmp_path):
+    db = influxdb()
+    s = spool(tmp_path, db, segment_size=200)
+    for line in lines(40):
+        s.put(line)
+    assert s.flush(5)
+    # Only the segment being written is left
+    assert len(segments(tmp_path)) == 1
+    s.close()
+
+
+def test_skips_torn_and_corrupt_lines(tmp_path):
+    db = influxdb(up=False)
+    s = spool(tmp_path, db)
+    for line in lines(3):
+        s.put(line)
+    s.close(timeout=0.1)
+    path = os.path.join(str(tmp_path), segments(tmp_path)[-1])
+    with open(path, 'a') as f:
+        f.write("00000000 m,location=x value=99 99\n")
+        f.write("deadbeef m,location=x val")
+
+    db.up = True
+    s = spool(tmp_path, db)
+    assert s.flush(5)
+    assert db.lines == lines(3)
+    assert s.stats['corrupt'] == 2
+    s.close()
+
+
+def test_evicts_oldest_segments_when_full(tmp_path):
+    db = influxdb(up=False)
+    s = spool(tmp_path, db, segment_size=500, max_size=2000)
+    for line in lines(200):
+        s.put(line)
+    assert s.stats['evicted_segments'] > 0
+    assert sum(os.path.getsize(os.path.join(str(tmp_path), name)) for name in segments(tmp_path)) <= 2000
+
+    db.up = True
+    assert s.flush(5)
+    # The newest lines are kept, in order
+    assert db.lines == lines(200)[-len(db.lines):]
+    s.close()
+
+
+def test_max_rate_limits_replay(tmp_path):
+    db = influxdb(up=False)
+    s = spool(tmp_path, db, batch_size=10, max_rate=200)
+    for line in lines(40):
+        s.put(line)
+    start = time.monotonic()
+    db.up = True
+    assert s.flush(5)
+    # 4 batches of 10 lines, 50ms pause after each full batch
+    assert time.monotonic() - start >= 0.15
+    s.close()